@@ -1,10 +1,18 @@
 #/bin/bash
 
 rm test/*.o
+rm test/*.o.build
 rm test/*.hex
 rm test/*.log
+rm test/*.ckpt
+rm test/*.prof
+rm test/*.batch.csv
+rm test/*.stdout
+rm test/*.stderr
+rm test/*.trace
+rm test/*.uart
+rm test/*.hash
 
-rm spike/outputs/*.i
-rm spike/outputs/*.r
 rm spike/outputs/*.d
+rm spike/outputs/*.commit
 rm spike/outputs/*.log
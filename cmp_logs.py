@@ -1,12 +1,77 @@
-import filecmp
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
+from itertools import zip_longest
+
+# "PC=XXXXXXXX [XXXXXXXX] xRD=XXXXXXXX xRS1=XXXXXXXX xRS2=XXXXXXXX", the
+# disassembly written without -s follows it and is not compared
+COMMIT_WIDTH = 61
+OPERANDS = ["rd", "rs1", "rs2"]
+
+
+def parse_line(line):
+    # returns pc, instruction word and [(register, value)] for rd, rs1 and rs2
+    fields = line.split()
+    registers = [tuple(field.split("=")) for field in fields[2:5]]
+    return fields[0][3:], fields[1][1:-1], registers
+
+
+def describe_divergence(index, line, spike_line):
+    if line is None or spike_line is None:
+        shorter = "simulator" if line is None else "spike"
+        return f"instruction {index}: {shorter} log ends here"
+    pc, inst, registers = parse_line(line)
+    spike_pc, spike_inst, spike_registers = parse_line(spike_line)
+    if pc != spike_pc or inst != spike_inst:
+        return f"instruction {index}: PC={pc} [{inst}] vs spike PC={spike_pc} [{spike_inst}]"
+    differences = [
+        f"{operand} {reg}={value} vs spike {spike_reg}={spike_value}"
+        for operand, (reg, value), (spike_reg, spike_value) in zip(
+            OPERANDS, registers, spike_registers
+        )
+        if (reg, value) != (spike_reg, spike_value)
+    ]
+    return f"instruction {index}: PC={pc} [{inst}] " + ", ".join(differences)
+
+
+def compare_file(log_file, spike_file):
+    # streams both logs and stops at the first divergent line,
+    # returns None when they match
+    with open(log_file) as log, open(spike_file) as spike:
+        for index, (line, spike_line) in enumerate(zip_longest(log, spike)):
+            if line is None or spike_line is None:
+                return describe_divergence(index, line, spike_line)
+            if line[:COMMIT_WIDTH] != spike_line[:COMMIT_WIDTH]:
+                return describe_divergence(index, line, spike_line)
+    return None
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of logs compared in parallel, 0 uses every core",
+        type=int,
+        default=0,
+    )
+
+    args = parser.parse_args()
     log_files = sorted(glob("test/*.log"))
-    log_files = [f.split("/")[-1] for f in log_files]
-    a = filecmp.cmpfiles("spike/outputs", "test", log_files)
-    print(f"Matching Logs: {len(a[0])}/{len(log_files)}")
-    if len(a[1]) != 0:
-        print(f"These files do not match: {a[1]}")
-    if len(a[2]) != 0:
-        print(f"These files do not have a corresponding pair: {a[2]}")
+    names = [f.split("/")[-1] for f in log_files]
+    missing = [name for name in names if not os.path.exists(f"spike/outputs/{name}")]
+    pairs = [
+        (f"test/{name}", f"spike/outputs/{name}") for name in names if name not in missing
+    ]
+    with ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+        results = list(executor.map(compare_file, *zip(*pairs))) if pairs else []
+    mismatched = [(name, result) for (name, _), result in zip(pairs, results) if result]
+    print(f"Matching Logs: {len(pairs) - len(mismatched)}/{len(log_files)}")
+    if len(mismatched) != 0:
+        print("These files do not match:")
+        for name, result in mismatched:
+            print(f"  {name.split('/')[-1]}: {result}")
+    if len(missing) != 0:
+        print(f"These files do not have a corresponding pair: {missing}")
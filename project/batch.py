@@ -0,0 +1,476 @@
+import numpy as np
+
+from components.decoder import Decoder
+from components.memory import PAGE_BITS, PAGE_MASK, PAGE_SIZE
+from utils.convert import MASK
+
+U32 = np.uint32
+
+
+class BatchSimulator:
+    # runs n instances of one program in lockstep, registers are an (n, 32)
+    # uint32 array, pcs an (n,) array and memory an (n, pages * PAGE_SIZE)
+    # byte array, a page is allocated for every instance at once
+    # each step runs the instruction at the lowest pc for all the instances
+    # there, the others wait so diverged control flow joins again
+    # handlers get (inst_fields, pc, rows, index): rows selects the
+    # instances in the registers (a slice when all of them run), index is
+    # the same as an array for the memory, control transfers return the
+    # next pc(s)
+
+    def __init__(self, pc, init_memory, n):
+        self.n = n
+        self.registers = np.zeros((n, 32), dtype=U32)
+        self.pcs = np.full(n, pc, dtype=U32)
+        self.ebreak = np.zeros(n, dtype=bool)
+        self.inst_counts = np.zeros(n, dtype=np.int64)
+        # page number -> page slot in memory, slot 0 stays zero and backs
+        # every page that was never written
+        self.page_table = np.zeros(1 << (32 - PAGE_BITS), dtype=np.int64)
+        self.page_count = 1
+        self._resize(16)
+        self.decoder = Decoder(self)
+        # decoded entries by pc and by instruction word, entry:
+        # (handler, fields, None, pc, instruction, name) like RISCVSimulator
+        self.decode_cache = {}
+        self.word_cache = {}
+        # once a store overwrote a decoded instruction, the instances may
+        # run different instructions at the same pc and every fetch checks
+        # the words of the whole group
+        self.code_written = False
+        for addr, content in init_memory:
+            self.load(addr, content)
+
+    def _resize(self, pages):
+        memory = np.zeros((self.n, pages * PAGE_SIZE), dtype=np.uint8)
+        # memory words (columns / 4) that were decoded as instructions
+        code_words = np.zeros(pages * PAGE_SIZE // 4, dtype=bool)
+        if self.page_count > 1:
+            memory[:, : self.page_count * PAGE_SIZE] = self.memory[:, : self.page_count * PAGE_SIZE]
+            code_words[: len(self.code_words)] = self.code_words
+        self.memory = memory
+        self.code_words = code_words
+        self.halves = memory.view("<u2")
+        self.words = memory.view("<u4")
+
+    def _columns(self, addr):
+        # memory columns of the addresses
+        return self.page_table[addr >> PAGE_BITS] * PAGE_SIZE + (addr & PAGE_MASK)
+
+    def _write_columns(self, addr):
+        # memory columns of the addresses, pages still backed by the zero
+        # slot are allocated first
+        slots = self.page_table[addr >> PAGE_BITS]
+        if not slots.all():
+            for page in np.unique(addr[slots == 0] >> PAGE_BITS):
+                if self.page_count * PAGE_SIZE == self.memory.shape[1]:
+                    self._resize(2 * self.page_count)
+                self.page_table[page] = self.page_count
+                self.page_count += 1
+            slots = self.page_table[addr >> PAGE_BITS]
+        return slots * PAGE_SIZE + (addr & PAGE_MASK)
+
+    def load(self, pos, content, instances=None):
+        # copies content to every instance, or to the ones in instances,
+        # per instance input data goes in this way before run
+        content = np.frombuffer(memoryview(content).cast("B"), dtype=np.uint8)
+        rows = slice(None) if instances is None else np.asarray(instances)
+        while len(content):
+            offset = pos & PAGE_MASK
+            size = min(PAGE_SIZE - offset, len(content))
+            column = int(self._write_columns(np.array([pos], dtype=U32))[0])
+            self.memory[rows, column : column + size] = content[:size]
+            pos += size
+            content = content[size:]
+
+    def read(self, instance, pos, size):
+        # bytes of one instance's memory
+        addr = (np.arange(size, dtype=np.int64) + pos).astype(U32)
+        return self.memory[instance, self._columns(addr)].tobytes()
+
+    def _read(self, index, addr, size):
+        if size > 1 and not (addr & U32(size - 1)).any():
+            # aligned accesses never cross a page
+            columns = self._columns(addr)
+            if size == 4:
+                return self.words[index, columns >> 2]
+            return self.halves[index, columns >> 1].astype(U32)
+        value = np.zeros(len(index), dtype=U32)
+        for k in range(size):
+            column = self._columns(addr + U32(k))
+            value |= self.memory[index, column].astype(U32) << U32(8 * k)
+        return value
+
+    def _write(self, index, addr, size, value):
+        if size > 1 and not (addr & U32(size - 1)).any():
+            columns = self._write_columns(addr)
+            if size == 4:
+                self.words[index, columns >> 2] = value
+            else:
+                self.halves[index, columns >> 1] = value & U32(0xFFFF)
+            if self.code_words[columns >> 2].any():
+                self.code_written = True
+            return
+        for k in range(size):
+            column = self._write_columns(addr + U32(k))
+            self.memory[index, column] = (value >> U32(8 * k)) & U32(0xFF)
+            if self.code_words[column >> 2].any():
+                self.code_written = True
+
+    def run(self):
+        # runs until every instance reached EBREAK, returns the instructions
+        # retired by all of them
+        n = self.n
+        everyone = np.arange(n)
+        start = int(self.inst_counts.sum())
+        index = None
+        try:
+            while True:
+                if index is None:
+                    active = everyone[~self.ebreak]
+                    if not len(active):
+                        break
+                    pcs = self.pcs[active]
+                    pc = int(pcs.min())
+                    at_pc = pcs == pc
+                    index = active[at_pc]
+                    rows = slice(None) if len(index) == n else index
+                    # lowest pc of the other instances, the group runs on its
+                    # own while it stays below it
+                    waiting = int(pcs[~at_pc].min()) if len(index) < len(active) else None
+                    steps = 0
+                groups = self._fetch(pc, index)
+                if len(groups) > 1:
+                    self._leave(rows, pc, steps)
+                    index = None
+                    self._run_groups(pc, groups)
+                    continue
+                entry = groups[0][0]
+                next_pc = entry[0](entry[1], pc, rows, index)
+                steps += 1
+                if next_pc is None:
+                    pc = (pc + 4) & MASK
+                elif isinstance(next_pc, int):
+                    pc = next_pc
+                else:
+                    # the branch or JALR split the group
+                    self.pcs[rows] = next_pc
+                    self.inst_counts[rows] += steps
+                    index = None
+                    continue
+                if entry[5] == "EBREAK" or (waiting is not None and pc >= waiting):
+                    self._leave(rows, pc, steps)
+                    index = None
+        finally:
+            # a fault leaves the group at the failing instruction
+            if index is not None:
+                self._leave(rows, pc, steps)
+        return int(self.inst_counts.sum()) - start
+
+    def _leave(self, rows, pc, steps):
+        # the pc and counts of a group are written when it stops running
+        # on its own
+        self.pcs[rows] = pc
+        self.inst_counts[rows] += steps
+
+    def _run_groups(self, pc, groups):
+        for entry, index in groups:
+            rows = slice(None) if len(index) == self.n else index
+            next_pc = entry[0](entry[1], pc, rows, index)
+            self.pcs[rows] = (pc + 4) & MASK if next_pc is None else next_pc
+            self.inst_counts[rows] += 1
+
+    def _fetch(self, pc, index):
+        # (entry, instances) pairs for the instances at pc, one pair unless
+        # code was overwritten differently in some of them
+        entry = self.decode_cache.get(pc)
+        if entry is None:
+            word = int(self._read(index[:1], np.array([pc], dtype=U32), 4)[0])
+            entry = self._decode(pc, word)
+            self.decode_cache[pc] = entry
+            column = int(self._columns(np.array([pc], dtype=U32))[0])
+            self.code_words[column >> 2] = True
+        if not self.code_written:
+            return [(entry, index)]
+        words = self._read(index, np.full(len(index), pc, dtype=U32), 4)
+        if (words == entry[4]).all():
+            return [(entry, index)]
+        return [
+            (self._decode(pc, int(word)), index[words == word]) for word in np.unique(words)
+        ]
+
+    def _decode(self, pc, word):
+        decoded = self.word_cache.get(word)
+        if decoded is None:
+            decoded = self.decoder.decode(word)
+            self.word_cache[word] = decoded
+        inst_metadata, inst_fields = decoded
+        return (inst_metadata[2], inst_fields, None, pc, word, inst_metadata[0])
+
+    def instance_registers(self, instance):
+        return [int(value) for value in self.registers[instance]]
+
+    # Operations, vectorized copies of the RISCVSimulator handlers
+    def _set(self, rows, rd, value):
+        if rd:
+            self.registers[rows, rd] = value
+
+    def _LUI(self, inst_fields, pc, rows, index):
+        self._set(rows, inst_fields["rd"], inst_fields["imm"] & MASK)
+
+    def _AUIPC(self, inst_fields, pc, rows, index):
+        self._set(rows, inst_fields["rd"], (inst_fields["imm"] + pc) & MASK)
+
+    def _JAL(self, inst_fields, pc, rows, index):
+        self._set(rows, inst_fields["rd"], (pc + 4) & MASK)
+        return (pc + inst_fields["imm"]) & MASK
+
+    def _JALR(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        next_pc = (regs[rows, inst_fields["rs1"]] + U32(inst_fields["imm"] & MASK)) & U32(0xFFFFFFFE)
+        self._set(rows, inst_fields["rd"], (pc + 4) & MASK)
+        return next_pc
+
+    def _branch(self, inst_fields, pc, taken):
+        # the group only splits when its instances disagree
+        target = (pc + inst_fields["imm"]) & MASK
+        if taken.all():
+            return target
+        if not taken.any():
+            return None
+        return np.where(taken, U32(target), U32((pc + 4) & MASK))
+
+    def _BEQ(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        taken = regs[rows, inst_fields["rs1"]] == regs[rows, inst_fields["rs2"]]
+        return self._branch(inst_fields, pc, taken)
+
+    def _BNE(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        taken = regs[rows, inst_fields["rs1"]] != regs[rows, inst_fields["rs2"]]
+        return self._branch(inst_fields, pc, taken)
+
+    def _BLT(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        rs1 = regs[rows, inst_fields["rs1"]].view(np.int32)
+        rs2 = regs[rows, inst_fields["rs2"]].view(np.int32)
+        return self._branch(inst_fields, pc, rs1 < rs2)
+
+    def _BGE(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        rs1 = regs[rows, inst_fields["rs1"]].view(np.int32)
+        rs2 = regs[rows, inst_fields["rs2"]].view(np.int32)
+        return self._branch(inst_fields, pc, rs1 >= rs2)
+
+    def _BLTU(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        taken = regs[rows, inst_fields["rs1"]] < regs[rows, inst_fields["rs2"]]
+        return self._branch(inst_fields, pc, taken)
+
+    def _BGEU(self, inst_fields, pc, rows, index):
+        regs = self.registers
+        taken = regs[rows, inst_fields["rs1"]] >= regs[rows, inst_fields["rs2"]]
+        return self._branch(inst_fields, pc, taken)
+
+    def _address(self, inst_fields, rows):
+        return self.registers[rows, inst_fields["rs1"]] + U32(inst_fields["imm"] & MASK)
+
+    def _LB(self, inst_fields, pc, rows, index):
+        value = self._read(index, self._address(inst_fields, rows), 1)
+        self._set(rows, inst_fields["rd"], (value ^ U32(0x80)) - U32(0x80))
+
+    def _LH(self, inst_fields, pc, rows, index):
+        value = self._read(index, self._address(inst_fields, rows), 2)
+        self._set(rows, inst_fields["rd"], (value ^ U32(0x8000)) - U32(0x8000))
+
+    def _LW(self, inst_fields, pc, rows, index):
+        value = self._read(index, self._address(inst_fields, rows), 4)
+        self._set(rows, inst_fields["rd"], value)
+
+    def _LBU(self, inst_fields, pc, rows, index):
+        value = self._read(index, self._address(inst_fields, rows), 1)
+        self._set(rows, inst_fields["rd"], value)
+
+    def _LHU(self, inst_fields, pc, rows, index):
+        value = self._read(index, self._address(inst_fields, rows), 2)
+        self._set(rows, inst_fields["rd"], value)
+
+    def _SB(self, inst_fields, pc, rows, index):
+        value = self.registers[rows, inst_fields["rs2"]]
+        self._write(index, self._address(inst_fields, rows), 1, value)
+
+    def _SH(self, inst_fields, pc, rows, index):
+        value = self.registers[rows, inst_fields["rs2"]]
+        self._write(index, self._address(inst_fields, rows), 2, value)
+
+    def _SW(self, inst_fields, pc, rows, index):
+        value = self.registers[rows, inst_fields["rs2"]]
+        self._write(index, self._address(inst_fields, rows), 4, value)
+
+    def _ADDI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 + U32(inst_fields["imm"] & MASK))
+
+    def _SLTI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]].view(np.int32)
+        self._set(rows, inst_fields["rd"], rs1 < np.int32(inst_fields["imm"]))
+
+    def _SLTIU(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 < U32(inst_fields["imm"] & MASK))
+
+    def _XORI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 ^ U32(inst_fields["imm"] & MASK))
+
+    def _ORI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 | U32(inst_fields["imm"] & MASK))
+
+    def _ANDI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 & U32(inst_fields["imm"] & MASK))
+
+    def _SLLI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 << U32(inst_fields["rs2"]))
+
+    def _SRLI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]]
+        self._set(rows, inst_fields["rd"], rs1 >> U32(inst_fields["rs2"]))
+
+    def _SRAI(self, inst_fields, pc, rows, index):
+        rs1 = self.registers[rows, inst_fields["rs1"]].view(np.int32)
+        self._set(rows, inst_fields["rd"], rs1 >> np.int32(inst_fields["rs2"]))
+
+    def _operands(self, inst_fields, rows):
+        regs = self.registers
+        return regs[rows, inst_fields["rs1"]], regs[rows, inst_fields["rs2"]]
+
+    def _ADD(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 + rs2)
+
+    def _SUB(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 - rs2)
+
+    def _SLT(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1.view(np.int32) < rs2.view(np.int32))
+
+    def _SLTU(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 < rs2)
+
+    def _SLL(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 << (rs2 & U32(0x1F)))
+
+    def _SRL(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 >> (rs2 & U32(0x1F)))
+
+    def _SRA(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1.view(np.int32) >> (rs2 & U32(0x1F)).view(np.int32))
+
+    def _XOR(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 ^ rs2)
+
+    def _OR(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 | rs2)
+
+    def _AND(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 & rs2)
+
+    def _FENCE(self, inst_fields, pc, rows, index):
+        pass
+
+    def _ECALL(self, inst_fields, pc, rows, index):
+        pass
+
+    def _EBREAK(self, inst_fields, pc, rows, index):
+        self.ebreak[rows] = True
+
+    # every instance is hart 0, mhartid is the only CSR
+    def _csr_access(self, inst_fields, rows, write):
+        csr = inst_fields["csr"]
+        if csr != 0xF14:
+            raise ValueError(f"unsupported CSR 0x{csr:03X}")
+        if write:
+            raise ValueError(f"write to read-only CSR 0x{csr:03X}")
+        self._set(rows, inst_fields["rd"], 0)
+
+    def _CSRRW(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, True)
+
+    def _CSRRS(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, inst_fields["rs1"] != 0)
+
+    def _CSRRC(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, inst_fields["rs1"] != 0)
+
+    def _CSRRWI(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, True)
+
+    def _CSRRSI(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, inst_fields["rs1"] != 0)
+
+    def _CSRRCI(self, inst_fields, pc, rows, index):
+        self._csr_access(inst_fields, rows, inst_fields["rs1"] != 0)
+
+    # the 64-bit products are exact in int64/uint64, the high word is
+    # truncated back to uint32
+    def _MUL(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], rs1 * rs2)
+
+    def _MULH(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        product = rs1.view(np.int32).astype(np.int64) * rs2.view(np.int32).astype(np.int64)
+        self._set(rows, inst_fields["rd"], (product >> 32).astype(U32))
+
+    def _MULHSU(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        product = rs1.view(np.int32).astype(np.int64) * rs2.astype(np.int64)
+        self._set(rows, inst_fields["rd"], (product >> 32).astype(U32))
+
+    def _MULHU(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        product = rs1.astype(np.uint64) * rs2.astype(np.uint64)
+        self._set(rows, inst_fields["rd"], (product >> np.uint64(32)).astype(U32))
+
+    # division by zero and the signed overflow are masked like div_signed
+    # and rem_signed, int64 holds the overflowing quotient 2**31
+    def _signed_division(self, inst_fields, rows):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        dividend = rs1.view(np.int32).astype(np.int64)
+        divisor = rs2.view(np.int32).astype(np.int64)
+        zero = divisor == 0
+        quotient = np.abs(dividend) // np.where(zero, 1, np.abs(divisor))
+        remainder = np.abs(dividend) - quotient * np.abs(divisor)
+        quotient = np.where((dividend < 0) != (divisor < 0), -quotient, quotient)
+        remainder = np.where(dividend < 0, -remainder, remainder)
+        return rs1, zero, quotient, remainder
+
+    def _DIV(self, inst_fields, pc, rows, index):
+        _, zero, quotient, _ = self._signed_division(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], np.where(zero, MASK, quotient & MASK).astype(U32))
+
+    def _DIVU(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        zero = rs2 == 0
+        self._set(rows, inst_fields["rd"], np.where(zero, U32(MASK), rs1 // np.where(zero, U32(1), rs2)))
+
+    def _REM(self, inst_fields, pc, rows, index):
+        rs1, zero, _, remainder = self._signed_division(inst_fields, rows)
+        self._set(rows, inst_fields["rd"], np.where(zero, rs1, (remainder & MASK).astype(U32)))
+
+    def _REMU(self, inst_fields, pc, rows, index):
+        rs1, rs2 = self._operands(inst_fields, rows)
+        zero = rs2 == 0
+        self._set(rows, inst_fields["rd"], np.where(zero, rs1, rs1 % np.where(zero, U32(1), rs2)))
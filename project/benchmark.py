@@ -0,0 +1,292 @@
+import argparse
+import json
+import os
+import platform
+import sys
+from glob import glob
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+
+from cli import get_program
+from components.decoder import Decoder
+from components.memory import Memory
+from utils import program_load
+from simulator import RISCVSimulator
+
+DATA_ADDR = 0x1000
+
+# handler: instruction fields, grouped by instruction class
+micro_handlers = {
+    "alu": {
+        "ADD": {"rd": 5, "rs1": 6, "rs2": 7},
+        "SUB": {"rd": 5, "rs1": 6, "rs2": 7},
+        "SLT": {"rd": 5, "rs1": 6, "rs2": 7},
+        "SRA": {"rd": 5, "rs1": 6, "rs2": 7},
+        "ADDI": {"rd": 5, "rs1": 6, "imm": -16},
+        "SLTIU": {"rd": 5, "rs1": 6, "imm": 16},
+        "SLLI": {"rd": 5, "rs1": 6, "rs2": 3},
+        "LUI": {"rd": 5, "imm": 0x12345000},
+    },
+    "load_store": {
+        "LW": {"rd": 5, "rs1": 6, "imm": 8},
+        "LH": {"rd": 5, "rs1": 6, "imm": 8},
+        "LBU": {"rd": 5, "rs1": 6, "imm": 8},
+        "SW": {"rs1": 6, "rs2": 7, "imm": 8},
+        "SB": {"rs1": 6, "rs2": 7, "imm": 8},
+    },
+    "branch": {
+        "BEQ": {"rs1": 6, "rs2": 7, "imm": 16},
+        "BNE": {"rs1": 6, "rs2": 7, "imm": 16},
+        "BLT": {"rs1": 6, "rs2": 7, "imm": 16},
+        "BGEU": {"rs1": 6, "rs2": 7, "imm": 16},
+        "JAL": {"rd": 1, "imm": 64},
+        "JALR": {"rd": 1, "rs1": 6, "imm": 4},
+    },
+    "m_extension": {
+        "MUL": {"rd": 5, "rs1": 6, "rs2": 7},
+        "MULH": {"rd": 5, "rs1": 6, "rs2": 7},
+        "MULHU": {"rd": 5, "rs1": 6, "rs2": 7},
+        "DIV": {"rd": 5, "rs1": 7, "rs2": 8},
+        "DIVU": {"rd": 5, "rs1": 7, "rs2": 8},
+        "REM": {"rd": 5, "rs1": 7, "rs2": 8},
+    },
+}
+
+# instruction words taken from the test traces
+decode_words = {
+    "ADDI": 0x01010413,
+    "ADD": 0x00B50533,
+    "LW": 0x00C12083,
+    "SW": 0x00112623,
+    "BNE": 0x00B51C63,
+    "JAL": 0x00C000EF,
+    "LUI": 0x00500137,
+    "MUL": 0x02B50533,
+    "SRAI": 0x41F65593,
+}
+
+
+def time_call(func, number, repeat):
+    # median seconds per call of func over repeat rounds of number calls
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        for _ in range(number):
+            func()
+        times.append((perf_counter() - start) / number)
+    return median(times)
+
+
+def micro_simulator():
+    sim = RISCVSimulator(0, [(DATA_ADDR, bytes(4096))], trace="off")
+    sim.registers[6] = DATA_ADDR
+    sim.registers[7] = 0x8765_4321
+    sim.registers[8] = 7
+    return sim
+
+
+def run_micro(args):
+    results = {}
+    sim = micro_simulator()
+    for group, handlers in micro_handlers.items():
+        for name, inst_fields in handlers.items():
+            handler = getattr(sim, f"_{name}")
+            results[f"micro/{group}/{name}"] = time_call(
+                lambda: handler(inst_fields), args.number, args.repeat
+            )
+            sim.next_pc = None
+
+    decoder = Decoder(sim)
+    for name, inst in decode_words.items():
+        results[f"micro/decode/{name}"] = time_call(
+            lambda: decoder.decode(inst), args.number, args.repeat
+        )
+
+    memory = Memory([(DATA_ADDR, bytes(4096))])
+    memory_calls = {
+        "get_word": lambda: memory.get_word(DATA_ADDR + 8),
+        "get_halfword": lambda: memory.get_halfword(DATA_ADDR + 8),
+        "get_byte": lambda: memory.get_byte(DATA_ADDR + 8),
+        "set_word": lambda: memory.set_word(DATA_ADDR + 8, 0x12345678),
+        "set_byte": lambda: memory.set_byte(DATA_ADDR + 8, 0x78),
+        "get_word_cross_page": lambda: memory.get_word(DATA_ADDR + 4094),
+    }
+    for name, call in memory_calls.items():
+        results[f"micro/memory/{name}"] = time_call(call, args.number, args.repeat)
+    return results
+
+
+def run_macro(args):
+    # execution time only, loading is left out and trace lines go to devnull
+    files = args.files
+    if files is None:
+        files = sorted(glob(args.path))
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for file in files:
+            program = get_program(str(file)[:-2], args.toolchain_prefix, compile=args.compile)
+            start_addr, mem_init = program_load.read_file(program)
+            for trace in args.trace:
+                times = []
+                for _ in range(args.repeat):
+                    risc_v = RISCVSimulator(
+                        start_addr, mem_init, trace=trace, trace_file=devnull, engine=args.engine
+                    )
+                    start = perf_counter()
+                    risc_v.run()
+                    times.append(perf_counter() - start)
+                results[f"macro/{Path(file).stem}/{args.engine}/{trace}"] = median(times)
+    return results
+
+
+def format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.1f} ns"
+
+
+def compare(results, baseline, threshold):
+    # prints every benchmark against the baseline, returns the regressed ones
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, seconds in results.items():
+        line = f"{name:<{width}} {format_time(seconds)}"
+        if name in baseline:
+            change = seconds / baseline[name] - 1
+            line = f"{line} {format_time(baseline[name])} {change:+8.1%}"
+            if change > threshold:
+                regressions.append(name)
+                line = f"{line} REGRESSION"
+        print(line)
+    return regressions
+
+
+def run_benchmarks(args):
+    results = {}
+    if not args.macro_only:
+        results.update(run_micro(args))
+    if not args.micro_only:
+        results.update(run_macro(args))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["benchmarks"]
+    regressions = compare(results, baseline, args.threshold)
+
+    if args.save:
+        # benchmarks not run this time keep their previous baseline
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "benchmarks": baseline,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+    if regressions:
+        print(f"{len(regressions)} benchmarks regressed more than {args.threshold:.0%}: {regressions}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-f",
+        "--files",
+        help="path to input files for the macro-benchmarks, if not set will run with all files at test/",
+        type=Path,
+        nargs="+",
+    )
+
+    parser.add_argument(
+        "-p", "--path", help="path for test folder", type=str, default="test/*.c"
+    )
+
+    parser.add_argument(
+        "-t",
+        "--toolchain-prefix",
+        help="RISC-V toolchain prefix",
+        type=str,
+        default="riscv32-unknown-elf",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--compile",
+        help="Compile C files to get simulators' input file",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="execution engine used by the macro-benchmarks",
+        choices=["interpreter", "translator"],
+        default="interpreter",
+    )
+
+    parser.add_argument(
+        "--trace",
+        help="trace levels the macro-benchmarks run with",
+        choices=["off", "commit", "full"],
+        nargs="+",
+        default=["off", "full"],
+    )
+
+    parser.add_argument(
+        "--micro-only", help="only run the micro-benchmarks", action="store_true"
+    )
+
+    parser.add_argument(
+        "--macro-only", help="only run the macro-benchmarks", action="store_true"
+    )
+
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        help="rounds of each benchmark, the median round is reported",
+        type=int,
+        default=5,
+    )
+
+    parser.add_argument(
+        "-n",
+        "--number",
+        help="calls per round of a micro-benchmark",
+        type=int,
+        default=20000,
+    )
+
+    parser.add_argument(
+        "-b",
+        "--baseline",
+        help="JSON file with the baseline timings",
+        type=str,
+        default="benchmarks.json",
+    )
+
+    parser.add_argument(
+        "--save",
+        help="write this run's timings to the baseline file",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--threshold",
+        help="relative slowdown over the baseline reported as a regression",
+        type=float,
+        default=0.1,
+    )
+
+    args = parser.parse_args()
+    sys.exit(run_benchmarks(args))
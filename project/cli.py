@@ -1,82 +1,475 @@
 import argparse
 import csv
+import hashlib
+import os
+import re
+import signal
 import subprocess
-from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from glob import glob
 from pathlib import Path
 from tqdm import tqdm
 from time import perf_counter
 
 
+from batch import BatchSimulator
+from components.cache import Cache, CacheHierarchy
+from components.devices import Clint, Uart
+from components.syscalls import SyscallEmulator
+from logger.pipeline import Pipeline
+from multihart import MultiHartSimulator
+from logger.profiler import Profiler
 from utils import program_load
 from simulator import RISCVSimulator
 
 
-def dump_to_hex(file, cmd_prefix, compile=False):
+COMPILE_FLAGS = [
+    "-g",
+    "-march=rv32im",
+    "-mabi=ilp32",
+    "-std=gnu99",
+    "-nostartfiles",
+    "-nostdinc",
+    "-nostdlib",
+    "-static",
+]
+INCLUDE = re.compile(rb'^\s*#\s*include\s*"([^"]+)"', re.MULTILINE)
+
+
+class CompileError(Exception):
+    pass
+
+
+def source_files(path, found=None):
+    # path and the local headers it includes, -nostdinc leaves only the
+    # "..." includes next to the including file
+    found = found if found is not None else []
+    found.append(path)
+    with open(path, "rb") as source:
+        text = source.read()
+    for header in INCLUDE.findall(text):
+        header_path = os.path.join(os.path.dirname(path), header.decode())
+        if os.path.exists(header_path) and header_path not in found:
+            source_files(header_path, found)
+    return found
+
+
+def build_key(file, cmd_prefix):
+    # hash of everything file.o is built from: sources, local headers,
+    # crt.S, toolchain and flags
+    base_path = "/".join(file.split("/")[:-1])
+    digest = hashlib.sha256()
+    digest.update("\0".join([cmd_prefix] + COMPILE_FLAGS).encode())
+    for path in source_files(f"{base_path}/crt.S") + source_files(f"{file}.c"):
+        with open(path, "rb") as source:
+            digest.update(path.encode() + b"\0" + source.read())
+    return digest.hexdigest()
+
+
+def compile_program(file, cmd_prefix):
+    # builds file.o, skipped when file.o.build holds the key of the current
+    # sources and the object it was written with, raises CompileError with
+    # the compiler output when the build fails
+    base_path = "/".join(file.split("/")[:-1])
+    program, stamp_path = f"{file}.o", f"{file}.o.build"
+    key = build_key(file, cmd_prefix)
+    if os.path.exists(program) and os.path.exists(stamp_path):
+        with open(stamp_path) as stamp:
+            if stamp.read() == f"{key} {os.stat(program).st_mtime_ns}":
+                return
+    result = subprocess.run(
+        [f"{cmd_prefix}-gcc"]
+        + COMPILE_FLAGS
+        + ["-o", program, f"{base_path}/crt.S", f"{file}.c"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if result.returncode != 0:
+        # never simulate the object of an older build
+        for path in (program, stamp_path):
+            if os.path.exists(path):
+                os.remove(path)
+        raise CompileError(result.stderr.decode(errors="replace").strip())
+    with open(f"{stamp_path}.tmp", "w") as stamp:
+        stamp.write(f"{key} {os.stat(program).st_mtime_ns}")
+    os.replace(f"{stamp_path}.tmp", stamp_path)
+
+
+def get_program(file, cmd_prefix, compile=False):
+    # returns the ELF file to simulate, loaded directly by program_load,
+    # the mapped ELF is the memory image, there is nothing else to parse
     if compile:
-        base_path = "/".join(file.split("/")[:-1])
-        subprocess.run(
-            [
-                f"{cmd_prefix}-gcc",
-                "-g",
-                "-march=rv32im",
-                "-mabi=ilp32",
-                "-std=gnu99",
-                "-nostartfiles",
-                "-nostdinc",
-                "-nostdlib",
-                "-static",
-                "-o",
-                f"{file}.o",
-                f"{base_path}/crt.S",
-                f"{file}.c",
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+        compile_program(file, cmd_prefix)
+        return f"{file}.o"
+    return f"{file}.riscv"  # assumes .riscv files are in the folder
+
+
+def simulate_file(file, args):
+    # compile (when asked), simulate and write the log of one test,
+    # returns its simulations.csv row
+    compile = (args.compile or args.spike) and args.restore is None
+    program = get_program(str(file)[:-2], args.toolchain_prefix, compile=compile)
+    if args.batch:
+        return simulate_batch(file, program, args)
+    if args.harts > 1:
+        return simulate_harts(file, program, args)
+    trace_file = None
+    syscalls = None
+    devices = []
+    hash_file = None
+    if args.trace != "off":
+        trace_file = open_trace(str(file)[:-2], args)
+    try:
+        if args.hash_every:
+            hash_file = open(f"{str(file)[:-2]}.hash", "w")
+        if args.syscalls:
+            syscalls = open_syscalls(str(file)[:-2], program, args)
+        if args.devices:
+            devices = open_devices(str(file)[:-2], args)
+        start = perf_counter()
+        options = dict(
+            trace=args.trace,
+            trace_file=trace_file,
+            engine=args.engine,
+            checkpoint_every=args.checkpoint_every,
+            checkpoint_file=f"{str(file)[:-2]}.{{count}}.ckpt",
+            profile=args.profile,
+            cache=CacheHierarchy(args.cache_config) if args.cache else None,
+            pipeline=args.pipeline,
+            syscalls=syscalls,
+            trace_format=args.trace_format,
+            trace_memory=args.trace_memory,
+            trace_compress=args.trace_compress,
+            devices=devices,
+            hash_every=args.hash_every,
+            hash_file=hash_file,
         )
-        subprocess.run(
-            [
-                f"{cmd_prefix}-objcopy",
-                "-I",
-                "elf32-littleriscv",
-                "-O",
-                "ihex",
-                f"{file}.o",
-                f"{file}.hex",
-            ]
+        if args.restore is not None:
+            risc_v = RISCVSimulator.from_checkpoint(args.restore, **options)
+        else:
+            start_addr, mem_init = program_load.read_file(program)
+            risc_v = RISCVSimulator(start_addr, mem_init, **options)
+        load = perf_counter() - start
+        first = risc_v.inst_count
+        if fast_forwards(args):
+            start_pc = None
+            if args.start_at is not None:
+                start_pc = resolve_address(args.start_at, program)
+            risc_v.fast_forward(pc=start_pc, count=args.start_count)
+        window_start = risc_v.inst_count
+        risc_v.run(args.max_instructions)
+        inst_count = risc_v.inst_count - first
+        total = perf_counter() - start
+    finally:
+        if trace_file is not None:
+            trace_file.close()
+        if syscalls is not None:
+            close_syscalls(syscalls)
+        close_devices(devices)
+        if hash_file is not None:
+            hash_file.close()
+    row = [file, inst_count]
+    if fast_forwards(args):
+        # inst_count includes the untraced prologue, the trace, cache and
+        # pipeline columns only cover the window after it
+        row.append(risc_v.inst_count - window_start)
+    if args.cache:
+        row += list(risc_v.cache.columns().values())
+    if args.pipeline:
+        row += list(risc_v.pipeline.columns().values())
+    row += [load, total-load, total, inst_count/(total-load)]
+    if args.max_instructions is not None:
+        # False when the budget stopped the test before its EBREAK
+        row.append(risc_v.ebreak)
+    if args.syscalls:
+        row.append(syscalls.exit_code)
+    if args.profile:
+        row += write_profile(risc_v, str(file)[:-2], program)
+    return row
+
+
+def fast_forwards(args):
+    return args.start_at is not None or args.start_count is not None
+
+
+def simulate_batch(file, program, args):
+    # runs args.batch instances of one test in lockstep, writes their
+    # results to test.batch.csv and returns the row with the instructions
+    # retired by all of them
+    start = perf_counter()
+    start_addr, mem_init = program_load.read_file(program)
+    batch = BatchSimulator(start_addr, mem_init, args.batch)
+    if args.batch_input is not None:
+        symbol, path = args.batch_input
+        addr, size = program_load.read_symbols(program).get(symbol, (None, 0))
+        if addr is None:
+            raise ValueError(f"{program} has no symbol {symbol}")
+        with open(path, "rb") as input_file:
+            data = input_file.read()
+        # one equal chunk of the input file per instance
+        chunk = len(data) // args.batch
+        if size and chunk > size:
+            raise ValueError(f"{path}: {chunk} bytes per instance do not fit in {symbol} ({size} bytes)")
+        for i in range(args.batch):
+            batch.load(addr, data[i * chunk : (i + 1) * chunk], [i])
+    load = perf_counter() - start
+    inst_count = batch.run()
+    total = perf_counter() - start
+    with open(f"{str(file)[:-2]}.batch.csv", "w") as csvfile:
+        csvwriter = csv.writer(csvfile, delimiter=';')
+        csvwriter.writerow(["instance", "inst_count", "ebreak", "a0"])
+        for i in range(args.batch):
+            csvwriter.writerow(
+                [i, int(batch.inst_counts[i]), bool(batch.ebreak[i]), int(batch.registers[i, 10])]
+            )
+    return [file, inst_count, load, total-load, total, inst_count/(total-load)]
+
+
+def simulate_harts(file, program, args):
+    # runs args.harts harts sharing the memory of one test, hart i logs to
+    # test.hart<i>.log, returns the row with the instructions of all of them
+    trace_files = []
+    syscalls = None
+    devices = []
+    try:
+        if args.trace != "off":
+            for hartid in range(args.harts):
+                trace_files.append(open_trace(f"{str(file)[:-2]}.hart{hartid}", args))
+        if args.syscalls:
+            # one emulator for every hart, they share the output and heap
+            syscalls = open_syscalls(str(file)[:-2], program, args)
+        if args.devices:
+            devices = open_devices(str(file)[:-2], args)
+        start = perf_counter()
+        start_addr, mem_init = program_load.read_file(program)
+        risc_v = MultiHartSimulator(
+            start_addr,
+            mem_init,
+            harts=args.harts,
+            quantum=args.quantum,
+            processes=args.hart_processes,
+            hart_options=[dict(trace_file=trace_file) for trace_file in trace_files] or None,
+            trace=args.trace,
+            engine=args.engine,
+            syscalls=syscalls,
+            trace_format=args.trace_format,
+            trace_memory=args.trace_memory,
+            trace_compress=args.trace_compress,
+            devices=devices,
         )
-    else: # assumes .riscv files are in the folder
-        subprocess.run(
-            [
-                f"{cmd_prefix}-objcopy",
-                "-I",
-                "elf32-littleriscv",
-                "-O",
-                "ihex",
-                f"{file}.riscv",
-                f"{file}.hex",
-            ]
+        load = perf_counter() - start
+        inst_count = risc_v.run(args.max_instructions)
+        total = perf_counter() - start
+    finally:
+        for trace_file in trace_files:
+            trace_file.close()
+        if syscalls is not None:
+            close_syscalls(syscalls)
+        close_devices(devices)
+    row = [file, inst_count, load, total-load, total, inst_count/(total-load)]
+    if args.max_instructions is not None:
+        row.append(risc_v.ebreak)
+    if args.syscalls:
+        row.append(syscalls.exit_code)
+    return row
+
+
+def open_trace(file_base, args):
+    # test.log, or test.trace with --trace-format binary
+    if args.trace_format == "binary":
+        return open(f"{file_base}.trace", "wb")
+    return open(f"{file_base}.log", "w")
+
+
+def read_stdin(args):
+    if args.stdin is None:
+        return b""
+    with open(args.stdin, "rb") as stdin_file:
+        return stdin_file.read()
+
+
+def open_syscalls(file_base, program, args):
+    # guest stdout and stderr go to test.stdout and test.stderr, stdin
+    # comes from the --stdin file, the heap starts after the .bss of
+    # program, a restored run takes its break from the checkpoint
+    image_end = None
+    if args.restore is None:
+        image_end = program_load.read_image_end(program)
+    return SyscallEmulator(
+        stdout=open(f"{file_base}.stdout", "wb"),
+        stderr=open(f"{file_base}.stderr", "wb"),
+        stdin=read_stdin(args),
+        image_end=image_end,
+    )
+
+
+def close_syscalls(syscalls):
+    syscalls.flush()
+    for output in syscalls.outputs.values():
+        output.close()
+
+
+def open_devices(file_base, args):
+    # the UART writes test.uart and receives the --stdin file
+    return [Uart(open(f"{file_base}.uart", "wb"), input=read_stdin(args)), Clint()]
+
+
+def close_devices(devices):
+    for device in devices:
+        device.flush()
+        if isinstance(device, Uart):
+            device.output.close()
+
+
+def parse_batch_input(value):
+    # SYMBOL=FILE
+    symbol, _, path = value.partition("=")
+    if not symbol or not path:
+        raise argparse.ArgumentTypeError(f"{value}: expected SYMBOL=FILE")
+    return symbol, path
+
+
+def parse_cache_spec(value):
+    # SIZE:WAYS:LINE[:POLICY[:WRITE[:LATENCY]]], e.g. 16k:4:32:plru:wt:2
+    fields = value.split(":")
+    if not 3 <= len(fields) <= 6:
+        raise argparse.ArgumentTypeError(
+            f"{value}: expected SIZE:WAYS:LINE[:POLICY[:WRITE[:LATENCY]]]"
         )
+    size = fields[0].lower()
+    scale = 1
+    if size.endswith("k"):
+        size, scale = size[:-1], 1024
+    elif size.endswith("m"):
+        size, scale = size[:-1], 1024 * 1024
+    try:
+        spec = {
+            "size": int(size) * scale,
+            "ways": int(fields[1]),
+            "line_size": int(fields[2]),
+        }
+        if len(fields) > 5:
+            spec["hit_time"] = int(fields[5])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value}: size, ways, line and latency are numbers")
+    if len(fields) > 3:
+        if fields[3] not in Cache.policies:
+            raise argparse.ArgumentTypeError(f"{value}: policy is one of {Cache.policies}")
+        spec["policy"] = fields[3]
+    if len(fields) > 4:
+        if fields[4] not in ("wb", "wt"):
+            raise argparse.ArgumentTypeError(f"{value}: write policy is wb or wt")
+        spec["write_back"] = fields[4] == "wb"
+    return spec
+
+
+def resolve_address(value, program):
+    # a number (0x prefix for hex) or a symbol of the program's ELF file
+    try:
+        return int(value, 0)
+    except ValueError:
+        symbols = program_load.read_symbols(program)
+        if value not in symbols:
+            raise ValueError(f"{program} has no symbol {value}")
+        return symbols[value][0]
+
+
+def write_profile(risc_v, file_base, program):
+    # writes the hot-spot report of one test, returns its instruction mix
+    symbols = None
+    if os.path.exists(program):
+        try:
+            symbols = program_load.read_symbols(program)
+        except ValueError:
+            pass  # Intel HEX image, no symbol table
+    with open(f"{file_base}.prof", "w") as report:
+        risc_v.profiler.report(report, risc_v.mnemonic, symbols)
+    return list(risc_v.profiler.instruction_mix(risc_v.mnemonic).values())
+
+
+def raise_timeout(signum, frame):
+    raise TimeoutError("test did not finish in time")
+
+
+def run_file(file, args):
+    # a failing or hung test is reported instead of stopping the whole run,
+    # returns (row, error)
+    if args.timeout:
+        signal.signal(signal.SIGALRM, raise_timeout)
+        signal.alarm(args.timeout)
+    try:
+        return simulate_file(file, args), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    finally:
+        if args.timeout:
+            signal.alarm(0)
+
+
+def run_isolated(file, args):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        try:
+            return executor.submit(run_file, file, args).result()
+        except BrokenProcessPool:
+            return None, "worker process crashed"
+
+
+def iter_results(files, args):
+    # yields (row, error) for each file in order, tests run on args.jobs processes
+    if args.jobs == 1:
+        for file in files:
+            yield run_file(file, args)
+        return
+    pending = list(files)
+    while pending:
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [executor.submit(run_file, file, args) for file in pending]
+            for i, future in enumerate(futures):
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    # a crash takes the whole pool down, this test is run
+                    # alone to tell whether it is the one crashing and the
+                    # rest goes to a new pool
+                    yield run_isolated(pending[i], args)
+                    pending = pending[i + 1 :]
+                    break
+            else:
+                pending = []
 
 
 def run_simulations(args):
     files = args.files
     if args.files == None:
         files = sorted(glob(args.path))
+    failed = []
+    header = ["file", "inst_count"]
+    if fast_forwards(args):
+        header.append("window_inst_count")
+    if args.cache:
+        header += list(CacheHierarchy(args.cache_config).columns())
+    if args.pipeline:
+        header += list(Pipeline().columns())
+    header += ["load_time", "exec_time", "total_time", "inst/s"]
+    if args.max_instructions is not None:
+        header.append("finished")
+    if args.syscalls:
+        header.append("exit_code")
+    if args.profile:
+        header += Profiler.mix_columns
     with open("simulations.csv", "w") as csvfile:
         csvwriter = csv.writer(csvfile, delimiter=';')
-        csvwriter.writerow(["file", "inst_count", "load_time", "exec_time", "total_time", "inst/s"])
-        for file in tqdm(files):
-            dump_to_hex(str(file)[:-2], args.toolchain_prefix, compile=args.compile or args.spike)
-            start = perf_counter()
-            start_addr, mem_init = program_load.read_file(f"{str(file)[:-2]}.hex")
-            risc_v = RISCVSimulator(start_addr, mem_init, disassembly=not args.spike)
-            load = perf_counter() - start
-            with open(f"{str(file)[:-2]}.log", "w") as f:
-                with redirect_stdout(f):
-                    inst_count = risc_v.run()
-            total = perf_counter() - start
-            csvwriter.writerow([file, inst_count, load, total-load, total, inst_count/(total-load)])
+        csvwriter.writerow(header)
+        for file, (row, error) in zip(files, tqdm(iter_results(files, args), total=len(files))):
+            if error is not None:
+                tqdm.write(f"{file}: {error}")
+                failed.append(file)
+                row = [file] + [""] * (len(header) - 1)
+            csvwriter.writerow(row)
+            csvfile.flush()
+    if failed:
+        print(f"{len(failed)}/{len(files)} tests failed: {[str(file) for file in failed]}")
     return
 
 
@@ -106,7 +499,7 @@ if __name__ == "__main__":
     parser.add_argument(
         "-c",
         "--compile",
-        help="Compile C files and perform objcopy to get simulators' input file",
+        help="Compile C files to get simulators' input file",
         action="store_true",
     )
 
@@ -117,5 +510,252 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    parser.add_argument(
+        "--trace",
+        help="trace level: off (statistics only), commit (pc, instruction and registers) or full (commit plus disassembly), -s defaults to commit",
+        choices=["off", "commit", "full"],
+        default=None,
+    )
+
+    parser.add_argument(
+        "--trace-format",
+        help="text log (test.log) or binary trace (test.trace, see project/trace_to_text.py), the binary trace keeps the commit fields",
+        choices=["text", "binary"],
+        default="text",
+    )
+
+    parser.add_argument(
+        "--trace-memory",
+        help="add the address and value of loads and stores to the binary trace",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--trace-compress",
+        help="compress the chunks of the binary trace with zlib",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="execution engine: interpreter or translator (hot basic blocks compiled to Python functions)",
+        choices=["interpreter", "translator"],
+        default="interpreter",
+    )
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of tests simulated in parallel, 0 uses every core",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--timeout",
+        help="seconds a single test may take before it is reported as hung, 0 disables it",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--checkpoint-every",
+        help="write a checkpoint (test.<count>.ckpt) every N retired instructions, 0 disables it",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--restore",
+        help="resume the test given with -f from this checkpoint instead of its entry point",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--profile",
+        help="count executions per PC, write a hot-spot report (test.prof) and add the instruction mix to simulations.csv",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--start-at",
+        help="run untraced until this PC or symbol (e.g. 0x10094 or main) is reached, then trace",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--start-count",
+        help="run untraced for this many instructions, then trace",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-instructions",
+        help="stop a test once this many instructions retired, its row gets finished=False",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--cache",
+        help="time fetches and data accesses with split L1 caches (16k:4:32 LRU write-back) and add cycles, CPI and miss rates to simulations.csv",
+        action="store_true",
+    )
+
+    for level in ("l1i", "l1d", "l2"):
+        parser.add_argument(
+            f"--{level}",
+            help=f"{level} cache as SIZE:WAYS:LINE[:POLICY[:WRITE[:LATENCY]]] (e.g. 32k:8:64:plru:wt:2), implies --cache",
+            type=parse_cache_spec,
+            default=None,
+        )
+
+    parser.add_argument(
+        "--pipeline",
+        help="time the retired instructions on an in-order 5-stage pipeline and add its cycles, CPI and stalls by cause to simulations.csv",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--batch",
+        help="run N instances of each test in lockstep on NumPy arrays, simulations.csv gets the instructions of all of them and test.batch.csv the result of each one",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--batch-input",
+        help="SYMBOL=FILE, split FILE in --batch equal chunks and load one at SYMBOL of each instance",
+        type=parse_batch_input,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--harts",
+        help="number of harts sharing the memory of each test, hart i reads i from mhartid and logs to test.hart<i>.log",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--quantum",
+        help="instructions each hart runs before the next one in the round-robin schedule of --harts",
+        type=int,
+        default=1000,
+    )
+
+    parser.add_argument(
+        "--hart-processes",
+        help="run the --harts in this many processes over shared memory, faster but not deterministic and untraced",
+        type=int,
+        default=1,
+    )
+
+    parser.add_argument(
+        "--syscalls",
+        help="serve ECALLs as proxy-kernel system calls (write, read, exit, brk, fstat, close, time), guest output goes to test.stdout/test.stderr and the exit status to simulations.csv",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--stdin",
+        help="file read by the guest from stdin with --syscalls and from the UART with --devices",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--hash-every",
+        help="write a hash of pc, registers and memory to test.hash every N retired instructions, compared by hash_bisect.py, 0 disables it",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--devices",
+        help="map a 16550-style UART at 0x10000000, whose output goes to test.uart, and a CLINT timer at 0x2000000",
+        action="store_true",
+    )
+
     args = parser.parse_args()
+    if args.restore is not None and (args.files is None or len(args.files) != 1):
+        parser.error("--restore needs exactly one test given with -f")
+    if args.jobs == 0:
+        args.jobs = os.cpu_count()
+    if args.hash_every < 0:
+        parser.error("--hash-every needs a positive number of instructions")
+    if args.batch < 0:
+        parser.error("--batch needs a positive number of instances")
+    if args.batch:
+        batch_conflicts = [
+            option
+            for option, value in (
+                ("--trace", args.trace not in (None, "off")),
+                ("--restore", args.restore is not None),
+                ("--checkpoint-every", args.checkpoint_every),
+                ("--profile", args.profile),
+                ("--start-at", args.start_at is not None),
+                ("--start-count", args.start_count is not None),
+                ("--max-instructions", args.max_instructions is not None),
+                ("--cache", args.cache or any(getattr(args, level) for level in ("l1i", "l1d", "l2"))),
+                ("--pipeline", args.pipeline),
+                ("--syscalls", args.syscalls),
+                ("--devices", args.devices),
+                ("--hash-every", args.hash_every),
+            )
+            if value
+        ]
+        if batch_conflicts:
+            parser.error(f"--batch cannot be used with {', '.join(batch_conflicts)}")
+        args.trace = "off"
+    elif args.batch_input is not None:
+        parser.error("--batch-input needs --batch")
+    if (args.trace_memory or args.trace_compress) and args.trace_format != "binary":
+        parser.error("--trace-memory and --trace-compress need --trace-format binary")
+    if args.stdin is not None and not (args.syscalls or args.devices):
+        parser.error("--stdin needs --syscalls or --devices")
+    if args.harts < 1 or args.quantum < 1 or args.hart_processes < 1:
+        parser.error("--harts, --quantum and --hart-processes must be positive")
+    if args.harts > 1:
+        hart_conflicts = [
+            option
+            for option, value in (
+                ("--batch", args.batch),
+                ("--restore", args.restore is not None),
+                ("--checkpoint-every", args.checkpoint_every),
+                ("--hash-every", args.hash_every),
+                ("--profile", args.profile),
+                ("--start-at", args.start_at is not None),
+                ("--start-count", args.start_count is not None),
+                ("--cache", args.cache or any(getattr(args, level) for level in ("l1i", "l1d", "l2"))),
+                ("--pipeline", args.pipeline),
+            )
+            if value
+        ]
+        if hart_conflicts:
+            parser.error(f"--harts cannot be used with {', '.join(hart_conflicts)}")
+        if args.hart_processes > 1:
+            if (
+                args.trace not in (None, "off")
+                or args.max_instructions is not None
+                or args.syscalls
+                or args.devices
+            ):
+                parser.error("--hart-processes runs without --trace, --max-instructions, --syscalls and --devices")
+            args.trace = "off"
+    if args.trace is None:
+        args.trace = "commit" if args.spike else "full"
+    args.cache_config = {
+        level: getattr(args, level) or CacheHierarchy.default_config[level]
+        for level in ("l1i", "l1d", "l2")
+    }
+    args.cache = args.cache or any(getattr(args, level) for level in ("l1i", "l1d", "l2"))
+    try:
+        CacheHierarchy(args.cache_config)
+    except ValueError as e:
+        parser.error(str(e))
     run_simulations(args)
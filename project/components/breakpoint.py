@@ -0,0 +1,5 @@
+class BreakpointHit(Exception):
+    # raised when execution reaches a PC in RISCVSimulator.breakpoints, before
+    # the instruction there runs, retired counts the instructions a partly
+    # run block retired before it
+    retired = 0
@@ -0,0 +1,247 @@
+from components.memory import Memory
+
+
+class Cache:
+    # set associative cache timing model, tags, dirty bits and replacement
+    # state are flat lists indexed by set * ways + way (a slot), data stays
+    # in Memory
+    policies = ["lru", "plru"]
+
+    def __init__(
+        self,
+        name,
+        size,
+        ways,
+        line_size,
+        policy="lru",
+        write_back=True,
+        hit_time=1,
+        next_level=None,
+        memory_time=10,
+    ):
+        if policy not in self.policies:
+            raise ValueError(f"unknown replacement policy {policy}, use one of {self.policies}")
+        sets = size // (ways * line_size)
+        if sets < 1 or sets & (sets - 1) or line_size & (line_size - 1):
+            raise ValueError(f"{name}: sets and line size must be powers of two")
+        if policy == "plru" and ways & (ways - 1):
+            raise ValueError(f"{name}: pseudo-LRU needs a power of two ways")
+        self.name = name
+        self.ways = ways
+        self.line_bits = line_size.bit_length() - 1
+        self.set_mask = sets - 1
+        self.policy = policy
+        # write-back caches allocate on write misses, write-through ones
+        # send every write to the next level and do not allocate
+        self.write_back = write_back
+        self.hit_time = hit_time
+        self.next_level = next_level
+        self.memory_time = memory_time
+        self.tags = [-1] * (sets * ways)
+        # line -> index in tags of the lines held, for the hit lookup
+        self.slots = {}
+        self.dirty = [False] * (sets * ways)
+        # lru: last use stamp per line, plru: ways - 1 tree bits per set
+        self.lru = policy == "lru"
+        self.stamps = [0] * (sets * ways)
+        self.tree = [0] * (sets * max(ways - 1, 1))
+        self.clock = 0
+        # most recently used line of each set, using it again leaves the
+        # replacement state as it is so those hits skip the lookup
+        self.mru = [-1] * sets
+        self.hits = 0
+        self.misses = 0
+        self.writebacks = 0
+        # accesses that went to memory because there is no next level
+        self.memory_accesses = 0
+
+    def access(self, addr, write=False):
+        line = addr >> self.line_bits
+        if self.mru[line & self.set_mask] == line and (not write or self.write_back):
+            self.hits += 1
+            if write:
+                self.dirty[self.slots[line]] = True
+            return self.hit_time
+        return self.access_line(line, write)
+
+    def access_line(self, line, write=False):
+        # returns the cycles taken by the access, misses include the next
+        # level (or memory) cycles
+        if not write and self.mru[line & self.set_mask] == line:
+            self.hits += 1
+            return self.hit_time
+        slot = self.slots.get(line)
+        if slot is not None:
+            self.hits += 1
+            if self.lru:
+                self.clock += 1
+                self.stamps[slot] = self.clock
+            else:
+                self._touch_tree(slot)
+            self.mru[line & self.set_mask] = line
+            if write:
+                if self.write_back:
+                    self.dirty[slot] = True
+                else:
+                    return self.hit_time + self._next(line, True)
+            return self.hit_time
+        self.misses += 1
+        if write and not self.write_back:
+            return self.hit_time + self._next(line, True)
+        slot = self._victim((line & self.set_mask) * self.ways)
+        cycles = self.hit_time
+        old = self.tags[slot]
+        if old >= 0:
+            del self.slots[old]
+            if self.dirty[slot]:
+                self.writebacks += 1
+                cycles += self._next(old, True)
+        cycles += self._next(line, False)
+        self.tags[slot] = line
+        self.slots[line] = slot
+        self.dirty[slot] = write
+        if self.lru:
+            self.clock += 1
+            self.stamps[slot] = self.clock
+        else:
+            self._touch_tree(slot)
+        self.mru[line & self.set_mask] = line
+        return cycles
+
+    def _next(self, line, write):
+        if self.next_level is None:
+            self.memory_accesses += 1
+            return self.memory_time
+        return self.next_level.access(line << self.line_bits, write)
+
+    def _touch_tree(self, slot):
+        # pseudo-LRU, tree bits point to the half that was used less recently
+        ways = self.ways
+        tree = self.tree
+        node = 0
+        offset = slot // ways * (ways - 1)
+        way = slot % ways
+        half = ways >> 1
+        while half:
+            right = way & half
+            tree[offset + node] = 0 if right else 1
+            node = 2 * node + (2 if right else 1)
+            half >>= 1
+
+    def _victim(self, base):
+        # returns the index in tags of the line to replace in the set
+        # starting at base
+        ways = self.ways
+        if self.lru:
+            # never used ways have stamp 0 and are taken first
+            stamps = self.stamps[base : base + ways]
+            return base + stamps.index(min(stamps))
+        tree = self.tree
+        node = 0
+        offset = base // ways * (ways - 1)
+        way = 0
+        half = ways >> 1
+        while half:
+            if tree[offset + node]:
+                way |= half
+                node = 2 * node + 2
+            else:
+                node = 2 * node + 1
+            half >>= 1
+        return base + way
+
+    def accesses(self):
+        return self.hits + self.misses
+
+    def cycles(self):
+        # every access pays hit_time at this level, the ones sent on are
+        # counted by the next level or as memory accesses
+        return self.accesses() * self.hit_time + self.memory_accesses * self.memory_time
+
+    def miss_rate(self):
+        return self.misses / self.accesses() if self.accesses() else 0.0
+
+
+class CacheHierarchy:
+    # split L1 instruction/data caches with an optional unified L2, every
+    # fetch is one L1I access so cycles and instructions come from the
+    # access counts of each level
+    # config: {"l1i": spec, "l1d": spec, "l2": spec or None}, spec is
+    # {"size", "ways", "line_size", "policy", "write_back", "hit_time"}
+    default_config = {
+        "l1i": {"size": 16384, "ways": 4, "line_size": 32},
+        "l1d": {"size": 16384, "ways": 4, "line_size": 32},
+        "l2": None,
+    }
+
+    def __init__(self, config=None, memory_time=10):
+        config = config or self.default_config
+        self.l2 = None
+        if config.get("l2"):
+            self.l2 = Cache("l2", memory_time=memory_time, **{"hit_time": 8, **config["l2"]})
+        self.l1i = Cache("l1i", next_level=self.l2, memory_time=memory_time, **config["l1i"])
+        self.l1d = Cache("l1d", next_level=self.l2, memory_time=memory_time, **config["l1d"])
+        self.caches = [cache for cache in (self.l1i, self.l1d, self.l2) if cache is not None]
+        # fetch(line) for an instruction from another line than the previous
+        # one, data_access(addr, write) for loads and stores
+        self.fetch = self.l1i.access_line
+        self.data_access = self.l1d.access
+
+    def fetch_repeat(self, count):
+        # fetches from the line fetched last, they hit it
+        self.l1i.hits += count
+
+    def cycles(self):
+        return sum(cache.cycles() for cache in self.caches)
+
+    def instructions(self):
+        return self.l1i.accesses()
+
+    def reset_stats(self):
+        for cache in self.caches:
+            cache.hits = cache.misses = cache.writebacks = cache.memory_accesses = 0
+
+    def columns(self):
+        # simulations.csv columns, cycles per instruction and per cache
+        # misses and miss rate
+        cycles = self.cycles()
+        instructions = self.instructions()
+        columns = {
+            "cycles": cycles,
+            "CPI": cycles / instructions if instructions else 0.0,
+        }
+        for cache in self.caches:
+            columns[f"{cache.name}_misses"] = cache.misses
+            columns[f"{cache.name}_miss_rate"] = cache.miss_rate()
+        return columns
+
+
+class CachedMemory(Memory):
+    # Memory whose data accesses go through a cache hierarchy, get_*/set_*
+    # return the hierarchy's latency as access time
+
+    def __init__(self, init_mem=(), hierarchy=None, access_time=10, devices=()):
+        super().__init__(init_mem, access_time, devices)
+        self.hierarchy = hierarchy
+        self.data_access = hierarchy.data_access
+
+    def get_word(self, pos):
+        return Memory.get_word(self, pos)[0], self.data_access(pos, False)
+
+    def get_halfword(self, pos):
+        return Memory.get_halfword(self, pos)[0], self.data_access(pos, False)
+
+    def get_byte(self, pos):
+        return Memory.get_byte(self, pos)[0], self.data_access(pos, False)
+
+    def set_word(self, pos, value):
+        Memory.set_word(self, pos, value)
+        return self.data_access(pos, True)
+
+    def set_halfword(self, pos, value):
+        Memory.set_halfword(self, pos, value)
+        return self.data_access(pos, True)
+
+    def set_byte(self, pos, value):
+        Memory.set_byte(self, pos, value)
+        return self.data_access(pos, True)
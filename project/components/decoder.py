@@ -1,4 +1,4 @@
-from utils.convert import bin_to_int
+from utils.convert import MASK
 
 
 class Decoder:
@@ -81,67 +81,208 @@ class Decoder:
         },
         "0001111": ("FENCE", "I"),
         "1110011": {
-            "000000000000": ("ECALL", "I"),
-            "000000000001": ("EBREAK", "I"),
+            "000": {
+                "000000000000": ("ECALL", "I"),
+                "000000000001": ("EBREAK", "I"),
+            },
+            # Zicsr, the immediate forms take uimm in the rs1 field
+            "001": ("CSRRW", "CSR"),
+            "010": ("CSRRS", "CSR"),
+            "011": ("CSRRC", "CSR"),
+            "101": ("CSRRWI", "CSR"),
+            "110": ("CSRRSI", "CSR"),
+            "111": ("CSRRCI", "CSR"),
         },
     }
 
-    def decode(self, inst):
-        code = inst[25:]
-        inst_dict = self.op_codes
-        if code == "1110011":
-            inst_metadata = inst_dict[code][inst[:12]]
-        else:
-            for start, end in [(25, 32), (17, 20), (0, 7)]:
-                key = inst[start:end]
-                if isinstance(inst_dict[key], tuple):
-                    inst_metadata = inst_dict[key]
-                    break
-                inst_dict = inst_dict[key]
+    # pairs of instructions RISCVSimulator's interpreter loop runs as one
+    # fused operation (see fuse): first instruction -> second instructions
+    fusion_pairs = {
+        "LUI": ["ADDI"],
+        "AUIPC": ["JALR", "LW"],
+        "SLT": ["BEQ", "BNE"],
+        "SLTU": ["BEQ", "BNE"],
+    }
 
-        inst_fields = self.get_inst_fields(inst, inst_metadata)
+    # mask selecting opcode, funct3 and funct7, the key of the dispatch table
+    dispatch_mask = 0xFE00707F
+    # (shift, width) of funct3 and funct7
+    funct_fields = ((12, 3), (25, 7))
 
-        return inst_metadata, inst_fields
+    def __init__(self, handlers=None):
+        self.handlers = handlers
+        self.field_getters = {
+            "R": self.get_r_fields,
+            "I": self.get_i_fields,
+            "S": self.get_s_fields,
+            "B": self.get_b_fields,
+            "U": self.get_u_fields,
+            "J": self.get_j_fields,
+            "CSR": self.get_csr_fields,
+        }
+        self.table = {}
+        self.system_table = {}
+        self._build_tables()
 
-    def get_inst_fields(self, inst, inst_metadata):
-        fields = {}
-        if inst_metadata[1] == "R":
-            fields = {
-                "rd": bin_to_int(inst[20:25]),
-                "rs1": bin_to_int(inst[12:17]),
-                "rs2": bin_to_int(inst[7:12]),
-            }
-        elif inst_metadata[1] == "I":
-            fields = {
-                "rd": bin_to_int(inst[20:25]),
-                "rs1": bin_to_int(inst[12:17]),
-                "imm": bin_to_int(inst[0] * 20 + inst[:12]),
-            }
-        elif inst_metadata[1] == "S":
-            fields = {
-                "rs1": bin_to_int(inst[12:17]),
-                "rs2": bin_to_int(inst[7:12]),
-                "imm": bin_to_int(inst[0] * 20 + inst[:7] + inst[20:25]),
-            }
-        elif inst_metadata[1] == "B":
-            fields = {
-                "rs1": bin_to_int(inst[12:17]),
-                "rs2": bin_to_int(inst[7:12]),
-                "imm": bin_to_int(
-                    inst[0] * 20 + inst[24] + inst[1:7] + inst[20:24] + "0"
-                ),
-            }
+    def _build_tables(self):
+        for op_code, entry in self.op_codes.items():
+            op_code = int(op_code, 2)
+            if op_code == 0b1110011:
+                # ECALL/EBREAK are told apart by imm[11:0], the CSR
+                # instructions by funct3 only
+                for imm, inst_metadata in entry["000"].items():
+                    self.system_table[int(imm, 2)] = self._table_entry(inst_metadata)
+                csr_entry = {funct3: sub for funct3, sub in entry.items() if funct3 != "000"}
+                self._fill(csr_entry, op_code, 0)
+                continue
+            self._fill(entry, op_code, 0)
 
-        elif inst_metadata[1] == "U":
-            fields = {
-                "rd": bin_to_int(inst[20:25]),
-                "imm": bin_to_int(inst[:20] + "0" * 12),
-            }
-        elif inst_metadata[1] == "J":
+    def _fill(self, entry, key, depth):
+        if isinstance(entry, tuple):
+            # fields below the leaf are don't care, expand all their values
+            keys = [key]
+            for shift, width in self.funct_fields[depth:]:
+                keys = [k | (f << shift) for k in keys for f in range(1 << width)]
+            table_entry = self._table_entry(entry)
+            for k in keys:
+                self.table[k] = table_entry
+            return
+        shift, _ = self.funct_fields[depth]
+        for field, sub_entry in entry.items():
+            self._fill(sub_entry, key | (int(field, 2) << shift), depth + 1)
+
+    def _table_entry(self, inst_metadata):
+        name, inst_format = inst_metadata
+        handler = None
+        if self.handlers is not None:
+            handler = getattr(self.handlers, "_" + name)
+        return (name, inst_format, handler), self.field_getters[inst_format]
+
+    def decode(self, inst):
+        if inst & 0x707F == 0b1110011:
+            inst_metadata, get_fields = self.system_table[inst >> 20]
+        else:
+            inst_metadata, get_fields = self.table[inst & self.dispatch_mask]
+        return inst_metadata, get_fields(inst)
+
+    def fuse(self, pc, first, second):
+        # (handler, fields) of the fused operation for the decoded entries at
+        # pc and pc + 4, None unless the second instruction reads the
+        # register the first one wrote, the fields hold everything that only
+        # depends on pc and the immediates
+        name, inst_fields = first[5], first[1]
+        second_name, second_fields = second[5], second[1]
+        rd = inst_fields["rd"]
+        if second_name not in self.fusion_pairs.get(name, ()) or not rd:
+            return None
+        if name == "LUI":
+            # constant materialization, lui rd, hi; addi rd, rd, lo
+            if second_fields["rs1"] != rd or second_fields["rd"] != rd:
+                return None
+            operation = "LUI_ADDI"
+            fields = {"rd": rd, "value": (inst_fields["imm"] + second_fields["imm"]) & MASK}
+        elif name == "AUIPC":
+            if second_fields["rs1"] != rd:
+                return None
+            value = (pc + inst_fields["imm"]) & MASK
+            fields = {"rd": rd, "value": value, "second_rd": second_fields["rd"]}
+            if second_name == "JALR":
+                # far call or jump, auipc rd, hi; jalr rd2, lo(rd)
+                operation = "AUIPC_JALR"
+                fields["link"] = (pc + 8) & MASK
+                fields["target"] = (value + second_fields["imm"]) & 0xFFFFFFFE
+            else:
+                # global load, auipc rd, hi; lw rd2, lo(rd)
+                operation = "AUIPC_LW"
+                fields["addr"] = (value + second_fields["imm"]) & MASK
+        else:
+            # compare and branch on the result, slt(u) rd, rs1, rs2 followed
+            # by beq/bne comparing rd with zero
+            operands = (second_fields["rs1"], second_fields["rs2"])
+            if operands != (rd, 0) and operands != (0, rd):
+                return None
+            operation = f"{name}_BRANCH"
             fields = {
-                "rd": bin_to_int(inst[20:25]),
-                "imm": bin_to_int(
-                    inst[0] * 12 + inst[12:20] + inst[11] + inst[1:7] + inst[7:11] + "0"
-                ),
+                "rd": rd,
+                "rs1": inst_fields["rs1"],
+                "rs2": inst_fields["rs2"],
+                # the comparison result that takes the branch
+                "taken": 1 if second_name == "BNE" else 0,
+                "target": (pc + 4 + second_fields["imm"]) & MASK,
             }
-        return fields
+        fields["next_pc"] = (pc + 8) & MASK
+        if fields.get("target") == fields["next_pc"]:
+            # a jump to the next instruction would look like falling through
+            # to the profiled loop (see RISCVSimulator._run_fused_profiled)
+            return None
+        return getattr(self.handlers, "_" + operation), fields
+
+    def get_inst_fields(self, inst, inst_metadata):
+        return self.field_getters[inst_metadata[1]](inst)
+
+    @staticmethod
+    def get_r_fields(inst):
+        return {
+            "rd": (inst >> 7) & 0x1F,
+            "rs1": (inst >> 15) & 0x1F,
+            "rs2": (inst >> 20) & 0x1F,
+        }
+
+    @staticmethod
+    def get_i_fields(inst):
+        return {
+            "rd": (inst >> 7) & 0x1F,
+            "rs1": (inst >> 15) & 0x1F,
+            "imm": ((inst >> 20) ^ 0x800) - 0x800,
+        }
+
+    @staticmethod
+    def get_csr_fields(inst):
+        return {
+            "rd": (inst >> 7) & 0x1F,
+            "rs1": (inst >> 15) & 0x1F,
+            "csr": inst >> 20,
+        }
+
+    @staticmethod
+    def get_s_fields(inst):
+        imm = ((inst >> 20) & 0xFE0) | ((inst >> 7) & 0x1F)
+        return {
+            "rs1": (inst >> 15) & 0x1F,
+            "rs2": (inst >> 20) & 0x1F,
+            "imm": (imm ^ 0x800) - 0x800,
+        }
+
+    @staticmethod
+    def get_b_fields(inst):
+        imm = (
+            ((inst >> 19) & 0x1000)
+            | ((inst << 4) & 0x800)
+            | ((inst >> 20) & 0x7E0)
+            | ((inst >> 7) & 0x1E)
+        )
+        return {
+            "rs1": (inst >> 15) & 0x1F,
+            "rs2": (inst >> 20) & 0x1F,
+            "imm": (imm ^ 0x1000) - 0x1000,
+        }
+
+    @staticmethod
+    def get_u_fields(inst):
+        return {
+            "rd": (inst >> 7) & 0x1F,
+            "imm": ((inst & 0xFFFFF000) ^ 0x80000000) - 0x80000000,
+        }
+
+    @staticmethod
+    def get_j_fields(inst):
+        imm = (
+            ((inst >> 11) & 0x100000)
+            | (inst & 0xFF000)
+            | ((inst >> 9) & 0x800)
+            | ((inst >> 20) & 0x7FE)
+        )
+        return {
+            "rd": (inst >> 7) & 0x1F,
+            "imm": (imm ^ 0x100000) - 0x100000,
+        }
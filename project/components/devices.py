@@ -0,0 +1,156 @@
+import struct
+import sys
+import time
+
+# addresses of the devices on QEMU's virt board, where firmware expects them
+UART_BASE = 0x10000000
+CLINT_BASE = 0x2000000
+
+# 16550 registers, one byte each
+UART_RBR = 0  # receive buffer (read) / transmit holding (write)
+UART_LSR = 5  # line status
+LSR_DATA_READY = 0x01
+LSR_THR_EMPTY = 0x20
+LSR_TX_IDLE = 0x40
+
+# CLINT register offsets, per hart msip and mtimecmp and the shared mtime
+CLINT_MSIP = 0x0
+CLINT_MTIMECMP = 0x4000
+CLINT_MTIME = 0xBFF8
+
+# checkpointed state (see utils.checkpoint): UART input position and
+# registers followed by the unflushed output, CLINT mtime and the counts of
+# the mtimecmp and msip registers followed by their (hart, value) pairs
+UART_STATE = struct.Struct("<Q8s")
+CLINT_STATE = struct.Struct("<QII")
+CLINT_MTIMECMP_STATE = struct.Struct("<IQ")
+CLINT_MSIP_STATE = struct.Struct("<II")
+
+
+class Uart:
+    # 16550-style UART, bytes written to the transmit register are kept in
+    # a buffer written to output once it holds buffer_size bytes and by
+    # flush, the receive register reads from the input bytes
+    # the transmitter is always ready, the other registers just hold what
+    # was written to them, pack_state and unpack_state save and restore all
+    # of it for checkpoints
+    size = 0x100
+
+    def __init__(self, output=None, base=UART_BASE, input=b"", buffer_size=1 << 20):
+        self.output = output if output is not None else sys.stdout.buffer
+        self.base = base
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.input = bytes(input)
+        self.input_pos = 0
+        self.registers = bytearray(8)
+
+    def read(self, offset, size):
+        if offset == UART_RBR:
+            if self.input_pos == len(self.input):
+                return 0
+            self.input_pos += 1
+            return self.input[self.input_pos - 1]
+        if offset == UART_LSR:
+            ready = LSR_DATA_READY if self.input_pos < len(self.input) else 0
+            return LSR_THR_EMPTY | LSR_TX_IDLE | ready
+        if offset < len(self.registers):
+            return self.registers[offset]
+        return 0
+
+    def write(self, offset, size, value):
+        if offset == UART_RBR:
+            self.buffer.append(value & 0xFF)
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+        elif offset < len(self.registers) and offset != UART_LSR:
+            self.registers[offset] = value & 0xFF
+
+    def flush(self):
+        if self.buffer:
+            self.output.write(self.buffer)
+            self.output.flush()
+            self.buffer.clear()
+
+    def pack_state(self):
+        return UART_STATE.pack(self.input_pos, bytes(self.registers)) + self.buffer
+
+    def unpack_state(self, state):
+        self.input_pos, registers = UART_STATE.unpack_from(state)
+        self.registers[:] = registers
+        self.buffer[:] = state[UART_STATE.size :]
+
+
+class Clint:
+    # CLINT-style timer, mtime counts frequency ticks per second of host
+    # time since the device was created and mtimecmp of hart i is at
+    # CLINT_MTIMECMP + 8 * i, both 64 bits wide and accessed as two words
+    # the simulator has no interrupts, a guest polls mtime or timer_pending
+    # tells whether the timer of a hart fired, msip is plain storage
+    # a checkpoint keeps mtime, mtimecmp and msip
+    size = 0x10000
+
+    def __init__(self, base=CLINT_BASE, frequency=10000000):
+        self.base = base
+        self.frequency = frequency
+        self.start = time.perf_counter_ns()
+        self.msip = {}
+        self.mtimecmp = {}
+
+    @property
+    def mtime(self):
+        return (time.perf_counter_ns() - self.start) * self.frequency // 1000000000
+
+    def timer_pending(self, hartid):
+        return self.mtime >= self.mtimecmp.get(hartid, (1 << 64) - 1)
+
+    def _register(self, offset):
+        # (64-bit value, its setter or None, bit shift of the accessed word)
+        shift = (offset & 4) * 8
+        if CLINT_MTIME <= offset < CLINT_MTIME + 8:
+            return self.mtime, None, shift
+        if CLINT_MTIMECMP <= offset < CLINT_MTIME:
+            hartid = (offset - CLINT_MTIMECMP) >> 3
+            value = self.mtimecmp.get(hartid, (1 << 64) - 1)
+            return value, lambda value: self.mtimecmp.__setitem__(hartid, value), shift
+        if offset < CLINT_MTIMECMP:
+            hartid = offset >> 2
+            return self.msip.get(hartid, 0), lambda value: self.msip.__setitem__(hartid, value & 1), 0
+        return 0, None, 0
+
+    def read(self, offset, size):
+        value, _, shift = self._register(offset & ~3)
+        return (value >> shift >> (offset & 3) * 8) & ((1 << size * 8) - 1)
+
+    def write(self, offset, size, value):
+        # only whole words change a register
+        if size != 4:
+            return
+        current, setter, shift = self._register(offset & ~3)
+        if setter is not None:
+            setter(current & ~(0xFFFFFFFF << shift) | value << shift)
+
+    def flush(self):
+        pass
+
+    def pack_state(self):
+        state = [CLINT_STATE.pack(self.mtime, len(self.mtimecmp), len(self.msip))]
+        state += [CLINT_MTIMECMP_STATE.pack(*item) for item in self.mtimecmp.items()]
+        state += [CLINT_MSIP_STATE.pack(*item) for item in self.msip.items()]
+        return b"".join(state)
+
+    def unpack_state(self, state):
+        # mtime goes on from the checkpointed value
+        mtime, timers, interrupts = CLINT_STATE.unpack_from(state)
+        self.start = time.perf_counter_ns() - mtime * 1000000000 // self.frequency
+        offset = CLINT_STATE.size
+        self.mtimecmp = {}
+        for _ in range(timers):
+            hartid, value = CLINT_MTIMECMP_STATE.unpack_from(state, offset)
+            self.mtimecmp[hartid] = value
+            offset += CLINT_MTIMECMP_STATE.size
+        self.msip = {}
+        for _ in range(interrupts):
+            hartid, value = CLINT_MSIP_STATE.unpack_from(state, offset)
+            self.msip[hartid] = value
+            offset += CLINT_MSIP_STATE.size
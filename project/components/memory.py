@@ -1,47 +1,278 @@
-from utils.convert import little_endian, int_to_hex
+import struct
+from bisect import bisect_right, insort
+from multiprocessing import shared_memory
+
+from utils.convert import MASK
+
+PAGE_BITS = 12
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE - 1
+
+WORD = struct.Struct("<I")
+HALFWORD = struct.Struct("<H")
+
+
+class Bus:
+    # memory-mapped devices in front of a Memory, page_table maps every page
+    # a device overlaps to its (base, end, device) regions sorted by base
+    # those pages are never allocated (see Memory.attach), so RAM accesses
+    # stay on the page lookup and only accesses missing the allocated pages
+    # get here, device page bytes outside every device read zero and ignore
+    # writes
+    # a device has base, size, read(offset, size), write(offset, size, value)
+    # and flush() for its buffered output
+
+    def __init__(self):
+        self.page_table = {}
+        self.devices = []
+
+    def attach(self, device):
+        end = device.base + device.size
+        for other in self.devices:
+            if device.base < other.base + other.size and other.base < end:
+                raise ValueError(
+                    f"device at {device.base:#x} overlaps the device at {other.base:#x}"
+                )
+        self.devices.append(device)
+        for page_id in range(device.base >> PAGE_BITS, ((end - 1) >> PAGE_BITS) + 1):
+            insort(self.page_table.setdefault(page_id, []), (device.base, end, device))
+
+    def _find(self, pos):
+        regions = self.page_table.get(pos >> PAGE_BITS)
+        if regions is not None:
+            i = bisect_right(regions, (pos, MASK + 1)) - 1
+            if i >= 0 and pos < regions[i][1]:
+                base, _, device = regions[i]
+                return device, pos - base
+        return None, 0
+
+    def load(self, pos, size):
+        device, offset = self._find(pos)
+        if device is None:
+            return 0
+        return device.read(offset, size)
+
+    def store(self, pos, size, value):
+        device, offset = self._find(pos)
+        if device is not None:
+            device.write(offset, size, value & ((1 << size * 8) - 1))
+
+    def flush(self):
+        for device in self.devices:
+            device.flush()
 
 
 class Memory:
-    def __init__(self, init_mem, access_time=10):
-        self.mem = init_mem
+    # sparse byte addressable memory, only pages that were loaded or written
+    # are allocated, reads from anywhere else return zero, or the device
+    # register there (see Bus), devices are attached before init_mem is
+    # loaded so it cannot cover them
+    # read and load copy bytes without going through the devices
+    def __init__(self, init_mem=(), access_time=10, devices=()):
+        self.pages = {}
+        # ids of the pages written since the last state hash, None when the
+        # run is not hashed (see RISCVSimulator.write_state_hash)
+        self.dirty_pages = None
+        self.bus = Bus()
         self.access_time = access_time
+        for device in devices:
+            self.attach(device)
+        for pos, content in init_mem:
+            self.load(pos, content)
+
+    def attach(self, device):
+        # an allocated page there would shadow the device
+        last_page = (device.base + device.size - 1) >> PAGE_BITS
+        for page_id in range(device.base >> PAGE_BITS, last_page + 1):
+            if self.pages.get(page_id) is not None:
+                raise ValueError(
+                    f"device at {device.base:#x} overlaps memory at {page_id << PAGE_BITS:#x}"
+                )
+        self.bus.attach(device)
+
+    def _get_page(self, page_id):
+        page = self.pages.get(page_id)
+        if page is None:
+            if page_id in self.bus.page_table:
+                raise ValueError(f"page {page_id << PAGE_BITS:#x} is device memory")
+            # read back, SharedPages keeps its own copy of the page
+            self.pages[page_id] = bytearray(PAGE_SIZE)
+            page = self.pages[page_id]
+        return page
 
-    def write(self, pos, content):
-        content = little_endian(content)
-        for i, b in enumerate(range(0, len(content), 2)):
-            self.mem[pos + i] = content[b : b + 2]
+    def load(self, pos, content):
+        content = memoryview(content).cast("B")
+        while len(content):
+            offset = pos & PAGE_MASK
+            size = min(PAGE_SIZE - offset, len(content))
+            self._get_page(pos >> PAGE_BITS)[offset : offset + size] = content[:size]
+            if self.dirty_pages is not None:
+                self.dirty_pages.add(pos >> PAGE_BITS)
+            pos += size
+            content = content[size:]
+
+    def read(self, pos, size):
+        data = bytearray(size)
+        done = 0
+        while done < size:
+            offset = pos & PAGE_MASK
+            chunk = min(PAGE_SIZE - offset, size - done)
+            page = self.pages.get(pos >> PAGE_BITS)
+            if page is not None:
+                data[done : done + chunk] = page[offset : offset + chunk]
+            pos += chunk
+            done += chunk
+        return data
 
     def get_word(self, pos):
-        word = (
-            self.mem.get(pos, "00")
-            + self.mem.get(pos + 1, "00")
-            + self.mem.get(pos + 2, "00")
-            + self.mem.get(pos + 3, "00")
-        )
-        word = little_endian(word)
-        return word, self.access_time
+        page = self.pages.get(pos >> PAGE_BITS)
+        offset = pos & PAGE_MASK
+        if page is None or offset > PAGE_SIZE - 4:
+            return self._load(pos, 4), self.access_time
+        return WORD.unpack_from(page, offset)[0], self.access_time
 
     def get_halfword(self, pos):
-        hw = self.mem.get(pos, "00") + self.mem.get(pos + 1, "00")
-        hw = little_endian(hw)
-        return hw, self.access_time
+        page = self.pages.get(pos >> PAGE_BITS)
+        offset = pos & PAGE_MASK
+        if page is None or offset > PAGE_SIZE - 2:
+            return self._load(pos, 2), self.access_time
+        return HALFWORD.unpack_from(page, offset)[0], self.access_time
 
     def get_byte(self, pos):
-        b = self.mem.get(pos, "00")
-        b = little_endian(b)
-        return b, self.access_time
+        page = self.pages.get(pos >> PAGE_BITS)
+        if page is None:
+            return self.bus.load(pos, 1), self.access_time
+        return page[pos & PAGE_MASK], self.access_time
+
+    def _load(self, pos, size):
+        # loads missing the allocated pages or crossing two pages, split per
+        # page, the parts on device pages come from the bus
+        value = 0
+        done = 0
+        while done < size:
+            offset = pos & PAGE_MASK
+            chunk = min(PAGE_SIZE - offset, size - done)
+            page = self.pages.get(pos >> PAGE_BITS)
+            if page is None:
+                part = self.bus.load(pos, chunk)
+            else:
+                part = int.from_bytes(page[offset : offset + chunk], "little")
+            value |= part << done * 8
+            pos = (pos + chunk) & MASK
+            done += chunk
+        return value
+
+    def _store(self, pos, size, value):
+        # stores to a page that is not allocated yet or across two pages,
+        # split per page like _load, the parts on device pages go to the bus
+        done = 0
+        while done < size:
+            offset = pos & PAGE_MASK
+            chunk = min(PAGE_SIZE - offset, size - done)
+            part = (value >> done * 8) & ((1 << chunk * 8) - 1)
+            page_id = pos >> PAGE_BITS
+            if page_id in self.bus.page_table:
+                self.bus.store(pos, chunk, part)
+            else:
+                self._get_page(page_id)[offset : offset + chunk] = part.to_bytes(chunk, "little")
+            pos = (pos + chunk) & MASK
+            done += chunk
 
     def set_word(self, pos, value):
-        hex_value = int_to_hex(value)
-        self.write(pos, hex_value)
+        page = self.pages.get(pos >> PAGE_BITS)
+        offset = pos & PAGE_MASK
+        if page is None or offset > PAGE_SIZE - 4:
+            self._store(pos, 4, value)
+        else:
+            WORD.pack_into(page, offset, value & 0xFFFFFFFF)
         return self.access_time
 
     def set_halfword(self, pos, value):
-        hex_value = int_to_hex(value)[4:]
-        self.write(pos, hex_value)
+        page = self.pages.get(pos >> PAGE_BITS)
+        offset = pos & PAGE_MASK
+        if page is None or offset > PAGE_SIZE - 2:
+            self._store(pos, 2, value)
+        else:
+            HALFWORD.pack_into(page, offset, value & 0xFFFF)
         return self.access_time
 
     def set_byte(self, pos, value):
-        hex_value = int_to_hex(value)[6:]
-        self.write(pos, hex_value)
+        page = self.pages.get(pos >> PAGE_BITS)
+        if page is None:
+            self._store(pos, 1, value)
+        else:
+            page[pos & PAGE_MASK] = value & 0xFF
         return self.access_time
+
+
+class SharedPages(dict):
+    # Memory.pages over a pool of pages in shared memory, so harts running in
+    # other processes see the same memory, table holds the pool slot + 1 of
+    # every allocated page id and its last entry the allocated slot count,
+    # it only changes under lock
+    # the dict caches the pages this process already mapped, new pages
+    # always start zeroed
+
+    def __init__(self, names, lock):
+        table_name, pool_name = names
+        self.names = names
+        self.lock = lock
+        self.table_block = shared_memory.SharedMemory(table_name)
+        self.pool_block = shared_memory.SharedMemory(pool_name)
+        self.table = self.table_block.buf.cast("I")
+        self.pool = self.pool_block.buf
+        self.slots = len(self.pool) // PAGE_SIZE
+
+    @classmethod
+    def create(cls, slots, lock):
+        table = shared_memory.SharedMemory(create=True, size=((1 << (32 - PAGE_BITS)) + 1) * 4)
+        pool = shared_memory.SharedMemory(create=True, size=slots * PAGE_SIZE)
+        pages = cls((table.name, pool.name), lock)
+        table.close()
+        pool.close()
+        return pages
+
+    def _map(self, page_id, slot):
+        page = self.pool[(slot - 1) * PAGE_SIZE : slot * PAGE_SIZE]
+        dict.__setitem__(self, page_id, page)
+        return page
+
+    def get(self, page_id, default=None):
+        page = dict.get(self, page_id)
+        if page is None:
+            slot = self.table[page_id]
+            if not slot:
+                return default
+            page = self._map(page_id, slot)
+        return page
+
+    def __setitem__(self, page_id, page):
+        # page is only copied when no process allocated page_id yet
+        with self.lock:
+            slot = self.table[page_id]
+            if not slot:
+                slot = self.table[-1] + 1
+                if slot > self.slots:
+                    raise MemoryError(f"shared memory is full ({self.slots} pages)")
+                self.pool[(slot - 1) * PAGE_SIZE : slot * PAGE_SIZE] = page
+                self.table[page_id] = slot
+                self.table[-1] = slot
+        self._map(page_id, slot)
+
+    def copy(self):
+        # private copy of every allocated page
+        return {
+            page_id: bytearray(self.pool[(slot - 1) * PAGE_SIZE : slot * PAGE_SIZE])
+            for page_id, slot in enumerate(self.table[:-1])
+            if slot
+        }
+
+    def close(self, unlink=False):
+        dict.clear(self)
+        self.table.release()
+        self.pool.release()
+        self.table_block.close()
+        self.pool_block.close()
+        if unlink:
+            self.table_block.unlink()
+            self.pool_block.unlink()
@@ -0,0 +1,181 @@
+import struct
+import sys
+
+from utils.convert import MASK
+
+# Linux/riscv-pk system call numbers, the ones newlib's libgloss uses
+SYS_CLOSE = 57
+SYS_READ = 63
+SYS_WRITE = 64
+SYS_FSTAT = 80
+SYS_EXIT = 93
+SYS_EXIT_GROUP = 94
+SYS_CLOCK_GETTIME = 113
+SYS_TIMES = 153
+SYS_GETTIMEOFDAY = 169
+SYS_BRK = 214
+
+EBADF = 9
+ENOSYS = 38
+
+# struct kernel_stat of libgloss, only st_mode is filled
+KERNEL_STAT = struct.Struct("<QQIIIIQQqiiq8x8x8x8x8x8x8x")
+S_IFCHR = 0o020000
+# struct timeval and struct timespec of newlib for ilp32 with the 64-bit
+# time_t of current toolchains: seconds, a 32-bit fraction and padding up
+# to the 8-byte alignment
+TIME = struct.Struct("<qi4x")
+# bytes kept free below the stack pointer when the heap grows towards it
+STACK_GUARD = 1 << 16
+
+
+class SyscallEmulator:
+    # proxy-kernel style system calls, RISCVSimulator hands every ECALL
+    # over to call with the number in a7, arguments in a0-a5 and the result
+    # (or -errno) going to a0
+    # guest stdout/stderr are kept in buffers written to the host files
+    # once they hold buffer_size bytes and by flush, stdin reads from the
+    # stdin bytes, time is the retired instruction count at clock_hz
+    # instructions per second
+
+    def __init__(
+        self,
+        stdout=None,
+        stderr=None,
+        stdin=b"",
+        buffer_size=1 << 20,
+        clock_hz=1000000000,
+        image_end=None,
+    ):
+        self.outputs = {
+            1: stdout if stdout is not None else sys.stdout.buffer,
+            2: stderr if stderr is not None else sys.stderr.buffer,
+        }
+        self.buffers = {1: bytearray(), 2: bytearray()}
+        self.buffer_size = buffer_size
+        self.stdin = bytes(stdin)
+        self.stdin_pos = 0
+        self.clock_hz = clock_hz
+        self.open_fds = {0, 1, 2}
+        # the heap starts after the program image, .bss included (see
+        # program_load.read_image_end), without image_end RISCVSimulator
+        # starts it after the loaded bytes
+        self.program_break = None if image_end is None else (image_end + 15) & ~15
+        self.exit_code = None
+        self.handlers = {
+            SYS_CLOSE: self._close,
+            SYS_READ: self._read,
+            SYS_WRITE: self._write,
+            SYS_FSTAT: self._fstat,
+            SYS_EXIT: self._exit,
+            SYS_EXIT_GROUP: self._exit_group,
+            SYS_CLOCK_GETTIME: self._clock_gettime,
+            SYS_TIMES: self._times,
+            SYS_GETTIMEOFDAY: self._gettimeofday,
+            SYS_BRK: self._brk,
+        }
+
+    def call(self, simulator):
+        regs = simulator.registers
+        handler = self.handlers.get(regs[17])
+        if handler is None:
+            result = -ENOSYS
+        else:
+            result = handler(simulator, *regs[10:16])
+        if result is not None:
+            regs[10] = result & MASK
+
+    def flush(self):
+        for fd, buffer in self.buffers.items():
+            if buffer:
+                self.outputs[fd].write(buffer)
+                self.outputs[fd].flush()
+                buffer.clear()
+
+    def _write_guest(self, simulator, addr, data):
+        # untimed copy into guest memory, code read from it is decoded again
+        simulator.memory.load(addr, data)
+        simulator._invalidate_code(addr, len(data))
+
+    def _time(self, simulator, unit):
+        # simulated time as (seconds, fraction in 1/unit)
+        seconds, rest = divmod(simulator.inst_count, self.clock_hz)
+        return seconds, rest * unit // self.clock_hz
+
+    def _close(self, simulator, fd, *_):
+        if fd not in self.open_fds:
+            return -EBADF
+        self.open_fds.discard(fd)
+        return 0
+
+    def _read(self, simulator, fd, addr, size, *_):
+        if fd != 0 or fd not in self.open_fds:
+            return -EBADF
+        data = self.stdin[self.stdin_pos : self.stdin_pos + size]
+        self.stdin_pos += len(data)
+        self._write_guest(simulator, addr, data)
+        return len(data)
+
+    def _write(self, simulator, fd, addr, size, *_):
+        if fd not in self.buffers or fd not in self.open_fds:
+            return -EBADF
+        buffer = self.buffers[fd]
+        buffer += simulator.memory.read(addr, size)
+        if len(buffer) >= self.buffer_size:
+            self.outputs[fd].write(buffer)
+            buffer.clear()
+        return size
+
+    def _fstat(self, simulator, fd, addr, *_):
+        if fd not in self.open_fds:
+            return -EBADF
+        # the standard streams are character devices, so newlib takes them
+        # for terminals
+        stat = KERNEL_STAT.pack(0, 0, S_IFCHR | 0o620, 1, 0, 0, 0, 0, 0, 0, 0, 0)
+        self._write_guest(simulator, addr, stat)
+        return 0
+
+    def _exit(self, simulator, status, *_):
+        self.exit_code = status - (1 << 32) if status & 0x80000000 else status
+        simulator.ebreak = True
+        self.flush()
+
+    def _exit_group(self, simulator, status, *_):
+        # stops the harts sharing the memory too
+        for hart in simulator.harts:
+            hart.ebreak = True
+        self._exit(simulator, status)
+
+    def _clock_gettime(self, simulator, clock_id, addr, *_):
+        self._write_guest(simulator, addr, TIME.pack(*self._time(simulator, 1000000000)))
+        return 0
+
+    def _times(self, simulator, addr, *_):
+        # struct tms, user time in microseconds like riscv-pk, returns the
+        # same clock
+        seconds, microseconds = self._time(simulator, 1000000)
+        ticks = (seconds * 1000000 + microseconds) & MASK
+        self._write_guest(simulator, addr, struct.pack("<IIII", ticks, 0, 0, 0))
+        return ticks
+
+    def _gettimeofday(self, simulator, addr, *_):
+        self._write_guest(simulator, addr, TIME.pack(*self._time(simulator, 1000000)))
+        return 0
+
+    def _brk_limit(self, simulator):
+        # the heap stops STACK_GUARD bytes below a stack above it and at the
+        # first device above it
+        limit = 1 << 32
+        sp = simulator.registers[2]
+        if sp > self.program_break:
+            limit = max(sp - STACK_GUARD, self.program_break)
+        for device in simulator.memory.bus.devices:
+            if self.program_break <= device.base < limit:
+                limit = device.base
+        return limit
+
+    def _brk(self, simulator, addr, *_):
+        # the break only moves up, brk(0) and refused calls return it
+        if self.program_break <= addr <= self._brk_limit(simulator):
+            self.program_break = addr
+        return self.program_break
@@ -0,0 +1,325 @@
+from components.memory import Memory, PAGE_BITS, PAGE_MASK, PAGE_SIZE, WORD, HALFWORD
+from components.breakpoint import BreakpointHit
+from utils.convert import to_signed, MASK, SIGN
+
+
+class BlockTranslator:
+    # straight-line runs of guest code are turned into one generated Python
+    # function, the block returns (next pc, retired instructions)
+    terminators = ["JAL", "JALR", "BEQ", "BNE", "BLT", "BGE", "BLTU", "BGEU", "ECALL", "EBREAK"]
+    max_block_size = 64
+
+    branch_conditions = {
+        "BEQ": "{rs1} == {rs2}",
+        "BNE": "{rs1} != {rs2}",
+        "BLT": "{rs1} ^ SIGN < {rs2} ^ SIGN",
+        "BGE": "{rs1} ^ SIGN >= {rs2} ^ SIGN",
+        "BLTU": "{rs1} < {rs2}",
+        "BGEU": "{rs1} >= {rs2}",
+    }
+
+    alu_expressions = {
+        "LUI": "{uimm}",
+        "AUIPC": "{auipc}",
+        "ADDI": "({rs1} + {imm}) & MASK",
+        "SLTI": "1 if to_signed({rs1}) < {imm} else 0",
+        "SLTIU": "1 if {rs1} < {uimm} else 0",
+        "XORI": "({rs1} ^ {imm}) & MASK",
+        "ORI": "({rs1} | {imm}) & MASK",
+        "ANDI": "{rs1} & {uimm}",
+        "SLLI": "({rs1} << {shamt}) & MASK",
+        "SRLI": "{rs1} >> {shamt}",
+        "SRAI": "(to_signed({rs1}) >> {shamt}) & MASK",
+        "ADD": "({rs1} + {rs2}) & MASK",
+        "SUB": "({rs1} - {rs2}) & MASK",
+        "SLT": "1 if {rs1} ^ SIGN < {rs2} ^ SIGN else 0",
+        "SLTU": "1 if {rs1} < {rs2} else 0",
+        "SLL": "({rs1} << ({rs2} & 0x1F)) & MASK",
+        "SRL": "{rs1} >> ({rs2} & 0x1F)",
+        "SRA": "(to_signed({rs1}) >> ({rs2} & 0x1F)) & MASK",
+        "XOR": "{rs1} ^ {rs2}",
+        "OR": "{rs1} | {rs2}",
+        "AND": "{rs1} & {rs2}",
+        "MUL": "({rs1} * {rs2}) & MASK",
+        "MULH": "((to_signed({rs1}) * to_signed({rs2})) >> 32) & MASK",
+        "MULHSU": "((to_signed({rs1}) * {rs2}) >> 32) & MASK",
+        "MULHU": "({rs1} * {rs2}) >> 32",
+    }
+
+    # name: (size, struct prefix, memory method, sign extension)
+    loads = {
+        "LB": (1, None, "get_byte", (0x80, 0xFFFFFF00)),
+        "LH": (2, "half", "get_halfword", (0x8000, 0xFFFF0000)),
+        "LW": (4, "word", "get_word", None),
+        "LBU": (1, None, "get_byte", None),
+        "LHU": (2, "half", "get_halfword", None),
+    }
+
+    stores = {
+        "SB": (1, None, "set_byte"),
+        "SH": (2, "half", "set_halfword"),
+        "SW": (4, "word", "set_word"),
+    }
+
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def _globals(self, traced):
+        simulator = self.simulator
+        memory = simulator.memory
+        # the slow paths skip CachedMemory's timing, data_access already
+        # charged the access
+        return {
+            "sim": simulator,
+            "regs": simulator.registers,
+            "pages": memory.pages,
+            "get_byte": Memory.get_byte.__get__(memory),
+            "get_halfword": Memory.get_halfword.__get__(memory),
+            "get_word": Memory.get_word.__get__(memory),
+            "set_byte": Memory.set_byte.__get__(memory),
+            "set_halfword": Memory.set_halfword.__get__(memory),
+            "set_word": Memory.set_word.__get__(memory),
+            "unpack_word": WORD.unpack_from,
+            "unpack_half": HALFWORD.unpack_from,
+            "pack_word": WORD.pack_into,
+            "pack_half": HALFWORD.pack_into,
+            "code_pages": simulator.code_pages,
+            "dirty_pages": memory.dirty_pages,
+            "invalidate": simulator._invalidate_code,
+            "record": simulator.logger.record if traced else None,
+            "record_load": simulator.logger.record_load if traced else None,
+            "fetch": simulator.cache.fetch if simulator.cache is not None else None,
+            "fetch_repeat": simulator.cache.fetch_repeat if simulator.cache is not None else None,
+            "data_access": simulator.cache.data_access if simulator.cache is not None else None,
+            "to_signed": to_signed,
+            "MASK": MASK,
+            "SIGN": SIGN,
+        }
+
+    def scan(self, pc):
+        # decode entries of the block starting at pc, direct jumps (JAL) are
+        # followed so the jump target becomes part of the block
+        simulator = self.simulator
+        entries = []
+        seen = set()
+        while len(entries) < self.max_block_size:
+            entry = simulator.decode_cache.get(pc)
+            if entry is None:
+                try:
+                    entry = simulator._instruction_lookup(pc)
+                except (KeyError, BreakpointHit):
+                    if not entries:
+                        raise
+                    # the interpreter reports it once execution gets there,
+                    # blocks also end before breakpoints
+                    break
+            entries.append(entry)
+            seen.add(pc)
+            name = entry[5]
+            if name == "JAL":
+                pc = (pc + entry[1]["imm"]) & MASK
+                if pc in seen:
+                    break
+                continue
+            if name in self.terminators:
+                break
+            pc += 4
+        return entries
+
+    def translate(self, pc, traced=False):
+        # returns the block function and the addresses it was built from,
+        # the function takes the instruction budget of looping blocks
+        entries = self.scan(pc)
+        source, names = self.generate(entries, traced)
+        scope = self._globals(traced)
+        scope.update(names)
+        defaults = ", ".join(f"{name}={name}" for name in scope)
+        code = compile(
+            f"def block(budget, {defaults}):\n{source}", f"<block {pc:08X}>", "exec"
+        )
+        exec(code, scope)
+        return scope["block"], [entry[3] for entry in entries]
+
+    def _exit_targets(self, entries):
+        last = entries[-1]
+        pc, name = last[3], last[5]
+        if name == "JAL":
+            return [(pc + last[1]["imm"]) & MASK]
+        if name in self.branch_conditions:
+            return [(pc + last[1]["imm"]) & MASK, pc + 4]
+        if name not in self.terminators:
+            return [pc + 4]
+        return []
+
+    def generate(self, entries, traced):
+        start = entries[0][3]
+        # a block whose exit leads back to its own start loops in place
+        # while fewer than budget instructions were retired, n counts the
+        # instructions retired by the previous iterations
+        loop = start in self._exit_targets(entries)
+        profiler = self.simulator.profiler
+        cache = self.simulator.cache
+        writer = self.simulator.trace_writer
+        addresses = [entry[3] for entry in entries]
+        names = {}
+        exits = []
+        # instruction cache lines accessed so far, each one is fetched before
+        # its first instruction runs so the data accesses keep their order
+        fetched = []
+
+        def count_exit(retired, taken_pc=None):
+            # profiling counts each way out of the block once, the profiler
+            # credits the instructions retired up to it when it collects them,
+            # the other fetches up to it hit the line fetched last
+            lines = []
+            k = len(exits)
+            exits.append(retired)
+            if profiler is not None:
+                names[f"x{k}"] = profiler.block_exit(addresses[:retired], taken_pc)
+                lines.append(f"x{k}[0] += 1")
+            if cache is not None and retired > len(fetched):
+                lines.append(f"fetch_repeat({retired - len(fetched)})")
+            return lines
+
+        def goto(target, retired, taken_pc=None):
+            counted = count_exit(retired, taken_pc)
+            if target == start and loop:
+                return counted + [f"n += {retired}", "if n < budget:", "    continue", f"return {target}, n"]
+            return counted + [f"return {target}, {retired_count(retired)}"]
+
+        def retired_count(retired):
+            return f"n + {retired}" if loop else f"{retired}"
+
+        lines = []
+        for i, entry in enumerate(entries):
+            handler, inst_fields, (rs1_id, rs2_id, rd_id), pc, _, name = entry
+            names[f"e{i}"] = entry
+            retired = i + 1
+            last = retired == len(entries)
+            fields = self._operands(inst_fields, pc)
+            rd = inst_fields.get("rd", 0)
+            record = []
+            if cache is not None:
+                line = pc >> cache.l1i.line_bits
+                if not fetched or fetched[-1] != line:
+                    fetched.append(line)
+                    lines.append(f"fetch({line})")
+            if traced:
+                lines.append(f"v1 = regs[{rs1_id}]")
+                lines.append(f"v2 = regs[{rs2_id}]")
+                record = [f"record(e{i}, v1, v2, regs[{rd_id}])"]
+
+            if name in self.alu_expressions:
+                if rd:
+                    lines.append(f"regs[{rd}] = " + self.alu_expressions[name].format(**fields))
+                lines += record
+            elif name in self.loads:
+                lines += self._load(name, fields, rd)
+                if traced and writer is not None and writer.memory:
+                    lines.append("record_load(v)")
+                lines += record
+            elif name in self.stores:
+                lines += self._store(name, fields)
+                lines += record
+                # the rest of this block may have been overwritten
+                size = self.stores[name][0]
+                lines.append(f"if a >> {PAGE_BITS} in code_pages and invalidate(a, {size}):")
+                lines += ["    " + line for line in count_exit(retired)]
+                lines.append(f"    return {pc + 4}, {retired_count(retired)}")
+            elif name in self.branch_conditions:
+                condition = self.branch_conditions[name].format(**fields)
+                lines.append(f"t = {condition}")
+                lines += record
+                lines.append("if t:")
+                lines += ["    " + line for line in goto((pc + inst_fields["imm"]) & MASK, retired, pc)]
+                lines += goto(pc + 4, retired)
+            elif name == "JAL":
+                if rd:
+                    lines.append(f"regs[{rd}] = {(pc + 4) & MASK}")
+                lines += record
+                if last:
+                    lines += goto((pc + inst_fields["imm"]) & MASK, retired)
+            elif name == "JALR":
+                lines.append(f"t = ({fields['rs1']} + {inst_fields['imm']}) & 0xFFFFFFFE")
+                if rd:
+                    lines.append(f"regs[{rd}] = {(pc + 4) & MASK}")
+                lines += record
+                lines += count_exit(retired)
+                lines.append(f"return t, {retired_count(retired)}")
+            elif name == "EBREAK":
+                lines.append("sim.ebreak = True")
+                lines += record
+                lines += count_exit(retired)
+                lines.append(f"return {pc + 4}, {retired_count(retired)}")
+            else:
+                # rare instructions run through the interpreter handler
+                names[f"h{i}"] = handler
+                names[f"f{i}"] = inst_fields
+                lines.append(f"sim.pc = {pc}")
+                lines.append(f"h{i}(f{i})")
+                lines += record
+                if name in self.terminators:
+                    lines.append("t = sim.next_pc")
+                    lines.append("sim.next_pc = None")
+                    lines += count_exit(retired)
+                    lines.append(f"return ({pc + 4} if t is None else t), {retired_count(retired)}")
+            if last and name not in self.terminators:
+                lines += goto(pc + 4, retired)
+        if loop:
+            lines = ["n = 0", "while True:"] + ["    " + line for line in lines]
+        return "".join(f"    {line}\n" for line in lines), names
+
+    def _operands(self, inst_fields, pc):
+        imm = inst_fields.get("imm", 0)
+        rs1 = inst_fields.get("rs1", 0)
+        rs2 = inst_fields.get("rs2", 0)
+        return {
+            "rs1": f"regs[{rs1}]" if rs1 else "0",
+            "rs2": f"regs[{rs2}]" if rs2 else "0",
+            "imm": imm,
+            "uimm": imm & MASK,
+            "auipc": (pc + imm) & MASK,
+            "shamt": rs2,
+        }
+
+    def _load(self, name, fields, rd):
+        size, packer, method, sign = self.loads[name]
+        lines = [f"a = ({fields['rs1']} + {fields['imm']}) & MASK"]
+        if self.simulator.cache is not None:
+            lines.append("data_access(a, False)")
+        lines.append(f"p = pages.get(a >> {PAGE_BITS})")
+        if size == 1:
+            lines.append(f"v = p[a & {PAGE_MASK}] if p is not None else get_byte(a)[0]")
+        else:
+            lines.append(f"if p is not None and a & {PAGE_MASK} <= {PAGE_SIZE - size}:")
+            lines.append(f"    v = unpack_{packer}(p, a & {PAGE_MASK})[0]")
+            lines.append("else:")
+            lines.append(f"    v = {method}(a)[0]")
+        if rd:
+            if sign is None:
+                lines.append(f"regs[{rd}] = v")
+            else:
+                lines.append(f"regs[{rd}] = v | {sign[1]} if v & {sign[0]} else v")
+        return lines
+
+    def _store(self, name, fields):
+        size, packer, method = self.stores[name]
+        value = fields["rs2"]
+        lines = [f"a = ({fields['rs1']} + {fields['imm']}) & MASK"]
+        if self.simulator.cache is not None:
+            lines.append("data_access(a, True)")
+        lines.append(f"p = pages.get(a >> {PAGE_BITS})")
+        if size == 1:
+            lines.append("if p is not None:")
+            lines.append(f"    p[a & {PAGE_MASK}] = {value} & 0xFF")
+        else:
+            lines.append(f"if p is not None and a & {PAGE_MASK} <= {PAGE_SIZE - size}:")
+            lines.append(f"    pack_{packer}(p, a & {PAGE_MASK}, {value} & {(1 << size * 8) - 1})")
+        lines.append("else:")
+        lines.append(f"    {method}(a, {value})")
+        if self.simulator.memory.dirty_pages is not None:
+            # the pages written since the last state hash, see write_state_hash
+            lines.append(f"dirty_pages.add(a >> {PAGE_BITS})")
+            if size > 1:
+                lines.append(f"dirty_pages.add(((a + {size - 1}) & MASK) >> {PAGE_BITS})")
+        return lines
@@ -0,0 +1,283 @@
+import argparse
+import select
+import socket
+
+from components.syscalls import SyscallEmulator
+from utils import program_load
+from simulator import RISCVSimulator
+
+REGISTER_NAMES = (
+    "zero ra sp gp tp t0 t1 t2 fp s1 a0 a1 a2 a3 a4 a5 "
+    "a6 a7 s2 s3 s4 s5 s6 s7 s8 s9 s10 s11 t3 t4 t5 t6"
+).split()
+REGISTER_TYPES = {"ra": "code_ptr", "sp": "data_ptr", "gp": "data_ptr", "tp": "data_ptr"}
+PC_REGISTER = 32
+
+TARGET_XML = (
+    '<?xml version="1.0"?>'
+    '<!DOCTYPE target SYSTEM "gdb-target.dtd">'
+    '<target version="1.0">'
+    "<architecture>riscv:rv32</architecture>"
+    '<feature name="org.gnu.gdb.riscv.cpu">'
+    + "".join(
+        f'<reg name="{name}" bitsize="32" type="{REGISTER_TYPES.get(name, "int")}" regnum="{i}"/>'
+        for i, name in enumerate(REGISTER_NAMES)
+    )
+    + f'<reg name="pc" bitsize="32" type="code_ptr" regnum="{PC_REGISTER}"/>'
+    "</feature>"
+    "</target>"
+)
+
+SIGINT = 2
+SIGTRAP = 5
+
+
+def word_hex(value):
+    # registers go little-endian over the wire
+    return (value & 0xFFFFFFFF).to_bytes(4, "little").hex()
+
+
+class GdbStub:
+    # GDB remote serial protocol server for one RISCVSimulator, register
+    # and memory access, step, continue, software and hardware breakpoints
+    # (RISCVSimulator.breakpoints) and write watchpoints (add_watchpoint)
+    # continue runs the simulator at full speed in slices of slice
+    # instructions, checking in between whether GDB sent an interrupt
+    # the program's EBREAK is reported as its exit with a0 as the status
+
+    def __init__(self, simulator, slice=1 << 16):
+        self.simulator = simulator
+        self.slice = slice
+        self.connection = None
+        self.buffer = bytearray()
+        self.no_ack = False
+        self.last_stop = f"S{SIGTRAP:02x}"
+
+    def serve(self, port, host="127.0.0.1"):
+        # serves one GDB connection until it detaches, kills or disconnects
+        with socket.create_server((host, port)) as server:
+            print(f"waiting for gdb on {host}:{server.getsockname()[1]}")
+            self.connection, _ = server.accept()
+        with self.connection:
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                packet = self._receive()
+                if packet is None:
+                    return
+                reply = self.handle(packet.decode("ascii"))
+                if reply is not None:
+                    self._send(reply)
+                if packet[:1] in (b"D", b"k"):
+                    return
+
+    def handle(self, packet):
+        # reply to one packet, "" for the ones not supported, None for no
+        # reply at all
+        sim = self.simulator
+        kind, body = packet[:1], packet[1:]
+        if packet.startswith("qSupported"):
+            return "PacketSize=4000;QStartNoAckMode+;swbreak+;hwbreak+;qXfer:features:read+"
+        if packet == "QStartNoAckMode":
+            self._send("OK")
+            self.no_ack = True
+            return None
+        if packet.startswith("qXfer:features:read:target.xml:"):
+            offset, length = (int(value, 16) for value in packet.split(":")[-1].split(","))
+            chunk = TARGET_XML[offset : offset + length]
+            return ("m" if offset + length < len(TARGET_XML) else "l") + chunk
+        if packet == "qAttached":
+            return "1"
+        if packet == "qC":
+            return "QC1"
+        if packet == "qfThreadInfo":
+            return "m1"
+        if packet == "qsThreadInfo":
+            return "l"
+        if kind == "H":
+            return "OK"
+        if kind == "?":
+            return self.last_stop
+        if kind == "g":
+            return "".join(word_hex(value) for value in sim.registers) + word_hex(sim.pc)
+        if kind == "G":
+            data = bytes.fromhex(body)
+            values = [int.from_bytes(data[i : i + 4], "little") for i in range(0, len(data), 4)]
+            sim.registers[1:32] = values[1:32]
+            if len(values) > PC_REGISTER:
+                sim.pc = values[PC_REGISTER]
+            return "OK"
+        if kind == "p":
+            register = int(body, 16)
+            if register == PC_REGISTER:
+                return word_hex(sim.pc)
+            if register < PC_REGISTER:
+                return word_hex(sim.registers[register])
+            return "E01"
+        if kind == "P":
+            register, value = body.split("=")
+            register, value = int(register, 16), int.from_bytes(bytes.fromhex(value), "little")
+            if register == PC_REGISTER:
+                sim.pc = value
+            elif 0 < register < PC_REGISTER:
+                sim.registers[register] = value
+            elif register != 0:
+                return "E01"
+            return "OK"
+        if kind == "m":
+            addr, length = (int(value, 16) for value in body.split(","))
+            return sim.memory.read(addr, length).hex()
+        if kind == "M":
+            location, data = body.split(":")
+            addr = int(location.split(",")[0], 16)
+            data = bytes.fromhex(data)
+            # code there is decoded again, a debugger write hits no watchpoint
+            sim.memory.load(addr, data)
+            sim._invalidate_code(addr, len(data), watch=False)
+            return "OK"
+        if kind in ("s", "c"):
+            if body:
+                sim.pc = int(body, 16)
+            self.last_stop = self._resume(step=kind == "s")
+            return self.last_stop
+        if kind in ("Z", "z"):
+            point, addr, size = body.split(",")[:3]
+            addr, size = int(addr, 16), int(size, 16)
+            if point in ("0", "1"):
+                if kind == "Z":
+                    sim.add_breakpoint(addr)
+                else:
+                    sim.remove_breakpoint(addr)
+                return "OK"
+            if point == "2":
+                if kind == "Z":
+                    sim.add_watchpoint(addr, size)
+                else:
+                    sim.remove_watchpoint(addr, size)
+                return "OK"
+            # read and access watchpoints
+            return ""
+        if kind == "D":
+            return "OK"
+        if kind == "k":
+            return None
+        return ""
+
+    def _resume(self, step):
+        # stop reply after a step, or after continuing until a breakpoint,
+        # a watchpoint, EBREAK or an interrupt from GDB
+        sim = self.simulator
+        if sim.ebreak:
+            return self._exit_reply()
+        self._step()
+        while not (step or sim.ebreak or sim.watch_hit is not None or sim.pc in sim.breakpoints):
+            if self._interrupted():
+                return f"S{SIGINT:02x}"
+            sim.run(sim.inst_count + self.slice)
+        if sim.ebreak:
+            return self._exit_reply()
+        if sim.watch_hit is not None:
+            addr, sim.watch_hit = sim.watch_hit, None
+            return f"T{SIGTRAP:02x}watch:{addr:x};"
+        if not step and sim.pc in sim.breakpoints:
+            return f"T{SIGTRAP:02x}swbreak:;"
+        return f"S{SIGTRAP:02x}"
+
+    def _step(self):
+        # runs one instruction, also when a breakpoint is set on it
+        sim = self.simulator
+        pc = sim.pc
+        stepped_over = pc in sim.breakpoints
+        if stepped_over:
+            sim.remove_breakpoint(pc)
+        try:
+            sim.run(sim.inst_count + 1)
+        finally:
+            if stepped_over:
+                sim.add_breakpoint(pc)
+
+    def _exit_reply(self):
+        return f"W{self.simulator.registers[10] & 0xFF:02x}"
+
+    def _interrupted(self):
+        # GDB sends a bare 0x03 byte to stop a running target
+        if not select.select([self.connection], [], [], 0)[0]:
+            return False
+        data = self.connection.recv(4096)
+        if not data:
+            return True
+        self.buffer += data.replace(b"\x03", b"")
+        return b"\x03" in data
+
+    def _receive(self):
+        # payload of the next packet, None once GDB disconnected
+        while True:
+            start = self.buffer.find(b"$")
+            end = self.buffer.find(b"#", start)
+            if start >= 0 and end >= 0 and len(self.buffer) >= end + 3:
+                payload = bytes(self.buffer[start + 1 : end])
+                checksum = int(self.buffer[end + 1 : end + 3], 16)
+                del self.buffer[: end + 3]
+                if not self.no_ack:
+                    valid = sum(payload) & 0xFF == checksum
+                    self.connection.sendall(b"+" if valid else b"-")
+                    if not valid:
+                        continue
+                return payload
+            if start < 0:
+                # acks and interrupts outside a run
+                self.buffer.clear()
+            data = self.connection.recv(4096)
+            if not data:
+                return None
+            self.buffer += data
+
+    def _send(self, reply):
+        payload = reply.encode("ascii")
+        checksum = f"{sum(payload) & 0xFF:02x}".encode("ascii")
+        self.connection.sendall(b"$" + payload + b"#" + checksum)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "program",
+        help="ELF or Intel HEX file to debug",
+        type=str,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--port",
+        help="TCP port GDB connects to with target remote :PORT",
+        type=int,
+        default=1234,
+    )
+
+    parser.add_argument(
+        "--engine",
+        help="execution engine, see cli.py",
+        type=str,
+        choices=RISCVSimulator.engines,
+        default="interpreter",
+    )
+
+    parser.add_argument(
+        "--syscalls",
+        help="serve ECALLs as proxy-kernel system calls, guest output goes to this terminal",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    start_addr, mem_init = program_load.read_file(args.program)
+    syscalls = None
+    if args.syscalls:
+        syscalls = SyscallEmulator(image_end=program_load.read_image_end(args.program))
+    risc_v = RISCVSimulator(
+        start_addr,
+        mem_init,
+        trace="off",
+        engine=args.engine,
+        syscalls=syscalls,
+    )
+    GdbStub(risc_v).serve(args.port)
@@ -0,0 +1,128 @@
+import argparse
+import io
+import sys
+from itertools import zip_longest
+
+from components.syscalls import SyscallEmulator
+from utils import program_load
+from utils.state_hash import first_divergence, read_sidecar
+from simulator import RISCVSimulator
+
+
+def trace_interval(program, start, end, output, args):
+    # runs untraced up to start, then writes the trace of instructions
+    # start + 1 to end
+    syscalls = None
+    if args.syscalls:
+        stdin = b""
+        if args.stdin is not None:
+            with open(args.stdin, "rb") as stdin_file:
+                stdin = stdin_file.read()
+        syscalls = SyscallEmulator(
+            stdout=io.BytesIO(),
+            stderr=io.BytesIO(),
+            stdin=stdin,
+            image_end=program_load.read_image_end(program),
+        )
+    start_addr, mem_init = program_load.read_file(program)
+    with open(output, "w") as trace_file:
+        risc_v = RISCVSimulator(
+            start_addr,
+            mem_init,
+            trace="commit" if args.spike else "full",
+            trace_file=trace_file,
+            engine=args.engine,
+            syscalls=syscalls,
+        )
+        risc_v.fast_forward(count=start)
+        risc_v.run(end)
+    return risc_v.inst_count
+
+
+def first_different_line(path_a, path_b):
+    # (index, line of a, line of b) of the first line the traces differ in,
+    # None when they are equal
+    with open(path_a) as trace_a, open(path_b) as trace_b:
+        for i, (line_a, line_b) in enumerate(zip_longest(trace_a, trace_b)):
+            if line_a != line_b:
+                return i, line_a, line_b
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "sidecars",
+        help="the two state hash sidecars (test.hash, written with cli.py --hash-every) to compare",
+        type=str,
+        nargs=2,
+    )
+
+    parser.add_argument(
+        "-p",
+        "--program",
+        help="re-run the first differing interval of this program with full tracing, writing program.<start>-<end>.log",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="trace of the same interval from the other run, reports the first instruction they differ in",
+        type=str,
+        default=None,
+    )
+
+    parser.add_argument(
+        "-s",
+        "--spike",
+        help="write the commit format compared with spike by cmp_logs.py (no disassembly)",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--engine",
+        help="execution engine, see cli.py",
+        type=str,
+        choices=RISCVSimulator.engines,
+        default="interpreter",
+    )
+
+    parser.add_argument(
+        "--syscalls",
+        help="serve ECALLs like cli.py --syscalls, the guest output is dropped",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--stdin",
+        help="file read by the guest from stdin with --syscalls",
+        type=str,
+        default=None,
+    )
+
+    args = parser.parse_args()
+    if args.compare is not None and args.program is None:
+        parser.error("--compare needs --program")
+    path_a, path_b = args.sidecars
+    divergence = first_divergence(read_sidecar(path_a), read_sidecar(path_b))
+    if divergence is None:
+        print(f"{path_a} and {path_b} match")
+        sys.exit(0)
+    start, end = divergence
+    print(f"first divergence after instruction {start}, by instruction {end}")
+    if args.program is not None:
+        output = f"{args.program.rsplit('.', 1)[0]}.{start}-{end}.log"
+        retired = trace_interval(args.program, start, end, output, args)
+        print(f"trace of instructions {start + 1} to {retired} written to {output}")
+        if args.compare is not None:
+            difference = first_different_line(output, args.compare)
+            if difference is None:
+                print(f"{output} and {args.compare} match")
+            else:
+                i, line_a, line_b = difference
+                print(f"first different instruction: {start + i + 1}")
+                print(f"{output}: {(line_a or '<end of trace>').rstrip()}")
+                print(f"{args.compare}: {(line_b or '<end of trace>').rstrip()}")
+    sys.exit(1)
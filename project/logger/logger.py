@@ -1,4 +1,6 @@
-from utils.convert import int_to_hex
+import sys
+
+from utils.convert import MASK
 
 
 class Logger:
@@ -37,39 +39,128 @@ class Logger:
         "t6",
     ]
 
-    disassembly_pattern = [
-        ["SLLI", "SRLI", "SRAI"],
-        ["LW", "LH", "LB", "LHU", "LBU", "SW", "SH", "SB", "JALR"],
-    ]
+    # off: no trace, commit: pc/inst/registers, full: commit plus disassembly
+    levels = ["off", "commit", "full"]
 
-    def __init__(self, disassembly):
-        self.inst = {}
-        self.disassembly = disassembly
+    disassembly_pattern = {
+        "U": ["LUI", "AUIPC"],
+        "JAL": ["JAL"],
+        "B": ["BEQ", "BNE", "BLT", "BGE", "BLTU", "BGEU"],
+        "LOAD": ["LW", "LH", "LB", "LHU", "LBU"],
+        "STORE": ["SW", "SH", "SB"],
+        "I": ["JALR", "ADDI", "SLTI", "XORI", "ORI", "ANDI"],
+        "IU": ["SLTIU"],
+        "SHAMT": ["SLLI", "SRLI", "SRAI"],
+        "NONE": ["FENCE", "ECALL", "EBREAK"],
+        "CSR": ["CSRRW", "CSRRS", "CSRRC"],
+        "CSRI": ["CSRRWI", "CSRRSI", "CSRRCI"],
+    }
 
-    def log(self):
-        inst = self.inst
-        if self.disassembly:
-            print(
-                f"{inst.get('pc')} [{inst.get('inst')}] {inst.get('rd_str')} {inst.get('rs1_str')} {inst.get('rs2_str')} {inst.get('disassembly')}"
-            )
-        else:
-            print(
-                f"{inst.get('pc')} [{inst.get('inst')}] {inst.get('rd_str')} {inst.get('rs1_str')} {inst.get('rs2_str')}"
-            )
-        self.flush()
+    def __init__(self, level="full", output=None, buffer_size=4096):
+        if level not in self.levels:
+            raise ValueError(f"unknown trace level {level}, use one of {self.levels}")
+        self.level = level
+        self.output = output
+        self.buffer_size = buffer_size
+        self.patterns = {
+            name: pattern
+            for pattern, names in self.disassembly_pattern.items()
+            for name in names
+        }
+        # decoded entries and register values of the retired instructions,
+        # lines are only formatted when the buffer is written
+        self.count = 0
+        self.entries = [None] * buffer_size
+        self.rd_values = [0] * buffer_size
+        self.rs1_values = [0] * buffer_size
+        self.rs2_values = [0] * buffer_size
+        # values read by the loads, only set with record_load
+        self.load_values = [0] * buffer_size
+        # objects with a consume(entries, count) method fed with every
+        # buffer of retired instructions before it is written, they keep
+        # the record hook on when the trace is off (see active)
+        self.consumers = []
 
-    def flush(self):
-        self.inst = {}
+    def active(self):
+        return self.level != "off" or bool(self.consumers)
+
+    def record(self, entry, rs1_value, rs2_value, rd_value):
+        count = self.count
+        self.entries[count] = entry
+        self.rs1_values[count] = rs1_value
+        self.rs2_values[count] = rs2_value
+        self.rd_values[count] = rd_value
+        count += 1
+        self.count = count
+        if count == self.buffer_size:
+            self.flush()
 
-    def set_pc(self, pc):
-        self.inst["pc"] = f"PC={pc:08X}"
+    def record_load(self, value):
+        # value read by the load recorded next, rd_value misses it when rd
+        # is x0
+        self.load_values[self.count] = value
 
-    def set_inst(self, inst):
-        self.inst["inst"] = inst
+    def flush(self):
+        if not self.count:
+            return
+        for consumer in self.consumers:
+            consumer.consume(self.entries, self.count)
+        if self.level == "off":
+            for i in range(self.count):
+                self.entries[i] = None
+            self.count = 0
+            return
+        templates = {}
+        lines = []
+        for i in range(self.count):
+            entry = self.entries[i]
+            template = templates.get(id(entry))
+            if template is None:
+                template = self.line_template(entry)
+                templates[id(entry)] = template
+            lines.append(
+                template % (self.rd_values[i], self.rs1_values[i], self.rs2_values[i])
+            )
+            self.entries[i] = None
+        self.count = 0
+        output = self.output if self.output is not None else sys.stdout
+        output.write("".join(lines))
 
-    def set_inst_disassembly(self, disassembly):
-            self.inst["disassembly"] = disassembly
+    def line_template(self, entry):
+        # everything but the register values is fixed for a decoded instruction
+        _, inst_fields, (rs1, rs2, rd), pc, inst, name = entry
+        line = f"PC={pc:08X} [{inst:08X}] x{rd:02d}=%08X x{rs1:02d}=%08X x{rs2:02d}=%08X"
+        if self.level == "full":
+            line = f"{line} {self.disassembly(name, inst_fields, pc)}"
+        return line + "\n"
 
-    def set_reg(self, reg_cat, reg_id, reg_value):
-        self.inst[reg_cat] = reg_id
-        self.inst[f"{reg_cat}_str"] = f"x{reg_id:02d}={int_to_hex(reg_value)}"
+    def disassembly(self, name, inst_fields, pc):
+        pattern = self.patterns.get(name, "R")
+        if pattern == "NONE":
+            return f"{name:>8}"
+        regs = self.registers
+        imm = inst_fields.get("imm")
+        rd = regs[inst_fields.get("rd", 0)]
+        rs1 = regs[inst_fields.get("rs1", 0)]
+        rs2 = regs[inst_fields.get("rs2", 0)]
+        if pattern == "U":
+            return f"{name:>8} {rd},0x{(imm & MASK) >> 12:X}"
+        if pattern == "JAL":
+            return f"{name:>8} {rd},0x{(pc + imm) & MASK:X}"
+        if pattern == "B":
+            return f"{name:>8} {rs1},{rs2},0x{(pc + imm) & MASK:X}"
+        if pattern == "LOAD":
+            return f"{name:>8} {rd},{imm}({rs1})"
+        if pattern == "STORE":
+            return f"{name:>8} {rs2},{imm}({rs1})"
+        if pattern == "I":
+            return f"{name:>8} {rd},{rs1},{imm}"
+        if pattern == "IU":
+            return f"{name:>8} {rd},{rs1},{imm & MASK}"
+        if pattern == "CSR":
+            return f"{name:>8} {rd},0x{inst_fields['csr']:X},{rs1}"
+        if pattern == "CSRI":
+            return f"{name:>8} {rd},0x{inst_fields['csr']:X},{inst_fields['rs1']}"
+        if pattern == "SHAMT":
+            return f"{name:>8} {rd},{rs1},0x{inst_fields['rs2']:X}"
+        return f"{name:>8} {rd},{rs1},{rs2}"
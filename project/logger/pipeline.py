@@ -0,0 +1,105 @@
+class Pipeline:
+    # in-order 5-stage (IF, ID, EX, MEM, WB) timing model with full
+    # forwarding, fed with the retired instructions by Logger.flush
+    # branches are predicted not taken and resolved in EX, JAL redirects
+    # fetch from ID and JALR from EX, MUL/DIV/REM hold EX for their latency
+    stages = 5
+    loads = ["LB", "LH", "LW", "LBU", "LHU"]
+    stores = ["SB", "SH", "SW"]
+    branches = ["BEQ", "BNE", "BLT", "BGE", "BLTU", "BGEU"]
+    # the shift immediates of OP-IMM decode with the shift amount in rs2 and
+    # the CSR immediate forms keep the immediate in rs1, neither is read
+    OP_IMM = 0b0010011
+    csr_immediates = ["CSRRWI", "CSRRSI", "CSRRCI"]
+    # instructions fetched after the control transfer that are flushed
+    penalties = {"branch": 2, "JAL": 1, "JALR": 2}
+    # cycles spent in EX
+    latencies = {
+        "MUL": 3,
+        "MULH": 3,
+        "MULHSU": 3,
+        "MULHU": 3,
+        "DIV": 34,
+        "DIVU": 34,
+        "REM": 34,
+        "REMU": 34,
+    }
+    stall_causes = ["load_use", "branch", "jump", "muldiv"]
+
+    def __init__(self):
+        self.instructions = 0
+        self.stalls = dict.fromkeys(self.stall_causes, 0)
+        # destination of the previous instruction when it is a load, and
+        # the fall-through pc of the previous instruction when it is a
+        # branch, its outcome is only known from the next retired pc
+        self.load_rd = 0
+        self.branch_next = None
+
+    def _classify(self, entry):
+        # (pc, registers read in EX, loaded register, branch fall-through,
+        # jump penalty, EX stall cycles) from the decoder fields
+        _, inst_fields, _, pc, inst, name = entry
+        sources = []
+        if name not in self.csr_immediates:
+            sources.append(inst_fields.get("rs1", 0))
+        if name not in self.stores and inst & 0x7F != self.OP_IMM:
+            # store data is only needed in MEM and is forwarded in time
+            sources.append(inst_fields.get("rs2", 0))
+        sources = tuple(reg for reg in sources if reg)
+        load_rd = inst_fields["rd"] if name in self.loads else 0
+        branch_next = pc + 4 if name in self.branches else None
+        jump = self.penalties.get(name, 0)
+        busy = self.latencies.get(name, 1) - 1
+        return pc, sources, load_rd, branch_next, jump, busy
+
+    def consume(self, entries, count):
+        infos = {}
+        load_rd = self.load_rd
+        branch_next = self.branch_next
+        branch_penalty = self.penalties["branch"]
+        load_use = branch = jump = muldiv = 0
+        for i in range(count):
+            entry = entries[i]
+            info = infos.get(id(entry))
+            if info is None:
+                info = infos[id(entry)] = self._classify(entry)
+            pc, sources, rd, next_pc, penalty, busy = info
+            if branch_next is not None and pc != branch_next:
+                branch += branch_penalty
+            if load_rd and load_rd in sources:
+                load_use += 1
+            jump += penalty
+            muldiv += busy
+            load_rd = rd
+            branch_next = next_pc
+        self.load_rd = load_rd
+        self.branch_next = branch_next
+        self.instructions += count
+        stalls = self.stalls
+        stalls["load_use"] += load_use
+        stalls["branch"] += branch
+        stalls["jump"] += jump
+        stalls["muldiv"] += muldiv
+
+    def reset_stats(self):
+        self.instructions = 0
+        self.stalls = dict.fromkeys(self.stall_causes, 0)
+        self.load_rd = 0
+        self.branch_next = None
+
+    def cycles(self):
+        if not self.instructions:
+            return 0
+        return self.instructions + self.stages - 1 + sum(self.stalls.values())
+
+    def columns(self):
+        # simulations.csv columns, cycles and CPI of the pipeline and the
+        # stall cycles by cause
+        cycles = self.cycles()
+        columns = {
+            "pipeline_cycles": cycles,
+            "pipeline_CPI": cycles / self.instructions if self.instructions else 0.0,
+        }
+        for cause in self.stall_causes:
+            columns[f"{cause}_stalls"] = self.stalls[cause]
+        return columns
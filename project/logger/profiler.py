@@ -0,0 +1,188 @@
+from bisect import bisect_right
+
+from utils.convert import MASK
+
+
+class Profiler:
+    # execution and taken counts per PC, kept in lists indexed by
+    # (pc - text_base) / 4, PCs outside the text segment (code written at
+    # run time) are counted in dicts
+    instruction_classes = {
+        "load": ["LB", "LH", "LW", "LBU", "LHU"],
+        "store": ["SB", "SH", "SW"],
+        "branch": ["BEQ", "BNE", "BLT", "BGE", "BLTU", "BGEU"],
+        "jump": ["JAL", "JALR"],
+        "muldiv": ["MUL", "MULH", "MULHSU", "MULHU", "DIV", "DIVU", "REM", "REMU"],
+        "system": [
+            "FENCE",
+            "ECALL",
+            "EBREAK",
+            "CSRRW",
+            "CSRRS",
+            "CSRRC",
+            "CSRRWI",
+            "CSRRSI",
+            "CSRRCI",
+        ],
+    }
+    mix_columns = ["alu", "load", "store", "branch", "jump", "muldiv", "system"]
+
+    def __init__(self, text_base, text_size):
+        self.text_base = text_base
+        self.size = (text_size + 3) // 4
+        self.counts = [0] * self.size
+        self.taken = [0] * self.size
+        # straight-line runs ending in a control transfer: a run from index
+        # i to j adds one to runs[i] and to ends[j], the run's last
+        # instruction is taken (see collect)
+        self.runs = [0] * self.size
+        self.ends = [0] * self.size
+        self.other_counts = {}
+        self.other_taken = {}
+        # translated blocks count their exits instead of every instruction:
+        # (pcs retired up to the exit, branch pc when the exit is its taken
+        # side, counter)
+        self.block_exits = []
+        self.classes = {
+            name: group
+            for group, names in self.instruction_classes.items()
+            for name in names
+        }
+
+    def count(self, pc, n=1):
+        index = ((pc - self.text_base) & MASK) >> 2
+        if index < self.size:
+            self.counts[index] += n
+        else:
+            self.other_counts[pc] = self.other_counts.get(pc, 0) + n
+
+    def count_run(self, first, last):
+        for pc in range(first, last + 4, 4):
+            self.count(pc)
+
+    def count_taken(self, pc, n=1):
+        index = ((pc - self.text_base) & MASK) >> 2
+        if index < self.size:
+            self.taken[index] += n
+        else:
+            self.other_taken[pc] = self.other_taken.get(pc, 0) + n
+
+    def block_exit(self, pcs, taken_pc=None):
+        counter = [0]
+        self.block_exits.append((pcs, taken_pc, counter))
+        return counter
+
+    def collect(self):
+        # moves the straight-line runs and the block exit counters into the
+        # per-PC counts
+        counts = self.counts
+        taken = self.taken
+        runs = self.runs
+        ends = self.ends
+        executed = 0
+        for i in range(self.size):
+            executed += runs[i]
+            counts[i] += executed
+            if ends[i]:
+                taken[i] += ends[i]
+                executed -= ends[i]
+                ends[i] = 0
+            runs[i] = 0
+        for pcs, taken_pc, counter in self.block_exits:
+            n = counter[0]
+            if not n:
+                continue
+            counter[0] = 0
+            for pc in pcs:
+                self.count(pc, n)
+            if taken_pc is not None:
+                self.count_taken(taken_pc, n)
+
+    def _by_pc(self, values, other):
+        result = {
+            self.text_base + 4 * i: n for i, n in enumerate(values) if n
+        }
+        result.update(other)
+        return result
+
+    def pc_counts(self):
+        self.collect()
+        return self._by_pc(self.counts, self.other_counts)
+
+    def taken_counts(self):
+        self.collect()
+        return self._by_pc(self.taken, self.other_taken)
+
+    def mnemonic_counts(self, mnemonic):
+        # mnemonic maps a pc to the instruction name at it
+        result = {}
+        for pc, n in self.pc_counts().items():
+            name = mnemonic(pc)
+            result[name] = result.get(name, 0) + n
+        return result
+
+    def instruction_mix(self, mnemonic):
+        mix = dict.fromkeys(self.mix_columns, 0)
+        for name, n in self.mnemonic_counts(mnemonic).items():
+            mix[self.classes.get(name, "alu")] += n
+        return mix
+
+    def report(self, output, mnemonic, symbols=None, top=50):
+        # ranked hot spots by function and by PC, branch behavior and the
+        # instruction mix, symbols is {name: (address, size)}
+        counts = self.pc_counts()
+        total = sum(counts.values()) or 1
+        locate = symbolizer(symbols or {})
+
+        functions = {}
+        for pc, n in counts.items():
+            function = locate(pc).split("+")[0]
+            if function.startswith("0x"):
+                function = "(no symbol)"
+            functions[function] = functions.get(function, 0) + n
+        output.write(f"instructions: {total}\n\nfunctions\n")
+        for function, n in sorted(functions.items(), key=lambda item: -item[1])[:top]:
+            output.write(f"{n:>12} {n / total:8.2%}  {function}\n")
+
+        output.write("\nhot spots\n")
+        for pc, n in sorted(counts.items(), key=lambda item: -item[1])[:top]:
+            output.write(
+                f"{n:>12} {n / total:8.2%}  {pc:08X} {mnemonic(pc):<8} {locate(pc)}\n"
+            )
+
+        taken = self.taken_counts()
+        branches = [
+            (pc, n) for pc, n in counts.items() if mnemonic(pc) in self.instruction_classes["branch"]
+        ]
+        output.write("\nbranches (executed, taken, not taken)\n")
+        for pc, n in sorted(branches, key=lambda item: -item[1])[:top]:
+            t = taken.get(pc, 0)
+            output.write(
+                f"{n:>12} {t:>12} {n - t:>12} {t / n:8.2%}  {pc:08X} {mnemonic(pc):<8} {locate(pc)}\n"
+            )
+
+        output.write("\nmnemonics\n")
+        for name, n in sorted(self.mnemonic_counts(mnemonic).items(), key=lambda item: -item[1]):
+            output.write(f"{n:>12} {n / total:8.2%}  {name}\n")
+
+        output.write("\ninstruction mix\n")
+        for group, n in self.instruction_mix(mnemonic).items():
+            output.write(f"{n:>12} {n / total:8.2%}  {group}\n")
+
+
+def symbolizer(symbols):
+    # returns a function giving "symbol+offset" for an address, addresses
+    # past the end of a sized symbol are shown as plain hex
+    ordered = sorted((addr, size, name) for name, (addr, size) in symbols.items())
+    starts = [addr for addr, _, _ in ordered]
+
+    def locate(pc):
+        i = bisect_right(starts, pc) - 1
+        if i < 0:
+            return f"0x{pc:X}"
+        addr, size, name = ordered[i]
+        if size and pc >= addr + size:
+            return f"0x{pc:X}"
+        return f"{name}+0x{pc - addr:X}" if pc != addr else name
+
+    return locate
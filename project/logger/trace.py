@@ -0,0 +1,185 @@
+import mmap
+import struct
+import zlib
+
+import numpy as np
+
+from components.decoder import Decoder
+from logger.logger import Logger
+from utils.convert import MASK
+
+# binary trace: header, then chunks of fixed-width records, each chunk is
+# (record count, payload bytes, pc before the chunk) and the records, as
+# zlib data when the file is compressed
+MAGIC = b"RVTRACE\0"
+HEADER = struct.Struct("<8sHH")
+CHUNK = struct.Struct("<III")
+VERSION = 1
+MEMORY_FLAG = 1
+COMPRESSED_FLAG = 2
+
+# pc is stored as the difference to the previous record's pc, modulo 2**32
+RECORD = [
+    ("pc", "<u4"),
+    ("inst", "<u4"),
+    ("rd", "u1"),
+    ("rs1", "u1"),
+    ("rs2", "u1"),
+    ("rd_value", "<u4"),
+    ("rs1_value", "<u4"),
+    ("rs2_value", "<u4"),
+]
+# address and value of loads and stores, zero for the other instructions
+MEMORY_RECORD = RECORD + [("addr", "<u4"), ("value", "<u4")]
+
+
+def record_dtype(memory):
+    return np.dtype(MEMORY_RECORD if memory else RECORD)
+
+
+class TraceWriter:
+    # Logger consumer writing the retired instructions as a binary trace,
+    # one chunk per logger buffer, register values come from the logger and
+    # so do the values of loads (see Logger.record_load) for memory records
+    loads = {"LB": 0xFF, "LH": 0xFFFF, "LW": MASK, "LBU": 0xFF, "LHU": 0xFFFF}
+    stores = {"SB": 0xFF, "SH": 0xFFFF, "SW": MASK}
+
+    def __init__(self, output, logger, memory=False, compress=False):
+        self.output = output
+        self.logger = logger
+        self.memory = memory
+        self.compress = compress
+        self.dtype = record_dtype(memory)
+        self.last_pc = 0
+        self.records = 0
+        flags = (MEMORY_FLAG if memory else 0) | (COMPRESSED_FLAG if compress else 0)
+        output.write(HEADER.pack(MAGIC, VERSION, flags))
+
+    def consume(self, entries, count):
+        # fields fixed for a decoded instruction are gathered once per
+        # buffer: (pc, inst, rd, rs1, rs2, is load, is store, imm, size mask)
+        slots = {}
+        static = []
+        index = []
+        for i in range(count):
+            entry = entries[i]
+            slot = slots.get(id(entry))
+            if slot is None:
+                slot = slots[id(entry)] = len(static)
+                _, inst_fields, (rs1, rs2, rd), pc, inst, name = entry
+                size_mask = self.loads.get(name) or self.stores.get(name, 0)
+                static.append(
+                    (
+                        pc,
+                        inst,
+                        rd,
+                        rs1,
+                        rs2,
+                        name in self.loads,
+                        name in self.stores,
+                        inst_fields.get("imm", 0) & MASK,
+                        size_mask,
+                    )
+                )
+            index.append(slot)
+        static = np.array(static, dtype=np.int64)[index]
+        logger = self.logger
+        records = np.empty(count, dtype=self.dtype)
+        pcs = static[:, 0].astype(np.uint32)
+        records["pc"] = np.diff(pcs, prepend=np.uint32(self.last_pc))
+        records["inst"] = static[:, 1]
+        records["rd"] = static[:, 2]
+        records["rs1"] = static[:, 3]
+        records["rs2"] = static[:, 4]
+        records["rd_value"] = logger.rd_values[:count]
+        records["rs1_value"] = logger.rs1_values[:count]
+        records["rs2_value"] = logger.rs2_values[:count]
+        if self.memory:
+            load, store = static[:, 5] != 0, static[:, 6] != 0
+            addr = (records["rs1_value"] + static[:, 7].astype(np.uint32)).astype(np.uint32)
+            records["addr"] = np.where(load | store, addr, 0)
+            value = np.where(load, logger.load_values[:count], records["rs2_value"])
+            records["value"] = value & static[:, 8].astype(np.uint32)
+        payload = records.tobytes()
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+        self.output.write(CHUNK.pack(count, len(payload), self.last_pc))
+        self.output.write(payload)
+        self.last_pc = int(pcs[-1])
+        self.records += count
+
+
+class TraceReader:
+    # memory maps a binary trace, chunk(i) and iteration give the records as
+    # NumPy structured arrays with the absolute pc in the pc field
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} binary trace")
+        self.memory = bool(flags & MEMORY_FLAG)
+        self.compressed = bool(flags & COMPRESSED_FLAG)
+        self.dtype = record_dtype(self.memory)
+        # (payload offset, record count, payload bytes, pc before the chunk)
+        self.chunks = []
+        offset = HEADER.size
+        while offset < len(self.data):
+            count, size, base = CHUNK.unpack_from(self.data, offset)
+            offset += CHUNK.size
+            self.chunks.append((offset, count, size, base))
+            offset += size
+
+    def __len__(self):
+        return sum(chunk[1] for chunk in self.chunks)
+
+    def __iter__(self):
+        for i in range(len(self.chunks)):
+            yield self.chunk(i)
+
+    def chunk(self, i):
+        offset, count, size, base = self.chunks[i]
+        if self.compressed:
+            payload = zlib.decompress(self.data[offset : offset + size])
+            records = np.frombuffer(payload, dtype=self.dtype, count=count).copy()
+        else:
+            records = np.frombuffer(self.data, dtype=self.dtype, count=count, offset=offset).copy()
+        records["pc"] = np.cumsum(records["pc"], dtype=np.uint32) + np.uint32(base)
+        return records
+
+    def records(self):
+        if not self.chunks:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(list(self))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+def write_text(reader, output, level="full"):
+    # writes the trace in the Logger text format of level, commit is the
+    # format compared with spike (-s)
+    logger = Logger(level=level)
+    decoder = Decoder()
+    templates = {}
+    for records in reader:
+        lines = []
+        for pc, inst, rd, rs1, rs2, rd_value, rs1_value, rs2_value in zip(
+            records["pc"].tolist(),
+            records["inst"].tolist(),
+            records["rd"].tolist(),
+            records["rs1"].tolist(),
+            records["rs2"].tolist(),
+            records["rd_value"].tolist(),
+            records["rs1_value"].tolist(),
+            records["rs2_value"].tolist(),
+        ):
+            template = templates.get((pc, inst))
+            if template is None:
+                inst_metadata, inst_fields = decoder.decode(inst)
+                entry = (None, inst_fields, (rs1, rs2, rd), pc, inst, inst_metadata[0])
+                template = templates[(pc, inst)] = logger.line_template(entry)
+            lines.append(template % (rd_value, rs1_value, rs2_value))
+        output.write("".join(lines))
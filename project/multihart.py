@@ -0,0 +1,167 @@
+import multiprocessing
+
+from components.memory import SharedPages
+from simulator import RISCVSimulator
+
+
+def round_robin(harts, quantum, max_count=None):
+    # runs quantum instructions of each hart, in hartid order, until all of
+    # them reached EBREAK or max_count instructions retired in total,
+    # returns the instructions retired
+    retired = 0
+    while True:
+        running = [hart for hart in harts if not hart.ebreak]
+        if not running:
+            return retired
+        for hart in running:
+            budget = quantum
+            if max_count is not None:
+                budget = min(quantum, max_count - retired)
+                if budget <= 0:
+                    return retired
+            retired += hart.run(hart.inst_count + budget)
+
+
+def run_group(names, lock, states, quantum, options, sender):
+    # process body of MultiHartSimulator: rebuilds the harts of one group on
+    # the shared pages, runs them and sends back their state or the error
+    try:
+        pages = SharedPages(names, lock)
+        harts = []
+        for hartid, pc, registers, ebreak, inst_count in states:
+            hart = RISCVSimulator(pc, (), hartid=hartid, **options)
+            hart.registers[:] = registers
+            hart.ebreak = ebreak
+            hart.inst_count = inst_count
+            if harts:
+                hart.share_memory(harts[0])
+            else:
+                hart.memory.pages = pages
+            harts.append(hart)
+        round_robin(harts, quantum)
+        sender.send([(hart.pc, hart.registers, hart.ebreak, hart.inst_count) for hart in harts])
+    except Exception as e:
+        sender.send(f"{type(e).__name__}: {e}")
+    finally:
+        sender.close()
+
+
+class MultiHartSimulator:
+    # harts RISCVSimulators sharing one memory, each with its own pc,
+    # registers and mhartid (the hart index), all of them start at pc
+    # with processes == 1 the harts are interleaved deterministically, each
+    # one runs quantum instructions in turn, otherwise hart i runs in process
+    # i % processes on a shared memory pool (shared_pages pages) and the
+    # interleaving is up to the OS, stores to code are only seen by harts in
+    # the same process and harts must be untraced and without devices there
+    # hart_options has the options of each hart (its trace_file, cache, ...)
+    # on top of options
+
+    def __init__(
+        self,
+        pc,
+        init_memory,
+        harts=2,
+        quantum=1000,
+        processes=1,
+        shared_pages=4096,
+        hart_options=None,
+        **options
+    ):
+        if harts < 1 or quantum < 1 or processes < 1:
+            raise ValueError("harts, quantum and processes must be positive")
+        self.quantum = quantum
+        self.processes = min(processes, harts)
+        self.shared_pages = shared_pages
+        self.options = options
+        self.harts = []
+        for hartid in range(harts):
+            hart_kwargs = dict(options)
+            if hart_options is not None:
+                hart_kwargs.update(hart_options[hartid])
+            hart = RISCVSimulator(pc, init_memory, hartid=hartid, **hart_kwargs)
+            if self.harts:
+                hart.share_memory(self.harts[0])
+            self.harts.append(hart)
+        if self.processes > 1:
+            for hart in self.harts:
+                if hart.logger.active() or hart.profiler is not None or hart.cache is not None:
+                    raise ValueError("harts in separate processes run without trace, profile, cache or pipeline")
+            if self.memory.bus.devices:
+                raise ValueError("harts in separate processes run without devices")
+
+    @property
+    def memory(self):
+        return self.harts[0].memory
+
+    @property
+    def inst_count(self):
+        return sum(hart.inst_count for hart in self.harts)
+
+    @property
+    def ebreak(self):
+        return all(hart.ebreak for hart in self.harts)
+
+    def run(self, max_count=None):
+        # runs until every hart reached EBREAK or max_count instructions
+        # retired by all the harts together, returns the instructions retired
+        if self.processes == 1:
+            return round_robin(self.harts, self.quantum, max_count)
+        if max_count is not None:
+            raise ValueError("an instruction budget needs the harts in a single process")
+        start = self.inst_count
+        self._run_processes()
+        return self.inst_count - start
+
+    def _run_processes(self):
+        context = multiprocessing.get_context()
+        lock = context.Lock()
+        pages = SharedPages.create(self.shared_pages, lock)
+        memory_pages = self.harts[0].memory.pages
+        errors = []
+        try:
+            for page_id, page in memory_pages.items():
+                pages[page_id] = page
+            workers = []
+            for group in range(self.processes):
+                harts = self.harts[group :: self.processes]
+                states = [
+                    (hart.hartid, hart.pc, hart.registers, hart.ebreak, hart.inst_count)
+                    for hart in harts
+                ]
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=run_group,
+                    args=(pages.names, lock, states, self.quantum, self.options, sender),
+                )
+                process.start()
+                sender.close()
+                workers.append((harts, process, receiver))
+            for harts, process, receiver in workers:
+                try:
+                    result = receiver.recv()
+                except EOFError:
+                    result = "hart process crashed"
+                process.join()
+                if isinstance(result, str):
+                    errors.append(result)
+                    continue
+                for hart, (pc, registers, ebreak, inst_count) in zip(harts, result):
+                    hart.pc = pc
+                    hart.registers[:] = registers
+                    hart.ebreak = ebreak
+                    hart.inst_count = inst_count
+            # the harts go on with a private copy of the memory, code they
+            # decoded may have been overwritten by the other processes
+            memory_pages.clear()
+            memory_pages.update(pages.copy())
+            for hart in self.harts:
+                hart.decode_cache.clear()
+                hart.fused_cache.clear()
+                hart.block_cache.clear()
+                hart.block_map.clear()
+                hart.block_hotness.clear()
+        finally:
+            pages.close(unlink=True)
+        if errors:
+            raise RuntimeError("; ".join(errors))
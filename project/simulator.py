@@ -1,399 +1,1141 @@
-import numpy as np
+import sys
 
-from components.memory import Memory
+from components.memory import Memory, PAGE_BITS
+from components.cache import CachedMemory
 from components.register import RegisterFile
 from components.decoder import Decoder
+from components.translator import BlockTranslator
+from components.breakpoint import BreakpointHit
 from logger.logger import Logger
-from utils.convert import hex_to_bin, bin_to_int, hex_to_int
+from logger.pipeline import Pipeline
+from logger.profiler import Profiler
+from logger.trace import TraceWriter
+from utils.checkpoint import (
+    pack_devices,
+    pack_syscalls,
+    read_checkpoint,
+    unpack_devices,
+    unpack_syscalls,
+    write_checkpoint,
+)
+from utils.state_hash import state_digest, write_header, write_record
+from utils.convert import to_signed, MASK, SIGN
+
+
+def div_signed(rs1, rs2):
+    # RISC-V semantics: x/0 = -1 and the overflow case returns the dividend
+    if rs2 == 0:
+        return MASK
+    if rs1 == SIGN and rs2 == MASK:
+        return SIGN
+    rs1, rs2 = to_signed(rs1), to_signed(rs2)
+    quotient = abs(rs1) // abs(rs2)
+    return (-quotient if (rs1 < 0) != (rs2 < 0) else quotient) & MASK
+
+
+def rem_signed(rs1, rs2):
+    # remainder takes the sign of the dividend, x%0 = x
+    if rs2 == 0:
+        return rs1
+    if rs1 == SIGN and rs2 == MASK:
+        return 0
+    rs1, rs2 = to_signed(rs1), to_signed(rs2)
+    remainder = abs(rs1) % abs(rs2)
+    return (-remainder if rs1 < 0 else remainder) & MASK
 
 
 class RISCVSimulator:
-    extend_sign = ["8", "9", "A", "B", "C", "D", "E", "F"]
+    engines = ["interpreter", "translator"]
+    hot_threshold = 16
+    # the untraced interpreter runs the pairs of Decoder.fusion_pairs as one
+    # operation, see _run_fused
+    fusion = True
 
-    def __init__(self, pc, init_memory, disassembly=False):
-        np.seterr(all="ignore")
-        self.pc = np.uint32(pc)
+    def __init__(
+        self,
+        pc,
+        init_memory,
+        trace="full",
+        trace_file=None,
+        engine="interpreter",
+        checkpoint_every=0,
+        checkpoint_file=None,
+        profile=False,
+        cache=None,
+        pipeline=False,
+        hartid=0,
+        syscalls=None,
+        trace_format="text",
+        trace_memory=False,
+        trace_compress=False,
+        devices=(),
+        hash_every=0,
+        hash_file=None,
+    ):
+        if engine not in self.engines:
+            raise ValueError(f"unknown engine {engine}, use one of {self.engines}")
+        self.pc = pc
         self.next_pc = None
-        self.memory = Memory(init_memory)
+        # cache is a CacheHierarchy timing fetches and data accesses
+        self.cache = cache
+        # devices are memory-mapped (see components.devices and Bus)
+        if cache is not None:
+            self.memory = CachedMemory(init_memory, cache, devices=devices)
+        else:
+            self.memory = Memory(init_memory, devices=devices)
         self.register_file = RegisterFile()
-        self.decoder = Decoder()
-        self.logger = Logger(disassembly=disassembly)
+        self.registers = self.register_file.registers
+        # CSRs readable with the Zicsr instructions, all of them read-only
+        self.hartid = hartid
+        self.csrs = {0xF14: hartid}  # mhartid
+        if hash_every:
+            # the store handlers also mark the pages they write for the state
+            # hash (see write_state_hash), runs without it keep the plain ones
+            self.memory.dirty_pages = set(self.memory.pages)
+            self._SB = self._marking_store(self._SB, 1)
+            self._SH = self._marking_store(self._SH, 2)
+            self._SW = self._marking_store(self._SW, 4)
+        if trace_memory and trace_format == "binary" and trace != "off":
+            # the load handlers hand the loaded value to the logger for the
+            # memory records of the binary trace
+            for name in BlockTranslator.loads:
+                setattr(self, "_" + name, self._recording_load(name))
+        self.decoder = Decoder(self)
+        self.logger = Logger(level=trace, output=trace_file)
+        # the binary trace (see logger.trace) is written from the logger
+        # buffer instead of the text lines, trace_file is a binary file
+        self.trace_writer = None
+        if trace_format == "binary" and trace != "off":
+            self.logger.level = "off"
+            self.trace_writer = TraceWriter(
+                trace_file, self.logger, memory=trace_memory, compress=trace_compress
+            )
+            self.logger.consumers.append(self.trace_writer)
+        # the pipeline timing model reads the retired instructions from the
+        # logger buffer
+        self.pipeline = None
+        if pipeline:
+            self.pipeline = Pipeline()
+            self.logger.consumers.append(self.pipeline)
         self.ebreak = False
+        self.inst_count = 0
+        # SyscallEmulator serving ECALLs, without it ECALL does nothing
+        # an ECALL stops the run loops like EBREAK and run serves it with
+        # inst_count up to date, ecall tells both apart
+        self.syscalls = syscalls
+        self.ecall = False
+        if syscalls is not None and syscalls.program_break is None:
+            # the heap starts after the highest loaded byte, the segments
+            # leave .bss out, so callers loading an ELF pass its image end
+            # to the SyscallEmulator
+            end = max((addr + len(content) for addr, content in init_memory), default=0)
+            syscalls.program_break = (end + 15) & ~15
+        self.engine = engine
+        # a checkpoint is written every checkpoint_every retired instructions,
+        # checkpoint_file is formatted with the instruction count
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_file = checkpoint_file
+        # a digest of pc, registers and memory is written to the hash_file
+        # sidecar every hash_every retired instructions and when EBREAK is
+        # reached, see utils.state_hash
+        # only the pages written since the previous record are hashed again,
+        # page_digests keeps the digest of every page
+        self.hash_every = hash_every
+        self.hash_file = hash_file
+        self.hashed_count = None
+        self.page_digests = {}
+        if hash_every:
+            write_header(hash_file, hash_every)
+        self.profiler = None
+        if profile:
+            # the counters cover the loaded segment holding the entry point
+            text_base, text_size = pc, 0
+            for addr, content in init_memory:
+                if addr <= pc < addr + len(content):
+                    text_base, text_size = addr, len(content)
+            self.profiler = Profiler(text_base, text_size)
+        # pages holding decoded or translated code, stores elsewhere skip
+        # the invalidation (see _invalidate_code)
+        self.code_pages = set()
+        # harts sharing this memory, see share_memory
+        self.harts = [self]
+        self.decode_cache = {}
+        self.fused_cache = {}
+        self.translator = BlockTranslator(self)
+        self.block_cache = {}
+        self.block_map = {}
+        self.block_hotness = {}
+        # execution stops before the instruction at any of these PCs, see
+        # add_breakpoint
+        self.breakpoints = set()
+        # execution stops after a store into any of these (address, size)
+        # ranges, watch_hit is the first watched byte written, see
+        # add_watchpoint
+        self.watchpoints = set()
+        self.watch_hit = None
+        # code_pages that are only there for a watchpoint
+        self.watch_pages = set()
 
-    def run(self):
-        inst_count = 0
-        while True:
-            self.logger.set_pc(self.pc)
-            inst = self._instruction_fetch()
-            self.logger.set_inst(inst)
-            inst = hex_to_bin(inst)
-            inst_metadata, inst_fields = self._instruction_decode(inst)
-
-            reg_id = bin_to_int(inst[12:17])
-            self.logger.set_reg(
-                "rs1", reg_id, self.register_file.registers[reg_id].getVal()
-            )
-            reg_id = bin_to_int(inst[7:12])
-            self.logger.set_reg(
-                "rs2", reg_id, self.register_file.registers[reg_id].getVal()
-            )
+    @classmethod
+    def from_checkpoint(cls, path, **kwargs):
+        pc, registers, ebreak, inst_count, segments, syscall_state, device_state = (
+            read_checkpoint(path)
+        )
+        simulator = cls(pc, segments, **kwargs)
+        simulator.registers[:] = registers
+        simulator.ebreak = ebreak
+        simulator.inst_count = inst_count
+        if simulator.syscalls is not None and syscall_state:
+            # the break, stdin position, open files and pending output of
+            # the checkpointed run
+            unpack_syscalls(simulator.syscalls, syscall_state)
+        # input positions, pending output and registers of the devices
+        unpack_devices(simulator.memory.bus.devices, device_state)
+        return simulator
+
+    def save_checkpoint(self, path):
+        # pc, registers, ebreak, every allocated memory page and the
+        # SyscallEmulator and device states, caches and translated blocks are
+        # rebuilt by the resumed run
+        syscall_state = b"" if self.syscalls is None else pack_syscalls(self.syscalls)
+        device_state = pack_devices(self.memory.bus.devices)
+        write_checkpoint(
+            path,
+            self.pc,
+            self.registers,
+            self.ebreak,
+            self.inst_count,
+            self.memory.pages,
+            syscall_state,
+            device_state,
+        )
 
-            self._execute(inst_metadata[0], inst_fields)
+    def run(self, max_count=None):
+        # runs until EBREAK, a breakpoint or until inst_count reaches
+        # max_count, returns the instructions retired by this call,
+        # inst_count keeps the total since the program entry
+        start = self.inst_count
+        every = self.checkpoint_every
+        try:
+            # a budget inst_count already reached runs nothing
+            while not self.ebreak and (max_count is None or self.inst_count < max_count):
+                checkpoint = None
+                hash_point = None
+                stop = max_count
+                if every:
+                    checkpoint = (self.inst_count // every + 1) * every
+                    if stop is None or checkpoint < stop:
+                        stop = checkpoint
+                if self.hash_every:
+                    hash_point = (self.inst_count // self.hash_every + 1) * self.hash_every
+                    if stop is None or hash_point < stop:
+                        stop = hash_point
+                if self.engine == "translator":
+                    self._run_blocks(stop)
+                else:
+                    self._run_interpreter(stop)
+                if self.ecall:
+                    self.ecall = self.ebreak = False
+                    self.syscalls.call(self)
+                if self.watch_hit is not None:
+                    # the run loops stopped like on EBREAK, see _invalidate_code
+                    self.ebreak = False
+                    break
+                if self.inst_count == checkpoint:
+                    self.save_checkpoint(self.checkpoint_file.format(count=checkpoint))
+                if self.inst_count == hash_point:
+                    self.write_state_hash()
+            if self.ebreak and self.hash_every:
+                self.write_state_hash()
+        except BreakpointHit:
+            pass
+        finally:
+            self.logger.flush()
+            if self.syscalls is not None:
+                self.syscalls.flush()
+            self.memory.bus.flush()
+        return self.inst_count - start
 
-            reg_id = bin_to_int(inst[20:25])
-            self.logger.set_reg(
-                "rd", reg_id, self.register_file.registers[reg_id].getVal()
+    def write_state_hash(self):
+        # one record per retired instruction count, the final one may fall
+        # on an interval boundary
+        if self.hashed_count != self.inst_count:
+            self.hashed_count = self.inst_count
+            memory = self.memory
+            digest = state_digest(
+                self.pc, self.registers, memory.pages, self.page_digests, memory.dirty_pages
             )
+            write_record(self.hash_file, self.inst_count, self.pc, digest)
+
+    def fast_forward(self, pc=None, count=None):
+        # runs with tracing, profiling and the pipeline model off until pc
+        # is reached or inst_count reaches count, returns the instructions
+        # retired
+        level, profiler = self.logger.level, self.profiler
+        consumers = self.logger.consumers
+        self.logger.level, self.profiler = "off", None
+        self.logger.consumers = []
+        if pc is not None:
+            self.add_breakpoint(pc)
+        try:
+            return self.run(count)
+        finally:
+            if pc is not None:
+                self.remove_breakpoint(pc)
+            self.logger.level, self.profiler = level, profiler
+            self.logger.consumers = consumers
+            # translated blocks were built without tracing and profiling
+            self.block_cache.clear()
+            self.block_map.clear()
+            self.block_hotness.clear()
+            # caches stay warm, only the window after this is reported
+            if self.cache is not None:
+                self.cache.reset_stats()
+
+    def share_memory(self, other):
+        # runs this hart on the memory of other, stores of any of the harts
+        # drop the code the others decoded or translated from those bytes,
+        # called before this hart runs
+        self.memory.pages = other.memory.pages
+        self.memory.bus = other.memory.bus
+        self.code_pages = other.code_pages
+        self.watch_pages = other.watch_pages
+        self.harts = other.harts
+        self.harts.append(self)
+
+    def add_breakpoint(self, pc):
+        # decoded and translated copies of the instruction are dropped so
+        # execution gets to _instruction_lookup, which raises BreakpointHit
+        self.breakpoints.add(pc)
+        self._invalidate_code(pc, 4)
+
+    def remove_breakpoint(self, pc):
+        self.breakpoints.discard(pc)
 
-            self.logger.log()
-            inst_count += 1
-            self.pc = self.next_pc if self.next_pc != None else self.pc + 4
+    def add_watchpoint(self, addr, size):
+        # stores reach _invalidate_code only on code_pages, so the watched
+        # pages join them until no watchpoint is left there and stores
+        # elsewhere keep their cost
+        self.watchpoints.add((addr, size))
+        for page in self._watched_pages([(addr, size)]) - self.code_pages:
+            self.code_pages.add(page)
+            self.watch_pages.add(page)
+
+    def remove_watchpoint(self, addr, size):
+        self.watchpoints.discard((addr, size))
+        watched = self._watched_pages(
+            watchpoint for hart in self.harts for watchpoint in hart.watchpoints
+        )
+        for page in self.watch_pages - watched:
+            self.code_pages.discard(page)
+            self.watch_pages.discard(page)
+
+    def _watched_pages(self, watchpoints):
+        return {
+            page
+            for addr, size in watchpoints
+            for page in range(addr >> PAGE_BITS, ((addr + size - 1) >> PAGE_BITS) + 1)
+        }
+
+    def _run_interpreter(self, stop=None):
+        # runs until EBREAK or until inst_count reaches stop
+        record = self.logger.record if self.logger.active() else None
+        if record is None and self.fusion and self.cache is None:
+            # the loops below only run the instruction left before stop
+            if self.profiler is None:
+                self._run_fused(stop)
+            else:
+                self._run_fused_profiled(stop)
+            if self.ebreak or self.inst_count == stop:
+                return
+        if self.profiler is not None or self.cache is not None:
+            return self._run_instrumented(stop)
+        inst_count = self.inst_count
+        registers = self.registers
+        decode_cache = self.decode_cache
+        try:
+            while True:
+                entry = decode_cache.get(self.pc)
+                if entry is None:
+                    entry = self._instruction_lookup(self.pc)
+                if record is None:
+                    entry[0](entry[1])
+                else:
+                    rs1_id, rs2_id, rd_id = entry[2]
+                    rs1_value = registers[rs1_id]
+                    rs2_value = registers[rs2_id]
+                    entry[0](entry[1])
+                    record(entry, rs1_value, rs2_value, registers[rd_id])
+                inst_count += 1
+                if self.next_pc is None:
+                    self.pc += 4
+                else:
+                    self.pc = self.next_pc
+                    self.next_pc = None
+                if self.ebreak or inst_count == stop:
+                    break
+        finally:
+            self.inst_count = inst_count
+
+    def _run_fused(self, stop=None):
+        # untraced _run_interpreter on fused_cache, fused handlers run both
+        # instructions, set next_pc and return 2, the others return None
+        # it stops one instruction before stop so a pair never crosses it
+        inst_count = self.inst_count
+        fused_cache = self.fused_cache
+        last = sys.maxsize if stop is None else stop - 1
+        if inst_count >= last:
+            return
+        try:
+            while True:
+                entry = fused_cache.get(self.pc)
+                if entry is None:
+                    entry = self._fused_lookup(self.pc)
+                inst_count += entry[0](entry[1]) or 1
+                if self.next_pc is None:
+                    self.pc += 4
+                else:
+                    self.pc = self.next_pc
+                    self.next_pc = None
+                if self.ebreak or inst_count >= last:
+                    break
+        finally:
+            self.inst_count = inst_count
+
+    def _run_fused_profiled(self, stop=None):
+        # _run_fused handing the straight-line runs to the profiler like
+        # _run_instrumented, a fused pair belongs to the run and only ends it
+        # at its second instruction when it transfers control
+        inst_count = self.inst_count
+        fused_cache = self.fused_cache
+        profiler = self.profiler
+        runs = profiler.runs
+        ends = profiler.ends
+        text_base = profiler.text_base
+        size = profiler.size
+        last_count = sys.maxsize if stop is None else stop - 1
+        if inst_count >= last_count:
+            return
+        run_start = self.pc
+        try:
+            while True:
+                pc = self.pc
+                entry = fused_cache.get(pc)
+                if entry is None:
+                    entry = self._fused_lookup(pc)
+                retired = entry[0](entry[1])
+                if self.next_pc is None:
+                    inst_count += 1
+                    self.pc = pc + 4
+                else:
+                    next_pc = self.next_pc
+                    self.next_pc = None
+                    self.pc = next_pc
+                    if retired is None:
+                        inst_count += 1
+                    else:
+                        inst_count += retired
+                        pc += 4
+                    if retired is None or next_pc != pc + 4:
+                        # a straight-line run starting and ending in the text
+                        # segment lies in it
+                        first = (run_start - text_base) >> 2
+                        last = (pc - text_base) >> 2
+                        if first >= 0 and last < size:
+                            runs[first] += 1
+                            ends[last] += 1
+                        else:
+                            profiler.count_run(run_start, pc)
+                            profiler.count_taken(pc)
+                        run_start = next_pc
+                if self.ebreak or inst_count >= last_count:
+                    break
+        finally:
+            # the run in progress, also when a fault stopped it
+            executed = self.pc if self.next_pc is None else self.pc + 4
+            if executed != run_start:
+                profiler.count_run(run_start, executed - 4)
+            self.inst_count = inst_count
+
+    def _run_instrumented(self, stop=None):
+        # _run_interpreter handing each straight-line run of instructions to
+        # the profiler when control leaves it, it adds runs inside the text
+        # segment to a difference array (see Profiler.collect), the
+        # instruction cache is accessed when the fetched line changes
+        inst_count = self.inst_count
+        registers = self.registers
+        decode_cache = self.decode_cache
+        record = self.logger.record if self.logger.active() else None
+        profiler = self.profiler
+        if profiler is not None:
+            runs = profiler.runs
+            ends = profiler.ends
+            text_base = profiler.text_base
+            size = profiler.size
+        cache = self.cache
+        if cache is not None:
+            fetch = cache.fetch
+            line_bits = cache.l1i.line_bits
+        fetch_line = None
+        fetches = 0
+        run_start = self.pc
+        try:
+            while True:
+                entry = decode_cache.get(self.pc)
+                if entry is None:
+                    entry = self._instruction_lookup(self.pc)
+                if cache is not None and self.pc >> line_bits != fetch_line:
+                    fetch_line = self.pc >> line_bits
+                    fetch(fetch_line)
+                    fetches += 1
+                if record is None:
+                    entry[0](entry[1])
+                else:
+                    rs1_id, rs2_id, rd_id = entry[2]
+                    rs1_value = registers[rs1_id]
+                    rs2_value = registers[rs2_id]
+                    entry[0](entry[1])
+                    record(entry, rs1_value, rs2_value, registers[rd_id])
+                inst_count += 1
+                if self.next_pc is None:
+                    self.pc += 4
+                else:
+                    pc = self.pc
+                    if profiler is not None:
+                        first = (run_start - text_base) >> 2
+                        last = (pc - text_base) >> 2
+                        if 0 <= first <= last < size:
+                            runs[first] += 1
+                            ends[last] += 1
+                        else:
+                            profiler.count_run(run_start, pc)
+                            profiler.count_taken(pc)
+                    self.pc = run_start = self.next_pc
+                    self.next_pc = None
+                if self.ebreak or inst_count == stop:
+                    break
+        finally:
+            # the run in progress, also when a fault stopped it
+            executed = self.pc if self.next_pc is None else self.pc + 4
+            if executed != run_start and profiler is not None:
+                profiler.count_run(run_start, executed - 4)
+            if cache is not None and inst_count - self.inst_count > fetches:
+                # the other retired instructions hit the line fetched before
+                cache.fetch_repeat(inst_count - self.inst_count - fetches)
+            self.inst_count = inst_count
+
+    def _run_blocks(self, stop=None):
+        # code is interpreted until its entry point was reached hot_threshold
+        # times, only then it is worth paying for the translation
+        inst_count = self.inst_count
+        block_cache = self.block_cache
+        hotness = self.block_hotness
+        traced = self.logger.active()
+        max_block_size = self.translator.max_block_size
+        # looping blocks give control back once they retired budget
+        # instructions, a block never retires more than max_block_size past it
+        budget = sys.maxsize
+        try:
+            while not self.ebreak and inst_count != stop:
+                if stop is not None:
+                    budget = stop - inst_count - max_block_size
+                    if budget < 0:
+                        inst_count += self._interpret_block(stop - inst_count)
+                        continue
+                block = block_cache.get(self.pc)
+                if block is None:
+                    hits = hotness.get(self.pc, 0) + 1
+                    if hits < self.hot_threshold:
+                        hotness[self.pc] = hits
+                        inst_count += self._interpret_block()
+                        continue
+                    block = self._translate(self.pc, traced)
+                self.pc, count = block(budget)
+                inst_count += count
+        except BreakpointHit as hit:
+            inst_count += hit.retired
+            raise
+        finally:
+            self.inst_count = inst_count
+
+    def _interpret_block(self, limit=None):
+        # runs instructions from pc up to the next control transfer, at most
+        # limit of them
+        registers = self.registers
+        decode_cache = self.decode_cache
+        record = self.logger.record if self.logger.active() else None
+        profiler = self.profiler
+        cache = self.cache
+        if limit is None:
+            limit = self.translator.max_block_size
+        if limit <= 0:
+            return 0
+        for count in range(1, limit + 1):
+            entry = decode_cache.get(self.pc)
+            if entry is None:
+                try:
+                    entry = self._instruction_lookup(self.pc)
+                except BreakpointHit as hit:
+                    hit.retired = count - 1
+                    raise
+            if profiler is not None:
+                profiler.count(self.pc)
+            if cache is not None:
+                cache.fetch(self.pc >> cache.l1i.line_bits)
+            if record is None:
+                entry[0](entry[1])
+            else:
+                rs1_id, rs2_id, rd_id = entry[2]
+                rs1_value = registers[rs1_id]
+                rs2_value = registers[rs2_id]
+                entry[0](entry[1])
+                record(entry, rs1_value, rs2_value, registers[rd_id])
+            if self.next_pc is not None:
+                if profiler is not None:
+                    profiler.count_taken(self.pc)
+                self.pc = self.next_pc
+                self.next_pc = None
+                break
+            self.pc += 4
             if self.ebreak:
                 break
-            self.next_pc = None
-        return inst_count
+        return count
+
+    def _translate(self, pc, traced):
+        block, addresses = self.translator.translate(pc, traced)
+        self.block_cache[pc] = block
+        self.block_hotness.pop(pc, None)
+        for addr in addresses:
+            self.block_map.setdefault(addr, set()).add(pc)
+        return block
+
+    def _instruction_lookup(self, pc):
+        # predecoded instructions are cached by PC, stores into a cached
+        # address drop the entry (see _invalidate_code)
+        # entry: (handler, fields, (rs1, rs2, rd) ids, pc, instruction, name)
+        # breakpoints are never cached so reaching one always ends up here
+        if pc in self.breakpoints:
+            raise BreakpointHit(pc)
+        inst = self._instruction_fetch(pc)
+        inst_metadata, inst_fields = self._instruction_decode(inst)
+        reg_ids = ((inst >> 15) & 0x1F, (inst >> 20) & 0x1F, (inst >> 7) & 0x1F)
+        entry = (inst_metadata[2], inst_fields, reg_ids, pc, inst, inst_metadata[0])
+        self.decode_cache[pc] = entry
+        # the previous page is marked too, an unaligned store at its end
+        # can reach the first instruction of this one
+        page = pc >> PAGE_BITS
+        self.code_pages.update((page, page - 1))
+        if self.watch_pages:
+            self.watch_pages.difference_update((page, page - 1))
+        return entry
+
+    def _fused_lookup(self, pc):
+        # fused_cache entry: the fused operation when the instructions at pc
+        # and pc + 4 are one of Decoder.fusion_pairs, the decode_cache entry
+        # otherwise, a pair never spans a breakpoint
+        entry = self.decode_cache.get(pc)
+        if entry is None:
+            entry = self._instruction_lookup(pc)
+        second_pc = (pc + 4) & MASK
+        if entry[5] in self.decoder.fusion_pairs and second_pc not in self.breakpoints:
+            second = self.decode_cache.get(second_pc)
+            if second is None:
+                try:
+                    second = self._instruction_lookup(second_pc)
+                except KeyError:
+                    # not an instruction, reported when it is reached
+                    second = None
+            fused = second is not None and self.decoder.fuse(pc, entry, second)
+            if fused:
+                handler, fields = fused
+                name = f"{entry[5]}+{second[5]}"
+                entry = (handler, fields, entry[2], pc, entry[4], name)
+        self.fused_cache[pc] = entry
+        return entry
 
-    def _instruction_fetch(self):
-        inst, _ = self.memory.get_word(self.pc)
-        return inst
+    def _invalidate_code(self, addr, size, watch=True):
+        # drops decoded instructions and translated blocks overlapping the
+        # written bytes in every hart sharing the memory, returns whether
+        # anything was dropped or the write hit a watchpoint, which sets
+        # watch_hit and stops the run loops after the store
+        dropped = False
+        if watch and self.watchpoints:
+            for start, length in self.watchpoints:
+                if start < addr + size and addr < start + length:
+                    self.watch_hit = max(addr, start)
+                    self.ebreak = dropped = True
+                    break
+        for hart in self.harts:
+            for pc in range(addr & ~3, addr + size, 4):
+                if hart.decode_cache.pop(pc, None) is not None:
+                    dropped = True
+                # a fused pair starts at pc or at the instruction before it
+                hart.fused_cache.pop(pc, None)
+                hart.fused_cache.pop(pc - 4, None)
+                for start in hart.block_map.pop(pc, ()):
+                    if hart.block_cache.pop(start, None) is not None:
+                        dropped = True
+        return dropped
+
+    def mnemonic(self, pc):
+        # name of the instruction at pc, used to label profiler counts
+        entry = self.decode_cache.get(pc)
+        if entry is not None:
+            return entry[5]
+        try:
+            return self._instruction_decode(self._instruction_fetch(pc))[0][0]
+        except KeyError:
+            return "UNKNOWN"
+
+    def _instruction_fetch(self, pc):
+        # untimed, the run loops charge the instruction cache
+        return int.from_bytes(self.memory.read(pc, 4), "little")
 
     def _instruction_decode(self, inst):
         return self.decoder.decode(inst)
 
-    def _execute(self, inst, inst_fields):
-        inst_method = getattr(self, "_" + inst)
-        inst_method(inst_fields)
-
     # Operations
     def _LUI(self, inst_fields):
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(inst_fields["imm"])
-        self.logger.set_inst_disassembly(f"{'LUI':>8} {self.logger.registers[inst_fields['rd']]},0x{np.uint32(inst_fields['imm']) >> 12:X}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = inst_fields["imm"] & MASK
 
     def _AUIPC(self, inst_fields):
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(inst_fields["imm"] + self.pc)
-        self.logger.set_inst_disassembly(f"{'AUIPC':>8} {self.logger.registers[inst_fields['rd']]},0x{np.uint32(inst_fields['imm']) >> 12:X}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (inst_fields["imm"] + self.pc) & MASK
 
     def _JAL(self, inst_fields):
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(self.pc + 4)
-        self.next_pc = self.pc + inst_fields["imm"]
-        self.logger.set_inst_disassembly(f"{'JAL':>8} {self.logger.registers[inst_fields['rd']]},0x{self.next_pc:X}")
+        regs = self.registers
+        self.next_pc = (self.pc + inst_fields["imm"]) & MASK
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (self.pc + 4) & MASK
 
     def _JALR(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(self.pc + 4)
-        self.next_pc = np.uint32(rs1.getVal()) + inst_fields["imm"]
-        self.logger.set_inst_disassembly(f"{'JALR':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        self.next_pc = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & 0xFFFFFFFE
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (self.pc + 4) & MASK
 
     def _BEQ(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if rs1.getVal() == rs2.getVal():
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] == regs[inst_fields["rs2"]]:
             self.next_pc = next_pc
-        self.logger.set_inst_disassembly(f"{'BEQ':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
 
     def _BNE(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if rs1.getVal() != rs2.getVal():
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] != regs[inst_fields["rs2"]]:
             self.next_pc = next_pc
-        self.logger.set_inst_disassembly(f"{'BNE':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
 
     def _BLT(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if rs1.getVal() < rs2.getVal():
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] ^ SIGN < regs[inst_fields["rs2"]] ^ SIGN:
             self.next_pc = next_pc
-        self.logger.set_inst_disassembly(f"{'BEQ':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
 
     def _BGE(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if rs1.getVal() >= rs2.getVal():
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] ^ SIGN >= regs[inst_fields["rs2"]] ^ SIGN:
             self.next_pc = next_pc
-        self.logger.set_inst_disassembly(f"{'BGE':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
 
     def _BLTU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if np.uint32(rs1.getVal()) < np.uint32(rs2.getVal()):
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] < regs[inst_fields["rs2"]]:
             self.next_pc = next_pc
-        self.logger.set_inst_disassembly(f"{'BLTU':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
 
     def _BGEU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        next_pc = self.pc + inst_fields["imm"]
-        if np.uint32(rs1.getVal()) >= np.uint32(rs2.getVal()):
-            self.next_pc = self.pc + inst_fields["imm"]
-        self.logger.set_inst_disassembly(f"{'BGEU':>8} {self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]},0x{next_pc:X}")
+        regs = self.registers
+        next_pc = (self.pc + inst_fields["imm"]) & MASK
+        if regs[inst_fields["rs1"]] >= regs[inst_fields["rs2"]]:
+            self.next_pc = next_pc
 
     def _LB(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        addr = rs1.getVal() + inst_fields["imm"]
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
         value, _ = self.memory.get_byte(addr)
-        if value[0] in self.extend_sign:
-            value = "F" * 12 + value
-        rd.setVal(hex_to_int(value))
-        self.logger.set_inst_disassembly(f"{'LB':>8} {self.logger.registers[inst_fields['rd']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        if value & 0x80:
+            value |= 0xFFFFFF00
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = value
 
     def _LH(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        addr = rs1.getVal() + inst_fields["imm"]
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
         value, _ = self.memory.get_halfword(addr)
-        if value[0] in self.extend_sign:
-            value = "F" * 8 + value
-        rd.setVal(hex_to_int(value))
-        self.logger.set_inst_disassembly(f"{'LH':>8} {self.logger.registers[inst_fields['rd']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        if value & 0x8000:
+            value |= 0xFFFF0000
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = value
 
     def _LW(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        value = hex_to_int(self.memory.get_word(addr)[0])
-        rd.setVal(value)
-        self.logger.set_inst_disassembly(f"{'LW':>8} {self.logger.registers[inst_fields['rd']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        value, _ = self.memory.get_word(addr)
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = value
 
     def _LBU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        value = hex_to_int(self.memory.get_byte(addr)[0])
-        rd.setVal(value)
-        self.logger.set_inst_disassembly(f"{'LBU':>8} {self.logger.registers[inst_fields['rd']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        value, _ = self.memory.get_byte(addr)
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = value
 
     def _LHU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        value = hex_to_int(self.memory.get_halfword(addr)[0])
-        rd.setVal(value)
-        self.logger.set_inst_disassembly(f"{'LHU':>8} {self.logger.registers[inst_fields['rd']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        value, _ = self.memory.get_halfword(addr)
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = value
+
+    def _marking_store(self, store, size):
+        # store handler that also adds the pages it writes to dirty_pages
+        regs = self.registers
+        dirty_pages = self.memory.dirty_pages
+
+        def handler(inst_fields):
+            store(inst_fields)
+            addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+            dirty_pages.add(addr >> PAGE_BITS)
+            dirty_pages.add(((addr + size - 1) & MASK) >> PAGE_BITS)
+
+        return handler
+
+    def _recording_load(self, name):
+        # load handler that also passes the value read to Logger.record_load
+        _, _, method, sign = BlockTranslator.loads[name]
+        regs = self.registers
+        get = getattr(self.memory, method)
+
+        def handler(inst_fields):
+            addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+            value, _ = get(addr)
+            self.logger.record_load(value)
+            if sign is not None and value & sign[0]:
+                value |= sign[1]
+            rd = inst_fields["rd"]
+            if rd:
+                regs[rd] = value
+
+        return handler
 
     def _SB(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        self.memory.set_byte(addr, rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SB':>8} {self.logger.registers[inst_fields['rs2']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        self.memory.set_byte(addr, regs[inst_fields["rs2"]])
+        if addr >> PAGE_BITS in self.code_pages:
+            self._invalidate_code(addr, 1)
 
     def _SH(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        self.memory.set_halfword(addr, rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SH':>8} {self.logger.registers[inst_fields['rs2']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        self.memory.set_halfword(addr, regs[inst_fields["rs2"]])
+        if addr >> PAGE_BITS in self.code_pages:
+            self._invalidate_code(addr, 2)
 
     def _SW(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        addr = rs1.getVal() + inst_fields["imm"]
-        self.memory.set_word(addr, rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SW':>8} {self.logger.registers[inst_fields['rs2']]},{inst_fields['imm']}({self.logger.registers[inst_fields['rs1']]})")
+        regs = self.registers
+        addr = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
+        self.memory.set_word(addr, regs[inst_fields["rs2"]])
+        if addr >> PAGE_BITS in self.code_pages:
+            self._invalidate_code(addr, 4)
 
     def _ADDI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() + inst_fields["imm"])
-        self.logger.set_inst_disassembly(f"{'ADDI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (regs[inst_fields["rs1"]] + inst_fields["imm"]) & MASK
 
     def _SLTI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(1 if rs1.getVal() < inst_fields["imm"] else 0)
-        self.logger.set_inst_disassembly(f"{'SLTI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = 1 if to_signed(regs[inst_fields["rs1"]]) < inst_fields["imm"] else 0
 
     def _SLTIU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(1 if np.uint32(rs1.getVal()) < np.uint32(inst_fields["imm"]) else 0)
-        self.logger.set_inst_disassembly(f"{'SLTIU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{np.uint32(inst_fields['imm'])}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = 1 if regs[inst_fields["rs1"]] < inst_fields["imm"] & MASK else 0
 
     def _XORI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() ^ inst_fields["imm"])
-        self.logger.set_inst_disassembly(f"{'XORI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (regs[inst_fields["rs1"]] ^ inst_fields["imm"]) & MASK
 
     def _ORI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() | inst_fields["imm"])
-        self.logger.set_inst_disassembly(f"{'ORI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (regs[inst_fields["rs1"]] | inst_fields["imm"]) & MASK
 
     def _ANDI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() & inst_fields["imm"])
-        self.logger.set_inst_disassembly(f"{'ANDI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{inst_fields['imm']}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = regs[inst_fields["rs1"]] & inst_fields["imm"] & MASK
 
     def _SLLI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
+        regs = self.registers
         shamt = inst_fields["rs2"]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() << shamt)
-        self.logger.set_inst_disassembly(f"{'SLLI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},0x{shamt:X}")
-
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (regs[inst_fields["rs1"]] << shamt) & MASK
 
     def _SRLI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
+        regs = self.registers
         shamt = inst_fields["rs2"]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(np.uint32(rs1.getVal()) >> shamt)
-        self.logger.set_inst_disassembly(f"{'SRLI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},0x{shamt:X}")
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = regs[inst_fields["rs1"]] >> shamt
 
     def _SRAI(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
+        regs = self.registers
         shamt = inst_fields["rs2"]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() >> shamt)
-        self.logger.set_inst_disassembly(f"{'SRAI':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},0x{shamt:X}")
+        rd = inst_fields["rd"]
+        if rd:
+            regs[rd] = (to_signed(regs[inst_fields["rs1"]]) >> shamt) & MASK
 
     def _ADD(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() + rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'ADD':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (rs1 + rs2) & MASK
 
     def _SUB(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() - rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SUB':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (rs1 - rs2) & MASK
 
     def _SLT(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(1 if rs1.getVal() < rs2.getVal() else 0)
-        self.logger.set_inst_disassembly(f"{'SLT':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = 1 if rs1 ^ SIGN < rs2 ^ SIGN else 0
 
     def _SLTU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(1 if np.uint32(rs1.getVal()) < np.uint32(rs2.getVal()) else 0)
-        self.logger.set_inst_disassembly(f"{'SLTU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = 1 if rs1 < rs2 else 0
 
     def _SLL(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() << rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SLL':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (rs1 << (rs2 & 0x1F)) & MASK
 
     def _SRL(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(np.uint32(rs1.getVal()) >> rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SRL':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 >> (rs2 & 0x1F)
 
     def _SRA(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() >> rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'SRA':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (to_signed(rs1) >> (rs2 & 0x1F)) & MASK
 
     def _XOR(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() ^ rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'XOR':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 ^ rs2
 
     def _OR(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() | rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'OR':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 | rs2
 
     def _AND(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() & rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'AND':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 & rs2
+
+    # Fused operations (see Decoder.fuse), both instructions of the pair
+    def _LUI_ADDI(self, inst_fields):
+        self.registers[inst_fields["rd"]] = inst_fields["value"]
+        self.next_pc = inst_fields["next_pc"]
+        return 2
+
+    def _AUIPC_JALR(self, inst_fields):
+        regs = self.registers
+        regs[inst_fields["rd"]] = inst_fields["value"]
+        rd = inst_fields["second_rd"]
+        if rd:
+            regs[rd] = inst_fields["link"]
+        self.next_pc = inst_fields["target"]
+        return 2
+
+    def _AUIPC_LW(self, inst_fields):
+        regs = self.registers
+        regs[inst_fields["rd"]] = inst_fields["value"]
+        value, _ = self.memory.get_word(inst_fields["addr"])
+        rd = inst_fields["second_rd"]
+        if rd:
+            regs[rd] = value
+        self.next_pc = inst_fields["next_pc"]
+        return 2
+
+    def _SLT_BRANCH(self, inst_fields):
+        regs = self.registers
+        rs1 = regs[inst_fields["rs1"]]
+        rs2 = regs[inst_fields["rs2"]]
+        result = 1 if rs1 ^ SIGN < rs2 ^ SIGN else 0
+        regs[inst_fields["rd"]] = result
+        if result == inst_fields["taken"]:
+            self.next_pc = inst_fields["target"]
+        else:
+            self.next_pc = inst_fields["next_pc"]
+        return 2
+
+    def _SLTU_BRANCH(self, inst_fields):
+        regs = self.registers
+        result = 1 if regs[inst_fields["rs1"]] < regs[inst_fields["rs2"]] else 0
+        regs[inst_fields["rd"]] = result
+        if result == inst_fields["taken"]:
+            self.next_pc = inst_fields["target"]
+        else:
+            self.next_pc = inst_fields["next_pc"]
+        return 2
 
     def _FENCE(self, inst_fields):
-        self.logger.set_inst_disassembly(f"{'FENCE':>8}")
+        pass
 
     def _ECALL(self, inst_fields):
-        self.logger.set_inst_disassembly(f"{'ECALL':>8}")
+        if self.syscalls is not None:
+            self.ecall = self.ebreak = True
 
     def _EBREAK(self, inst_fields):
         self.ebreak = True
-        self.logger.set_inst_disassembly(f"{'EBREAK':>8}")
+
+    def _csr_access(self, inst_fields, write):
+        # every CSR is read-only, a write is an illegal instruction
+        csr = inst_fields["csr"]
+        if csr not in self.csrs:
+            raise ValueError(f"unsupported CSR 0x{csr:03X} at PC={self.pc:08X}")
+        if write:
+            raise ValueError(f"write to read-only CSR 0x{csr:03X} at PC={self.pc:08X}")
+        rd = inst_fields["rd"]
+        if rd:
+            self.registers[rd] = self.csrs[csr]
+
+    def _CSRRW(self, inst_fields):
+        self._csr_access(inst_fields, True)
+
+    def _CSRRS(self, inst_fields):
+        self._csr_access(inst_fields, inst_fields["rs1"] != 0)
+
+    def _CSRRC(self, inst_fields):
+        self._csr_access(inst_fields, inst_fields["rs1"] != 0)
+
+    def _CSRRWI(self, inst_fields):
+        self._csr_access(inst_fields, True)
+
+    def _CSRRSI(self, inst_fields):
+        self._csr_access(inst_fields, inst_fields["rs1"] != 0)
+
+    def _CSRRCI(self, inst_fields):
+        self._csr_access(inst_fields, inst_fields["rs1"] != 0)
 
     def _MUL(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() * rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'MUL':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (rs1 * rs2) & MASK
 
     def _MULH(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal((np.int64(rs1.getVal()) * np.int64(rs2.getVal())) >> 32)
-        self.logger.set_inst_disassembly(f"{'MULH':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = ((to_signed(rs1) * to_signed(rs2)) >> 32) & MASK
 
     def _MULHSU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal((np.int64(rs1.getVal()) * np.uint64(np.uint32(rs2.getVal()))) >> 32)
-        self.logger.set_inst_disassembly(f"{'MULHSU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = ((to_signed(rs1) * rs2) >> 32) & MASK
 
     def _MULHU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(
-            (np.uint64(np.uint32(rs1.getVal())) * np.uint64(np.uint32(rs2.getVal())))
-            >> np.uint32(32)
-        )
-        self.logger.set_inst_disassembly(f"{'MULHU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = (rs1 * rs2) >> 32
 
     def _DIV(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() / rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'DIV':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = div_signed(rs1, rs2)
 
     def _DIVU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(np.uint32(rs1.getVal()) // np.uint32(rs2.getVal()))
-        self.logger.set_inst_disassembly(f"{'DIVU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 // rs2 if rs2 else MASK
 
     def _REM(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(rs1.getVal() % rs2.getVal())
-        self.logger.set_inst_disassembly(f"{'REM':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rem_signed(rs1, rs2)
 
     def _REMU(self, inst_fields):
-        rs1 = self.register_file.registers[inst_fields["rs1"]]
-        rs2 = self.register_file.registers[inst_fields["rs2"]]
-        rd = self.register_file.registers[inst_fields["rd"]]
-        rd.setVal(np.uint32(rs1.getVal()) % np.uint32(rs2.getVal()))
-        self.logger.set_inst_disassembly(f"{'REMU':>8} {self.logger.registers[inst_fields['rd']]},{self.logger.registers[inst_fields['rs1']]},{self.logger.registers[inst_fields['rs2']]}")
+        regs = self.registers
+        rd = inst_fields["rd"]
+        if rd:
+            rs1 = regs[inst_fields["rs1"]]
+            rs2 = regs[inst_fields["rs2"]]
+            regs[rd] = rs1 % rs2 if rs2 else rs1
@@ -0,0 +1,37 @@
+import argparse
+from glob import glob
+
+from logger.trace import TraceReader, write_text
+
+
+def convert_file(trace_path, level):
+    # test.trace -> test.log, or test.hart<i>.trace -> test.hart<i>.log
+    with open(f"{trace_path[:-len('.trace')]}.log", "w") as log:
+        reader = TraceReader(trace_path)
+        try:
+            write_text(reader, log, level)
+        finally:
+            reader.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "files",
+        help="binary traces to convert, if not set will convert every test/*.trace",
+        type=str,
+        nargs="*",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--spike",
+        help="write the commit format compared with spike by cmp_logs.py (no disassembly)",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    files = args.files or sorted(glob("test/*.trace"))
+    for trace_path in files:
+        convert_file(trace_path, "commit" if args.spike else "full")
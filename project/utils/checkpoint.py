@@ -0,0 +1,132 @@
+import mmap
+import os
+import struct
+
+from components.memory import PAGE_BITS, PAGE_SIZE
+
+# magic, version, ebreak, pc, page count, retired instructions, x0-x31,
+# sizes of the system call and device states, followed by the page numbers
+# and the pages themselves at page aligned offsets, so a mapped checkpoint
+# can be used without parsing it, and by the system call and device states
+CHECKPOINT_MAGIC = b"RVCP"
+CHECKPOINT_VERSION = 3
+HEADER = struct.Struct("<4sHHIIQ32III")
+# state of a SyscallEmulator: program break, stdin position, bit mask of
+# the open file descriptors, whether exit was called and its status, sizes
+# of the unflushed stdout and stderr, followed by those bytes
+SYSCALL_STATE = struct.Struct("<IQIBiII")
+# state of one memory-mapped device: its base and the size of the state
+# from its pack_state, followed by those bytes
+DEVICE_STATE = struct.Struct("<II")
+
+
+def _data_offset(page_count):
+    index_end = HEADER.size + 4 * page_count
+    return (index_end + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+
+def pack_syscalls(syscalls):
+    exit_code = syscalls.exit_code
+    stdout, stderr = syscalls.buffers[1], syscalls.buffers[2]
+    state = SYSCALL_STATE.pack(
+        syscalls.program_break,
+        syscalls.stdin_pos,
+        sum(1 << fd for fd in syscalls.open_fds),
+        exit_code is not None,
+        exit_code or 0,
+        len(stdout),
+        len(stderr),
+    )
+    return state + stdout + stderr
+
+
+def unpack_syscalls(syscalls, state):
+    program_break, stdin_pos, fds, exited, exit_code, stdout_size, stderr_size = (
+        SYSCALL_STATE.unpack_from(state)
+    )
+    syscalls.program_break = program_break
+    syscalls.stdin_pos = stdin_pos
+    syscalls.open_fds = {fd for fd in range(32) if fds >> fd & 1}
+    syscalls.exit_code = exit_code if exited else None
+    stdout_end = SYSCALL_STATE.size + stdout_size
+    syscalls.buffers[1][:] = state[SYSCALL_STATE.size : stdout_end]
+    syscalls.buffers[2][:] = state[stdout_end : stdout_end + stderr_size]
+
+
+def pack_devices(devices):
+    state = bytearray()
+    for device in devices:
+        device_state = device.pack_state()
+        state += DEVICE_STATE.pack(device.base, len(device_state)) + device_state
+    return bytes(state)
+
+
+def unpack_devices(devices, state):
+    # the states go to the devices at the same base
+    by_base = {device.base: device for device in devices}
+    offset = 0
+    while offset < len(state):
+        base, size = DEVICE_STATE.unpack_from(state, offset)
+        offset += DEVICE_STATE.size
+        if base not in by_base:
+            raise ValueError(f"the checkpoint has a device at {base:#x}, the run does not")
+        by_base[base].unpack_state(state[offset : offset + size])
+        offset += size
+
+
+def write_checkpoint(
+    path, pc, registers, ebreak, inst_count, pages, syscall_state=b"", device_state=b""
+):
+    # syscall_state comes from pack_syscalls and device_state from
+    # pack_devices, empty for runs without them
+    page_ids = sorted(pages)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(
+            HEADER.pack(
+                CHECKPOINT_MAGIC,
+                CHECKPOINT_VERSION,
+                int(ebreak),
+                pc,
+                len(page_ids),
+                inst_count,
+                *registers,
+                len(syscall_state),
+                len(device_state),
+            )
+        )
+        f.write(struct.pack(f"<{len(page_ids)}I", *page_ids))
+        f.write(bytes(_data_offset(len(page_ids)) - f.tell()))
+        for page_id in page_ids:
+            f.write(pages[page_id])
+        f.write(syscall_state)
+        f.write(device_state)
+    # a run killed while writing never leaves a truncated checkpoint behind
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    # returns (pc, registers, ebreak, inst_count, segments, syscall_state,
+    # device_state), segments are (address, buffer) pairs like the ones from
+    # program_load.read_file, the states are for unpack_syscalls and
+    # unpack_devices
+    with open(path, "rb") as f:
+        image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = HEADER.unpack_from(image, 0)
+    magic, version, ebreak, pc, page_count, inst_count = header[:6]
+    if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} is not a version {CHECKPOINT_VERSION} checkpoint")
+    page_ids = struct.unpack_from(f"<{page_count}I", image, HEADER.size)
+    view = memoryview(image)
+    offset = _data_offset(page_count)
+    segments = []
+    for i, page_id in enumerate(page_ids):
+        start = offset + i * PAGE_SIZE
+        segments.append((page_id << PAGE_BITS, view[start : start + PAGE_SIZE]))
+    state_start = offset + page_count * PAGE_SIZE
+    syscall_size, device_size = header[38:]
+    syscall_state = bytes(image[state_start : state_start + syscall_size])
+    device_start = state_start + syscall_size
+    device_state = bytes(image[device_start : device_start + device_size])
+    registers = list(header[6:38])
+    return pc, registers, bool(ebreak), inst_count, segments, syscall_state, device_state
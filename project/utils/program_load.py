@@ -1,19 +1,129 @@
+import mmap
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+ELF_HEADER = struct.Struct("<16sHHIIIIIHHHHHH")
+PROGRAM_HEADER = struct.Struct("<IIIIIIII")
+SECTION_HEADER = struct.Struct("<IIIIIIIIII")
+SYMBOL = struct.Struct("<IIIBBH")
+PT_LOAD = 1
+SHT_SYMTAB = 2
+SHN_LORESERVE = 0xFF00
+STT_SECTION = 3
+STT_FILE = 4
+
+
 def read_file(path):
-    content = {}
+    # returns the entry point and the memory image as a list of
+    # (address, buffer) segments, ELF files are detected by their magic
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic == ELF_MAGIC:
+        return read_elf(path)
+    return read_hex(path)
+
+
+def _map_elf(path):
+    with open(path, "rb") as f:
+        image = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header = ELF_HEADER.unpack_from(image, 0)
+    ident = header[0]
+    if ident[:4] != ELF_MAGIC or ident[4] != 1 or ident[5] != 1:
+        raise ValueError(f"{path} is not a little-endian ELF32 file")
+    return image, header
+
+
+def read_elf(path):
+    image, header = _map_elf(path)
+    entry, phoff = header[4], header[5]
+    phentsize, phnum = header[9], header[10]
+    view = memoryview(image)
+    segments = []
+    for i in range(phnum):
+        p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = PROGRAM_HEADER.unpack_from(
+            image, phoff + i * phentsize
+        )
+        # the memsz tail (.bss) is left out, unmapped memory already reads zero
+        if p_type == PT_LOAD and p_filesz:
+            segments.append((p_vaddr, view[p_offset : p_offset + p_filesz]))
+    return entry, segments
+
+
+def read_image_end(path):
+    # end of the memory image of an ELF file, the memsz tail (.bss)
+    # included, the heap of a program starts after it
+    with open(path, "rb") as f:
+        magic = f.read(4)
+    if magic != ELF_MAGIC:
+        raise ValueError(f"{path} is not an ELF file, the end of its .bss is unknown")
+    image, header = _map_elf(path)
+    phoff, phentsize, phnum = header[5], header[9], header[10]
+    end = 0
+    for i in range(phnum):
+        p_type, _, p_vaddr, _, _, p_memsz, _, _ = PROGRAM_HEADER.unpack_from(
+            image, phoff + i * phentsize
+        )
+        if p_type == PT_LOAD:
+            end = max(end, p_vaddr + p_memsz)
+    image.close()
+    return end
+
+
+def read_symbols(path):
+    # returns {name: (address, size)} from the ELF symbol table
+    image, header = _map_elf(path)
+    shoff, shentsize, shnum = header[6], header[11], header[12]
+    sections = [
+        SECTION_HEADER.unpack_from(image, shoff + i * shentsize) for i in range(shnum)
+    ]
+    symbols = {}
+    for section in sections:
+        if section[1] != SHT_SYMTAB:
+            continue
+        sym_offset, sym_size, str_section = section[4], section[5], sections[section[6]]
+        strtab = image[str_section[4] : str_section[4] + str_section[5]]
+        for offset in range(sym_offset, sym_offset + sym_size, SYMBOL.size):
+            st_name, st_value, st_size, st_info, _, st_shndx = SYMBOL.unpack_from(
+                image, offset
+            )
+            # skip undefined/absolute symbols, sections and files
+            if st_name == 0 or st_shndx == 0 or st_shndx >= SHN_LORESERVE:
+                continue
+            if st_info & 0xF in (STT_SECTION, STT_FILE):
+                continue
+            name = strtab[st_name : strtab.index(b"\0", st_name)].decode()
+            # mapping symbols ($x, $d) and assembler local labels
+            if name.startswith(("$", ".L")):
+                continue
+            symbols[name] = (st_value, st_size)
+    image.close()
+    return symbols
+
+
+def read_hex(path):
+    # Intel HEX image, consecutive records are merged into one segment
+    segments = []
     EOF = False
     base_addr = 0
     start_addr = 0
+    seg_addr = None
+    seg_data = None
     with open(path, "r") as f:
         while not EOF:
-            line = f.readline().strip()
+            line = f.readline()
+            if not line:
+                raise ValueError(f"{path} has no Intel HEX end of file record")
+            line = line.strip()
             r_type = line[7:9]
             if r_type == "00":
                 addr = int(line[3:7], 16) + base_addr
                 num_bytes = int(line[1:3], 16)
-                line = line[9:]
-                for start in range(num_bytes):
-                    content[addr] = line[start * 2 : (start + 1) * 2]
-                    addr += 1
+                data = bytes.fromhex(line[9 : 9 + num_bytes * 2])
+                if seg_data is None or seg_addr + len(seg_data) != addr:
+                    seg_addr = addr
+                    seg_data = bytearray()
+                    segments.append((seg_addr, seg_data))
+                seg_data += data
             elif r_type == "01":
                 EOF = True
             elif r_type == "02":
@@ -24,4 +134,4 @@ def read_file(path):
                 base_addr = int(line[9:13], 16) << 16
             elif r_type == "05":
                 start_addr = int(line[9:17], 16)
-    return start_addr, content
+    return start_addr, segments
@@ -0,0 +1,65 @@
+import hashlib
+import struct
+
+from components.memory import PAGE_SIZE
+
+# sidecar of a run: a header with the interval, then one line per hashed
+# state, "<retired instructions> <pc> <digest>"
+SIDECAR_HEADER = "# state hash every {every} instructions\n"
+STATE = struct.Struct("<I32I")
+ZERO_PAGE = bytes(PAGE_SIZE)
+
+
+def state_digest(pc, registers, pages, page_digests, dirty_pages):
+    # pc, registers and the digests of every page that was ever written, in
+    # page order, pages still all zero read like unallocated ones and are
+    # skipped
+    # page_digests holds the digest of every page and is brought up to date
+    # by hashing the dirty_pages again, which is emptied
+    for page_id in dirty_pages:
+        page = pages.get(page_id)
+        if page is None or page == ZERO_PAGE:
+            page_digests.pop(page_id, None)
+        else:
+            page_digests[page_id] = hashlib.blake2b(page, digest_size=16).digest()
+    dirty_pages.clear()
+    digest = hashlib.blake2b(STATE.pack(pc, *registers), digest_size=16)
+    for page_id in sorted(page_digests):
+        digest.update(page_id.to_bytes(4, "little"))
+        digest.update(page_digests[page_id])
+    return digest.hexdigest()
+
+
+def write_header(output, every):
+    output.write(SIDECAR_HEADER.format(every=every))
+
+
+def write_record(output, inst_count, pc, digest):
+    output.write(f"{inst_count} {pc:08x} {digest}\n")
+
+
+def read_sidecar(path):
+    # returns the records as (inst_count, pc, digest)
+    records = []
+    with open(path) as sidecar:
+        for line in sidecar:
+            if line.startswith("#"):
+                continue
+            count, pc, digest = line.split()
+            records.append((int(count), int(pc, 16), digest))
+    return records
+
+
+def first_divergence(records_a, records_b):
+    # (start, end) of the first interval the runs differ in, the states at
+    # start match, None when every common record does
+    start = 0
+    for a, b in zip(records_a, records_b):
+        if a != b:
+            return start, min(a[0], b[0])
+        start = a[0]
+    if len(records_a) != len(records_b):
+        # one run went on after the other one stopped
+        longer = records_a if len(records_a) > len(records_b) else records_b
+        return start, longer[min(len(records_a), len(records_b))][0]
+    return None
@@ -1,48 +1,56 @@
+import argparse
 import subprocess
 import os
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from tqdm import tqdm
 
+from merge_logs import find_ebreak, merge_commits
 
-def run_spike(file, debug_file):
-    file_base = str(file).split("/")[-1][:-2]
-    with open(os.path.join("spike", "outputs", f"{file_base}.r"), "w") as f:
-        subprocess.run(
-            [
-                "spike",
-                "--isa=RV32IM",
-                "-m0x10000:0x500000",
-                "-l",
-                f"--log={os.path.join('spike', 'outputs', f'{file_base}.i')}",
-                "-d",
-                f"--debug-cmd={debug_file}",
-                file,
-            ],
-            stderr=f,
-        )
-
-
-def generate_debug_file(inst_file):
-    lines = 0
-    with open(inst_file, "r") as f:
-        for line in f:
-            if line[10:12] == "0x":
-                lines += 1
 
-    with open(f"{inst_file[:-2]}.d", "w") as f:
-        f.write("until pc 0 10094\n")
-        for i in range(lines):
-            f.write("run 1\n")
-            f.write("reg 0\n")
+def run_spike(file):
+    # one spike run per test, its commit log is read from a pipe and written
+    # in the simulator log format as it is produced
+    file_base = str(file).split("/")[-1][:-2]
+    entry, end_pc = find_ebreak(file)
+    debug_file = os.path.join("spike", "outputs", f"{file_base}.d")
+    with open(debug_file, "w") as f:
+        f.write(f"until pc 0 {end_pc:x}\n")
         f.write("quit\n")
+    spike = subprocess.Popen(
+        [
+            "spike",
+            "--isa=RV32IM",
+            "-m0x10000:0x500000",
+            "--log-commits",
+            "--log=/dev/stdout",
+            "-d",
+            f"--debug-cmd={debug_file}",
+            file,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True,
+    )
+    with open(os.path.join("spike", "outputs", f"{file_base}.log"), "w") as log:
+        merge_commits(spike.stdout, log, entry, end_pc)
+    if spike.wait() != 0:
+        raise RuntimeError(f"spike failed on {file} with exit status {spike.returncode}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of spike runs in parallel, 0 uses every core",
+        type=int,
+        default=0,
+    )
+
+    args = parser.parse_args()
     input_files = sorted(glob("test/*.o"))
-    for file in input_files:
-        run_spike(file, "spike/initial_debug.d")
-    for inst_file in sorted(glob("spike/outputs/*.i")):
-        generate_debug_file(inst_file)
-    debug_files = tqdm(sorted(glob("spike/outputs/*.d")))
-    for i, d in tqdm(zip(input_files, debug_files)):
-        run_spike(i, d)
+    with ProcessPoolExecutor(max_workers=args.jobs or os.cpu_count()) as executor:
+        for _ in tqdm(executor.map(run_spike, input_files), total=len(input_files)):
+            pass
@@ -1,63 +1,80 @@
+import os
+import sys
 from glob import glob
 from tqdm import tqdm
 
-import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "project"))
 
+from utils import program_load
 
-def bin_to_int(content):
-    return np.int32(int(content, 2))
+MASK = 0xFFFFFFFF
+EBREAK = 0x00100073
 
 
-def hex_to_bin(content):
-    return format(int(content, 16), "0>32b")
+def parse_commit(line):
+    # "core   0: 3 0x00010094 (0x00000093) x1  0x00000000", returns
+    # (pc, inst, (rd, value) or None), other lines (disassembly, debug
+    # console) return None
+    fields = line.split()
+    if len(fields) < 5 or fields[0] != "core" or not fields[2].isdigit():
+        return None
+    pc = int(fields[3], 16) & MASK
+    inst = int(fields[4][1:-1], 16)
+    write = None
+    if len(fields) > 6 and fields[5][0] == "x" and fields[5][1:].isdigit():
+        write = (int(fields[5][1:]), int(fields[6], 16) & MASK)
+    return pc, inst, write
 
 
-def decode_line(line):
-    pc = line[12:20]
-    inst = line[24:32]
-    bin_inst = hex_to_bin(inst)
+def merge_commits(lines, log, entry, end_pc=None):
+    # streams spike's commit log into the simulator log format, the register
+    # file starts zeroed at the entry point like in the simulator (the boot
+    # ROM before it is skipped), end_pc is the EBREAK that stopped spike, it
+    # traps so spike does not commit it
+    regs = [0] * 32
+    started = False
+    for line in lines:
+        commit = parse_commit(line)
+        if commit is None:
+            continue
+        pc, inst, write = commit
+        if not started:
+            if pc != entry:
+                continue
+            started = True
+        rd, rs1, rs2 = (inst >> 7) & 0x1F, (inst >> 15) & 0x1F, (inst >> 20) & 0x1F
+        rs1_value, rs2_value = regs[rs1], regs[rs2]
+        if write is not None and write[0]:
+            regs[write[0]] = write[1]
+        log.write(
+            f"PC={pc:08X} [{inst:08X}] x{rd:02d}={regs[rd]:08X} x{rs1:02d}={rs1_value:08X} x{rs2:02d}={rs2_value:08X}\n"
+        )
+    if started and end_pc is not None:
+        log.write(
+            f"PC={end_pc:08X} [{EBREAK:08X}] x00={0:08X} x00={0:08X} x01={regs[1]:08X}\n"
+        )
 
-    reg_ids = {
-        "rs1": bin_to_int(bin_inst[12:17]),
-        "rs2": bin_to_int(bin_inst[7:12]),
-        "rd": bin_to_int(bin_inst[20:25]),
-    }
-    return pc.upper(), inst.upper(), reg_ids
 
+def find_ebreak(program):
+    # address of the first EBREAK after the entry point, where crt.S stops
+    entry, segments = program_load.read_elf(program)
+    for addr, data in segments:
+        if addr <= entry < addr + len(data):
+            for offset in range(entry - addr, len(data) - 3, 4):
+                if int.from_bytes(data[offset : offset + 4], "little") == EBREAK:
+                    return entry, addr + offset
+    raise ValueError(f"{program} has no EBREAK after its entry point")
 
-def get_regs(file):
-    regs = []
-    for _ in range(8):
-        line_regs = [
-            item for item in file.readline().strip().split(" ") if len(item) == 10
-        ]
-        for reg_value in line_regs:
-            regs.append(reg_value[2:].upper())
-    return regs
+
+def merge_file(commit_file):
+    # commit logs saved by hand (spike --log-commits --log=X.commit), the
+    # entry point comes from the matching test/X.o
+    base = commit_file.split("/")[-1][: -len(".commit")]
+    entry, end_pc = find_ebreak(os.path.join("test", f"{base}.o"))
+    with open(commit_file, "r") as commits, open(f"{commit_file[:-len('.commit')]}.log", "w") as log:
+        merge_commits(commits, log, entry, end_pc)
 
 
 if __name__ == "__main__":
-    reg_files = sorted(glob("spike/outputs/*.r"))
-    inst_files = sorted(glob("spike/outputs/*.i"))
-    for reg, inst in tqdm(zip(reg_files, inst_files)):
-        log_file = f"{reg[:-2]}.log"
-        with open(inst, "r") as i, open(reg, "r") as r, open(log_file, "w") as log:
-            r.readline()
-            acc = 0
-            while acc < 31:
-                line = i.readline()
-                if line[10:12] == "0x":
-                    pc, inst_hex, reg_ids = decode_line(line)
-                    log.write(
-                        f"PC={pc} [{inst_hex}] x{reg_ids['rd']:02d}=00000000 x{reg_ids['rs1']:02d}=00000000 x{reg_ids['rs2']:02d}=00000000\n"
-                    )
-                    prev_regs = get_regs(r)
-                    acc += 1
-            for line in i:
-                if line[10:12] == "0x":
-                    pc, inst_hex, reg_ids = decode_line(line)
-                    cur_regs = get_regs(r)
-                    log.write(
-                        f"PC={pc} [{inst_hex}] x{reg_ids['rd']:02d}={cur_regs[reg_ids['rd']]} x{reg_ids['rs1']:02d}={prev_regs[reg_ids['rs1']]} x{reg_ids['rs2']:02d}={prev_regs[reg_ids['rs2']]}\n"
-                    )
-                    prev_regs = cur_regs
+    for commit_file in tqdm(sorted(glob("spike/outputs/*.commit"))):
+        merge_file(commit_file)